@@ -0,0 +1,24 @@
+# This file is part of tdmclient.
+# Copyright 2021-2026 ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE,
+# Miniature Mobile Robots group, Switzerland
+# Author: Yves Piguet
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+from tdmclient import ClientAsync, Recorder
+
+if __name__ == "__main__":
+
+    with ClientAsync() as client:
+
+        async def prog():
+            await client.wait_for_node()
+            nodes = list(client.nodes)
+            with Recorder(client, "recording",
+                          variables=["prox.horizontal", "prox.ground.delta"]):
+                for node in nodes:
+                    await node.watch(variables=True)
+                await client.sleep(60)
+            print("done")
+
+        client.run_async_program(prog)
@@ -9,19 +9,28 @@
 Communication with TDM.
 """
 
-from tdmclient.fb import FlatBuffer, Table, Union
+from tdmclient.fb import (FlatBuffer, FlexBuffer, Table, Union, SchemaItem,
+                          TableView, UnionView)
 from tdmclient.zeroconf import TDMZeroconfBrowser
-from tdmclient.tcp import TDMConnection
+from tdmclient.tcp import TDMConnection, PacketReader
 try:
     from tdmclient.ws import TDMConnectionWS
 except ModuleNotFoundError:
     pass
-from tdmclient.thymio import ThymioFB, Node
+from tdmclient.thymio import ThymioFB, Node, MessageTemplate, RequestTimeoutError
 from tdmclient.client import Client
-from tdmclient.clientasync import ClientAsync, NodeLockError
+from tdmclient.eventstream import EventStream
+from tdmclient.clientasync import ClientAsync, NodeLockError, RequestHandle
 from tdmclient.clientnode import ClientNode
 from tdmclient.clientasyncnode import ClientAsyncNode
-from tdmclient.clientasynccachenode import ClientAsyncCacheNode, ArrayCache
+from tdmclient.clientasynccachenode import (ClientAsyncCacheNode, ArrayCache,
+                                           FlushScheduler, VariableHistory)
+try:
+    # asyncio.BufferedProtocol requires Python 3.7
+    from tdmclient.aio import ClientAio, TDMProtocol
+except AttributeError:
+    pass
+from tdmclient.recorder import Recorder, NpyFile
 from tdmclient.repl import TDMConsole
 
 from tdmclient.server import (Server, ServerNode,
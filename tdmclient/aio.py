@@ -0,0 +1,300 @@
+# This file is part of tdmclient.
+# Copyright 2021-2026 ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE,
+# Miniature Mobile Robots group, Switzerland
+# Author: Yves Piguet
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Communication with Thymio Device Manager in asyncio programs
+"""
+
+import asyncio
+import struct
+import time
+import types
+from collections import deque
+
+import tdmclient
+from tdmclient.client import DisconnectedError
+from tdmclient.tcp import PacketReader
+
+
+class TDMProtocol(asyncio.BufferedProtocol):
+    """asyncio protocol for the connection to the TDM via plain TCP, which
+    can be used as a transport by Client (methods send_packet,
+    receive_packet and request_shutdown).
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.packet_reader = PacketReader()
+        self.comm_error = None
+        # fun(packet) called for each packet received, or None to queue
+        # packets for receive_packet
+        self.on_packet = None
+        self.input_queue = deque()
+        # fun(exc) called when the connection is lost
+        self.on_connection_lost = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.packet_reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        for packet in self.packet_reader.buffer_updated(nbytes):
+            if self.on_packet is None:
+                self.input_queue.append(packet)
+                continue
+            try:
+                self.on_packet(packet)
+            except Exception as error:
+                # report error without closing the connection
+                asyncio.get_running_loop().call_exception_handler({
+                    "message": "Error while processing TDM packet",
+                    "exception": error,
+                    "protocol": self,
+                })
+
+    def connection_lost(self, exc):
+        self.comm_error = exc
+        self.transport = None
+        if self.on_connection_lost is not None:
+            self.on_connection_lost(exc)
+
+    def send_packet(self, packet):
+        """Send a packet.
+        """
+        if self.transport is None:
+            raise DisconnectedError("TDM disconnected")
+        # new bytes object, since the transport can keep it until it's sent
+        self.transport.write(struct.pack("<I", len(packet)) + packet)
+
+    def pause_reading(self):
+        """Stop receiving data until resume_reading is called.
+        """
+        if self.transport is not None:
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        if self.transport is not None:
+            self.transport.resume_reading()
+
+    def receive_packet(self):
+        """Get next received packet, or None if none.
+        """
+        return self.input_queue.popleft() if len(self.input_queue) > 0 else None
+
+    def request_shutdown(self, on_terminated=None):
+        """Close the connection and call on_terminated (if not None).
+        """
+        if self.transport is not None:
+            self.transport.close()
+        if on_terminated is not None:
+            on_terminated()
+
+
+class ClientAio(tdmclient.ClientAsync):
+    """Client for asyncio programs. Incoming messages are processed by the
+    event loop as soon as they're received, and requests are asyncio
+    futures resolved when their reply is received. Async methods of the
+    client and of its nodes can be combined with asyncio.gather,
+    asyncio.wait_for etc.
+
+    Should be created in a coroutine with "await ClientAio.create(...)".
+    """
+
+    def __init__(self, tdm_transport, **kwargs):
+        """Client using tdm_transport, typically a TDMProtocol object.
+        Other arguments are passed to ClientAsync.
+        """
+        self.loop = asyncio.get_running_loop()
+        # futures of coroutines waiting for the next message
+        self.message_waiters = []
+        # futures of requests waiting for their reply
+        self.pending_requests = set()
+        # asyncio handle of the next write-behind of cached variables
+        self.flush_timer = None
+        super(ClientAio, self).__init__(tdm_transport=tdm_transport, **kwargs)
+        tdm_transport.on_packet = self.process_incoming_message
+        tdm_transport.on_connection_lost = self.connection_lost
+
+    @classmethod
+    async def create(cls, tdm_addr=None, tdm_port=None, **kwargs):
+        """Connect to the TDM via plain TCP and return a new client.
+
+        Arguments (all are optional):
+            tdm_addr - TDM address (default: local)
+            tdm_port - TDM port (default: 8596)
+        Other arguments are passed to ClientAio.
+        """
+        _, protocol = await asyncio.get_running_loop().create_connection(
+            TDMProtocol,
+            tdm_addr or "127.0.0.1",
+            tdm_port or cls.DEFAULT_TDM_PORT
+        )
+        return cls(tdm_transport=protocol, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        self.disconnect()
+
+    def process_incoming_message(self, msg):
+        super(ClientAio, self).process_incoming_message(msg)
+        self.notify_message_waiters()
+
+    def notify_message_waiters(self):
+        waiters = self.message_waiters
+        self.message_waiters = []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    def connection_lost(self, exc):
+        self.tdm = None
+        for future in list(self.pending_requests):
+            if not future.done():
+                future.set_exception(DisconnectedError("TDM disconnected"))
+        self.notify_message_waiters()
+
+    def pause_receiving(self, owner):
+        if len(self.receive_pausers) == 0 and self.tdm is not None:
+            self.tdm.pause_reading()
+        super(ClientAio, self).pause_receiving(owner)
+
+    def resume_receiving(self, owner):
+        super(ClientAio, self).resume_receiving(owner)
+        if len(self.receive_pausers) == 0 and self.tdm is not None:
+            self.tdm.resume_reading()
+
+    def schedule_flush(self, node):
+        super(ClientAio, self).schedule_flush(node)
+        if self.flush_scheduler is not None and self.flush_timer is None:
+            # once the current task yields, to merge successive changes
+            self.flush_timer = self.loop.call_soon(self.poll_flush_scheduler)
+
+    def poll_flush_scheduler(self):
+        self.flush_timer = None
+        if self.flush_scheduler is not None and self.tdm is not None:
+            deadline = self.flush_scheduler.poll()
+            if deadline is not None:
+                self.flush_timer = self.loop.call_later(max(deadline - time.monotonic(), 0),
+                                                        self.poll_flush_scheduler)
+
+    def send_request(self, send_fun):
+        """Call a function which sends a message and return an asyncio
+        future resolved with its reply.
+
+        Parameter: send_fun(request_id_notify)
+        """
+
+        future = self.loop.create_future()
+
+        def notify(r):
+            if not future.done():
+                if isinstance(r, tdmclient.RequestTimeoutError):
+                    future.set_exception(r)
+                else:
+                    future.set_result(r)
+
+        self.pending_requests.add(future)
+        future.add_done_callback(self.pending_requests.discard)
+        try:
+            send_fun(notify)
+        except Exception:
+            future.cancel()
+            raise
+        request_id = self.last_request_id
+
+        def on_done(future):
+            if future.cancelled():
+                # nobody waits for the reply anymore
+                self.cancel_request(request_id)
+
+        future.add_done_callback(on_done)
+        _, deadline = self.request_time_dict.get(request_id, (None, None))
+        if deadline is not None:
+            # check deadline even if no message is received (with a margin,
+            # since timers can fire up to the clock resolution in advance)
+            self.loop.call_later(max(deadline - time.monotonic(), 0) + 0.001,
+                                 self.expire_requests)
+        return future
+
+    @types.coroutine
+    def send_msg_and_get_result(self, send_fun):
+        """Call a function which sends a message and wait for its reply.
+
+        Parameter: send_fun(request_id_notify)
+        """
+        result = yield from self.send_request(send_fun)
+        return result
+
+    async def gather(self, *coroutines, limit=None, return_exceptions=False):
+        """Run coroutines concurrently with asyncio.gather, with at most limit
+        of them at the same time (no limit if None), and return the list of
+        their results.
+        """
+        if limit is not None:
+            semaphore = asyncio.Semaphore(limit)
+
+            async def limited(co):
+                async with semaphore:
+                    return await co
+
+            coroutines = [limited(co) for co in coroutines]
+        return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
+
+    @types.coroutine
+    def wait_for_messages(self, timeout=None):
+        """Wait until new messages have been processed, or for timeout
+        seconds (forever if None). Return True if messages have been processed.
+        """
+        future = self.loop.create_future()
+        self.message_waiters.append(future)
+        try:
+            yield from asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if future in self.message_waiters:
+                self.message_waiters.remove(future)
+
+    @types.coroutine
+    def sleep(self, duration=-1, wake=None):
+        """Wait for duration seconds (forever if negative), or until
+        wake() returns True after a message has been processed.
+        """
+        t_end = None if duration < 0 else self.loop.time() + duration
+        while wake is None or not wake():
+            timeout = None if t_end is None else t_end - self.loop.time()
+            if timeout is not None and timeout <= 0:
+                break
+            yield from self.wait_for_messages(timeout)
+
+    @types.coroutine
+    def wait_for_node(self, timeout=None, **kwargs):
+        yield from self.sleep(-1 if timeout is None else timeout,
+                              wake=lambda: self.first_node(**kwargs) is not None)
+        return self.first_node(**kwargs)
+
+    @types.coroutine
+    def wait_for_status(self, expected_status, **kwargs):
+        """Wait until the first node has the specified status.
+        """
+        yield from self.wait_for_status_set({expected_status}, **kwargs)
+
+    @types.coroutine
+    def wait_for_status_set(self, expected_status_set, **kwargs):
+        """Wait until the first node has one of the specified statuses.
+        """
+
+        def wake():
+            node = self.first_node(**kwargs)
+            return node is not None and node.status in expected_status_set
+
+        yield from self.sleep(wake=wake)
@@ -5,6 +5,8 @@
 #
 # SPDX-License-Identifier: BSD-3-Clause
 
+from time import sleep
+
 from tdmclient import TDMZeroconfBrowser, TDMConnection
 try:
     from tdmclient import TDMConnectionWS
@@ -25,6 +27,13 @@ class Client(ThymioFB):
     DEFAULT_TDM_PORT = 8596
     DEFAULT_TDM_WS_PORT = 8597
 
+    # message types filtered by track_nodes (node id in first field)
+    NODE_MESSAGE_TYPES = {
+        ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED,
+        ThymioFB.MESSAGE_TYPE_EVENTS_EMITTED,
+        ThymioFB.MESSAGE_TYPE_VM_EXECUTION_STATE_CHANGED,
+    }
+
     def __init__(self,
                  zeroconf=False, zeroconf_all=False,
                  tdm_ws=False, tdm_addr=None, tdm_port=None,
@@ -62,6 +71,20 @@ class Client(ThymioFB):
         # processing, or None to stop there
         self.intercept_incoming_message = None
 
+        # message types discarded before being decoded
+        self.ignored_message_types = set()
+        # dict message_type: list of fun(msg_view) called before decoding
+        # messages of that type, which return False to discard them
+        # (msg_view: message content as a TableView, decoded lazily)
+        self.message_filters = {}
+        # set of ids (bytes) of the nodes whose variables, events and vm
+        # state are processed, or None for all nodes
+        self.tracked_node_ids = None
+        # number of messages discarded without being decoded
+        self.skipped_message_count = 0
+        # objects which have paused the processing of incoming messages
+        self.receive_pausers = set()
+
         def on_zc_change(is_added, addr, port, ws_port):
             if is_added and self.tdm_addr is None:
                 if self.debug >= 1:
@@ -168,18 +191,111 @@ class Client(ThymioFB):
             print("send list of nodes request")
         self.send_packet(self.create_msg_request_list_of_nodes())
 
+    def ignore_message_type(self, message_type, ignore=True):
+        """Discard (or stop discarding) incoming messages of the specified
+        type before they're decoded.
+        """
+        if ignore:
+            self.ignored_message_types.add(message_type)
+        else:
+            self.ignored_message_types.discard(message_type)
+
+    def add_message_filter(self, message_type, fun):
+        """Add a function fun(msg_view) called for each incoming message of
+        the specified type before it's decoded, which returns False to discard
+        it. msg_view is the message content as a TableView.
+        """
+        if message_type not in self.message_filters:
+            self.message_filters[message_type] = []
+        self.message_filters[message_type].append(fun)
+
+    def remove_message_filter(self, message_type, fun):
+        self.message_filters[message_type].remove(fun)
+        if len(self.message_filters[message_type]) == 0:
+            del self.message_filters[message_type]
+
+    def track_nodes(self, nodes=None):
+        """Process variable changes, events and vm state changes only for the
+        specified nodes (Node objects or node id strings), or for all nodes
+        if nodes is None.
+        """
+        if nodes is None:
+            self.tracked_node_ids = None
+        else:
+            self.tracked_node_ids = {
+                ThymioFB.id_str_to_bytes(node) if isinstance(node, str) else node.id
+                for node in nodes
+            }
+
+    def accept_message(self, msg):
+        """Check with the union type and the filters whether an incoming
+        message should be decoded and processed.
+        """
+        message_type = FlatBuffer.peek_union_type(msg)
+        if message_type in self.ignored_message_types:
+            return False
+        filters = self.message_filters.get(message_type)
+        check_node_id = (self.tracked_node_ids is not None
+                         and message_type in self.NODE_MESSAGE_TYPES)
+        if filters or check_node_id:
+            fb = FlatBuffer()
+            fb.parse(msg, self.SCHEMA, lazy=True)
+            union_data = fb.root.union_data
+            msg_view = union_data[0] if union_data is not None else None
+            if check_node_id and msg_view is not None:
+                node_id = msg_view.field(0)
+                if node_id is None or bytes(node_id.field(0, b"")) not in self.tracked_node_ids:
+                    return False
+            if filters:
+                for fun in filters:
+                    if not fun(msg_view):
+                        return False
+        return True
+
+    def pause_receiving(self, owner):
+        """Stop processing incoming messages, which are kept by the transport,
+        until resume_receiving is called with the same owner.
+        """
+        self.receive_pausers.add(owner)
+
+    def resume_receiving(self, owner):
+        self.receive_pausers.discard(owner)
+
     def process_waiting_messages(self):
         at_least_one = False
         if self.tdm:
-            while True:
+            while len(self.receive_pausers) == 0:
                 msg = self.tdm.receive_packet()
                 if msg is None:
                     break
-                if self.debug >= 3:
-                    print("recv", msg)
-                if self.intercept_incoming_message:
-                    msg = self.intercept_incoming_message(msg)
-                if msg:
-                    self.process_message(msg)
+                self.process_incoming_message(msg)
                 at_least_one = True
+        self.expire_requests()
         return at_least_one
+
+    def wait_for_packet(self, timeout):
+        """Wait until a packet has been received from the tdm, or for timeout
+        seconds. Return True if packets are waiting, or if the transport
+        doesn't support waiting (then just sleep).
+        """
+        if len(self.receive_pausers) > 0:
+            # packets which are waiting won't be processed
+            sleep(timeout)
+            return False
+        if self.tdm is not None and hasattr(self.tdm, "wait_for_packet"):
+            return self.tdm.wait_for_packet(timeout)
+        sleep(timeout)
+        return True
+
+    def process_incoming_message(self, msg):
+        """Process a message received from the tdm.
+        """
+        if self.debug >= 3:
+            print("recv", bytes(msg))
+        if self.intercept_incoming_message:
+            msg = self.intercept_incoming_message(msg)
+        if msg:
+            if self.accept_message(msg):
+                self.process_message(msg)
+            else:
+                self.skipped_message_count += 1
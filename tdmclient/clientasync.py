@@ -6,6 +6,7 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 from time import sleep, monotonic
+from collections import deque
 import tdmclient
 import types
 
@@ -34,17 +35,87 @@ class NodeLockError(Exception):
         return self.message
 
 
+class RequestHandle:
+    """Request sent by ClientAsync.send_nowait, whose reply hasn't been
+    waited for. Once the reply has been received, done is True and result is
+    None for success or the error.
+    """
+
+    __slots__ = ("request_id", "node", "done", "result")
+
+    def __init__(self, node=None):
+        self.request_id = None
+        self.node = node
+        self.done = False
+        self.result = None
+
+    def __repr__(self):
+        state = ("pending" if not self.done
+                 else "ok" if self.result is None
+                 else f"error {self.result}")
+        return f"Request {self.request_id} ({state})"
+
+
 class ClientAsync(tdmclient.Client):
 
     DEFAULT_SLEEP = 0.1
 
+    # maximum number of errors kept in request_errors
+    MAX_REQUEST_ERRORS = 1000
+
     def __init__(self, node_class=None, **kwargs):
         super(ClientAsync, self).__init__(**kwargs)
         self.node_class = node_class or tdmclient.ClientAsyncCacheNode
+        # write-behind of cached variables (see set_write_behind)
+        self.flush_scheduler = None
+        # requests sent with send_nowait: RequestHandle objects of failed
+        # requests (most recent ones), function on_request_error(handle)
+        # called for each error, and counters
+        self.request_errors = deque(maxlen=self.MAX_REQUEST_ERRORS)
+        self.on_request_error = None
+        self.nowait_counts = {"sent": 0, "completed": 0, "failed": 0}
 
     def create_node(self, node_dict):
         return self.node_class(self, node_dict)
 
+    def set_write_behind(self, rate=50, max_changes=None, link_rate=None):
+        """Send variables changed in the cache of nodes automatically while
+        the client processes messages (e.g. in sleep), at most rate times per
+        second for each node, immediately when max_changes variables are
+        waiting, and at most link_rate times per second for all the nodes.
+        Disable write-behind if rate is None.
+        """
+        self.flush_scheduler = (tdmclient.FlushScheduler(rate, max_changes, link_rate)
+                                if rate is not None else None)
+
+    def schedule_flush(self, node):
+        """Called by a ClientAsyncCacheNode when variables have been changed
+        in its cache.
+        """
+        if self.flush_scheduler is not None:
+            self.flush_scheduler.changed(node)
+
+    def events(self, names=None, node=None, max_size=1000,
+               overflow=tdmclient.EventStream.DROP_OLDEST):
+        """Get a new EventStream to iterate over the events received.
+        """
+        return tdmclient.EventStream(self, names=names, node=node,
+                                     max_size=max_size, overflow=overflow)
+
+    def process_waiting_messages(self):
+        at_least_one = super(ClientAsync, self).process_waiting_messages()
+        if self.flush_scheduler is not None:
+            self.flush_scheduler.poll()
+        return at_least_one
+
+    def wait_for_packet(self, timeout):
+        if self.flush_scheduler is not None:
+            # wake up for the next write-behind deadline
+            deadline = self.flush_scheduler.next_deadline()
+            if deadline is not None:
+                timeout = max(min(timeout, deadline - monotonic()), 0)
+        return super(ClientAsync, self).wait_for_packet(timeout)
+
     @staticmethod
     def filter_nodes(nodes, node_id=None, node_name=None):
         for node in nodes:
@@ -56,21 +127,39 @@ class ClientAsync(tdmclient.Client):
     def first_node(self, **kwargs):
         """First matching node if there is one.
         """
-        for node in self.filter_nodes(self.nodes, **kwargs):
+        for node in self.find_nodes(**kwargs):
             return node
 
     @types.coroutine
     def sleep(self, duration=-1, wake=None):
+        """Wait for duration seconds (forever if negative) while processing
+        incoming messages as soon as they're received, or until wake()
+        returns True.
+        """
         t0 = monotonic()
         while duration < 0 or monotonic() < t0 + duration:
             self.process_waiting_messages()
-            sleep(self.DEFAULT_SLEEP
-                  if duration < 0
-                  else max(min(self.DEFAULT_SLEEP, t0 + duration - monotonic()),
-                           self.DEFAULT_SLEEP / 1e3))
             if wake is not None and wake():
                 break
             yield
+            self.wait_for_packet(self.DEFAULT_SLEEP
+                                 if duration < 0
+                                 else max(min(self.DEFAULT_SLEEP, t0 + duration - monotonic()),
+                                          self.DEFAULT_SLEEP / 1e3))
+
+    @types.coroutine
+    def wait_for_messages(self, timeout=None):
+        """Process waiting messages, or wait until some are received (at most
+        timeout seconds) if there are none. Return True if messages have been
+        processed.
+        """
+        if self.process_waiting_messages():
+            yield
+            return True
+        yield
+        self.wait_for_packet(self.DEFAULT_SLEEP if timeout is None
+                             else min(timeout, self.DEFAULT_SLEEP))
+        return self.process_waiting_messages()
 
     @types.coroutine
     def wait_for_tdm(self, timeout=None):
@@ -94,15 +183,17 @@ class ClientAsync(tdmclient.Client):
 
     @types.coroutine
     def wait_for_node(self, timeout=None, **kwargs):
-        time = 0
-        while timeout is None or time < timeout:
+        t0 = monotonic()
+        while timeout is None or monotonic() < t0 + timeout:
             if self.process_waiting_messages():
                 node = self.first_node(**kwargs)
                 if node is not None:
                     return node
             else:
-                sleep(self.DEFAULT_SLEEP)
-                time += self.DEFAULT_SLEEP
+                self.wait_for_packet(self.DEFAULT_SLEEP
+                                     if timeout is None
+                                     else max(min(self.DEFAULT_SLEEP, t0 + timeout - monotonic()),
+                                              0))
             yield
 
     @types.coroutine
@@ -115,7 +206,7 @@ class ClientAsync(tdmclient.Client):
                 if node is not None and node.status == expected_status:
                     return
             else:
-                sleep(self.DEFAULT_SLEEP)
+                self.wait_for_packet(self.DEFAULT_SLEEP)
             yield
 
     @types.coroutine
@@ -128,7 +219,7 @@ class ClientAsync(tdmclient.Client):
                 if node is not None and node.status in expected_status_set:
                     return
             else:
-                sleep(self.DEFAULT_SLEEP)
+                self.wait_for_packet(self.DEFAULT_SLEEP)
             yield
 
     @types.coroutine
@@ -157,6 +248,8 @@ class ClientAsync(tdmclient.Client):
     @types.coroutine
     def send_msg_and_get_result(self, send_fun):
         """Call a function which sends a message and wait for its reply.
+        Raise RequestTimeoutError if there is no reply before the request
+        timeout.
 
         Parameter: send_fun(request_id_notify)
         """
@@ -171,12 +264,175 @@ class ClientAsync(tdmclient.Client):
             done = True
 
         send_fun(notify)
-        while not done:
-            yield
-            sleep(self.DEFAULT_SLEEP)
-            self.process_waiting_messages()
+        request_id = self.last_request_id
+        try:
+            while not done:
+                yield
+                # reply possibly processed in the meantime by another coroutine
+                if not done and not self.process_waiting_messages():
+                    self.wait_for_packet(self.DEFAULT_SLEEP)
+                    self.process_waiting_messages()
+        finally:
+            if not done:
+                # coroutine closed before the reply: forget the request
+                self.cancel_request(request_id)
+        if isinstance(result, tdmclient.RequestTimeoutError):
+            raise result
         return result
 
+    def send_nowait(self, send_fun, node=None):
+        """Call a function which sends a message and return a RequestHandle
+        without waiting for the reply. Errors (error replies or
+        RequestTimeoutError) are stored in self.request_errors and passed to
+        self.on_request_error if it isn't None.
+
+        Parameter: send_fun(request_id_notify)
+        """
+
+        handle = RequestHandle(node)
+
+        def notify(result):
+            handle.done = True
+            handle.result = result
+            if result is None:
+                self.nowait_counts["completed"] += 1
+            else:
+                self.nowait_counts["failed"] += 1
+                self.request_errors.append(handle)
+                if self.on_request_error is not None:
+                    self.on_request_error(handle)
+
+        send_fun(notify)
+        handle.request_id = self.last_request_id
+        self.nowait_counts["sent"] += 1
+        return handle
+
+    def pop_request_errors(self):
+        """Remove and return the list of RequestHandle objects of the requests
+        sent with send_nowait which have failed.
+        """
+        errors = list(self.request_errors)
+        self.request_errors.clear()
+        return errors
+
+    @types.coroutine
+    def gather(self, *coroutines, limit=None, return_exceptions=False):
+        """Run coroutines concurrently, stepping them in turn, with at most
+        limit of them at the same time (no limit if None), and return the
+        list of their results. If return_exceptions is False, the exception
+        raised by the first coroutine which has failed is raised once all of
+        them have terminated; else exceptions are returned as results.
+        """
+
+        results = [None] * len(coroutines)
+        error = None
+        waiting = list(enumerate(coroutines))
+        waiting.reverse()
+        running = []
+        try:
+            while len(waiting) > 0 or len(running) > 0:
+                while len(waiting) > 0 and (limit is None or len(running) < limit):
+                    running.append(waiting.pop())
+                still_running = []
+                for i, co in running:
+                    try:
+                        co.send(None)
+                        still_running.append((i, co))
+                    except StopIteration as e:
+                        results[i] = e.value
+                    except Exception as e:
+                        results[i] = e
+                        if error is None:
+                            error = e
+                running = still_running
+                if len(waiting) > 0 or len(running) > 0:
+                    yield
+        finally:
+            # close coroutines if gather is interrupted
+            for i, co in running:
+                co.close()
+        if error is not None and not return_exceptions:
+            raise error
+        return results
+
+    @staticmethod
+    def coalesce_events(events):
+        """Group events (node, event_name, event_data) in a list of (node,
+        event_dict) for as few SendEvents messages as possible, keeping the
+        order of the events of each node (a message can't contain the same
+        event twice). Events are sent to the group of the node, hence events
+        for nodes of the same group are merged.
+        """
+        messages = []
+        # index in messages of the last message of each group
+        last_message = {}
+        for node, event_name, event_data in events:
+            group_id = node.props["group_id"]
+            i = last_message.get(group_id)
+            if i is None or event_name in messages[i][1]:
+                i = len(messages)
+                last_message[group_id] = i
+                messages.append((node, {}))
+            messages[i][1][event_name] = event_data
+        return messages
+
+    @types.coroutine
+    def send_events_batch(self, events):
+        """Send events (node, event_name, event_data) to one or several nodes
+        in as few messages as possible, without waiting for a reply before
+        sending the next message. Return None if all the events have been
+        sent successfully, else the first error.
+        """
+        results = yield from self.gather(*[
+            node.send_events(event_dict)
+            for node, event_dict in self.coalesce_events(events)
+        ])
+        for result in results:
+            if result is not None:
+                return result
+        return None
+
+    @types.coroutine
+    def send_events_paced(self, steps, rate, wait_for_replies=True):
+        """Send steps of events at rate steps per second, without waiting for
+        replies in the meantime. Each step is a sequence of events (node,
+        event_name, event_data) sent with send_events_batch. Return a dict
+        with the number of steps and messages, the list of errors, and the
+        mean and max delay of steps with respect to their schedule
+        ("jitter_mean" and "jitter_max", in seconds); errors are collected
+        only if wait_for_replies is True.
+        """
+
+        pending = 0
+        errors = []
+
+        def notify(result):
+            nonlocal pending
+            pending -= 1
+            if result is not None:
+                errors.append(result)
+
+        message_count = 0
+        jitter = []
+        t0 = monotonic()
+        for i, step in enumerate(steps):
+            t = t0 + i / rate
+            yield from self.sleep(max(t - monotonic(), 0))
+            jitter.append(monotonic() - t)
+            for node, event_dict in self.coalesce_events(step):
+                pending += 1
+                message_count += 1
+                node.send_send_events(event_dict, request_id_notify=notify)
+        if wait_for_replies:
+            yield from self.sleep(wake=lambda: pending <= 0)
+        return {
+            "steps": len(jitter),
+            "messages": message_count,
+            "errors": errors,
+            "jitter_mean": sum(jitter) / len(jitter) if len(jitter) > 0 else None,
+            "jitter_max": max(jitter) if len(jitter) > 0 else None,
+        }
+
     @staticmethod
     def step_coroutine(co):
         """Perform one step of a coroutine (the result of calling an async function).
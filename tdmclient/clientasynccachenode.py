@@ -6,24 +6,87 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 from tdmclient import ClientAsyncNode
+from time import monotonic
+import array
+import sys
 import types
 
 
 class ArrayCache:
+    """Array variable of a ClientAsyncCacheNode. Getting elements or slices
+    retrieves the most current values; setting elements or slices (with a
+    sequence of the same size or an int for all the elements) caches the
+    values so that they're sent by the next call to node.flush(). With
+    array.array or numpy storage (client argument array_type), the values
+    are also available without copy with method memoryview() or
+    numpy.asarray, for reading only.
+    """
 
     def __init__(self, node, var_name):
         self.node = node
         self.var_name = var_name
+        # dict updated in place by node
+        self.var = node.var
 
     def __repr__(self):
-        return f"Node array variable {self.var_name}[{len(self.node.var[self.var_name])}]"
+        return f"Node array variable {self.var_name}[{len(self.var[self.var_name])}]"
+
+    def __len__(self):
+        return len(self.var[self.var_name])
+
+    def __iter__(self):
+        return iter(self.var[self.var_name])
 
     def __getitem__(self, key):
-        return self.node.var[self.var_name][key]
+        return self.var[self.var_name][key]
 
     def __setitem__(self, key, value):
-        self.node.var[self.var_name][key] = value
-        self.node.mark_change(self.var_name)
+        values = self.var[self.var_name]
+        if isinstance(key, slice):
+            indices = range(*key.indices(len(values)))
+            if isinstance(value, int):
+                value = [value] * len(indices)
+            elif len(value) != len(indices):
+                raise TDMIncompatibleVarSizeError(self.var_name, len(indices), len(value))
+            if (isinstance(values, array.array)
+                    and not (isinstance(value, array.array)
+                             and value.typecode == values.typecode)):
+                value = array.array(values.typecode, value)
+            old_values = {i: values[i] for i in indices}
+        else:
+            old_value = values[key]
+            old_values = {key % len(values): old_value}
+        values[key] = value
+        self.node.mark_change(self.var_name, old_values)
+
+    def memoryview(self):
+        """Return a read-only memoryview of the values with array.array or
+        numpy storage, without copy (with a copy for array.array before
+        Python 3.8).
+        """
+        values = self.var[self.var_name]
+        if isinstance(values, list):
+            raise Exception("memoryview requires client argument array_type")
+        if not isinstance(values, array.array):
+            # numpy: buffer of a read-only view
+            return memoryview(self.__array__())
+        view = memoryview(values)
+        if hasattr(view, "toreadonly"):
+            return view.toreadonly()
+        return memoryview(values.tobytes()).cast(values.typecode)
+
+    def __buffer__(self, flags):
+        # buffer protocol (python 3.12+)
+        return self.memoryview()
+
+    def __array__(self, dtype=None, copy=None):
+        import numpy
+        a = numpy.asarray(self.var[self.var_name], dtype=dtype)
+        if a.base is not None or a is self.var[self.var_name]:
+            # view of the cache
+            a = a.view()
+            a.flags.writeable = False
+        return a
 
 
 class VarPrefix:
@@ -46,6 +109,88 @@ class VarPrefix:
         self.node.__setitem__(name, value)
 
 
+class VariableHistory:
+    """Ring buffer of the last values of a variable, with the time they've
+    been received (from time.monotonic()) and the timestamp set by the TDM,
+    in arrays allocated once.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        # allocated for the first value
+        self.var_size = None
+        self.times = array.array("d", bytes(8 * size))
+        self.tdm_timestamps = array.array("q", bytes(8 * size))
+        self.values = None
+        # total number of values appended
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def __repr__(self):
+        return f"History of {self.name} ({len(self)}/{self.size})"
+
+    def append(self, value, time, tdm_timestamp=None):
+        """Add a value, replacing the oldest one if the buffer is full.
+        """
+        if self.values is None:
+            self.var_size = len(value)
+            self.values = array.array("h", bytes(2 * self.size * self.var_size))
+        elif len(value) != self.var_size:
+            raise TDMIncompatibleVarSizeError(self.name, self.var_size, len(value))
+        i = self.count % self.size
+        self.times[i] = time
+        self.tdm_timestamps[i] = tdm_timestamp or 0
+        n = self.var_size
+        if not (isinstance(value, array.array) and value.typecode == "h"):
+            value = array.array("h", value)
+        self.values[i * n : (i + 1) * n] = value
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def window(self, duration=None, last=None):
+        """Return the values received during the last duration seconds before
+        the last one, or the last values, oldest first, as a tuple of
+        arrays (times, tdm_timestamps, values); values contains var_size
+        elements per entry.
+        """
+        num = len(self)
+        if last is not None:
+            num = min(num, last)
+        start = self.count - num
+        if duration is not None and num > 0:
+            t_min = self.times[(self.count - 1) % self.size] - duration
+            while num > 0 and self.times[start % self.size] < t_min:
+                start += 1
+                num -= 1
+        n = self.var_size or 0
+        times = array.array("d")
+        tdm_timestamps = array.array("q")
+        values = array.array("h")
+        # at most two contiguous parts in the ring
+        while num > 0:
+            i = start % self.size
+            part = min(num, self.size - i)
+            times += self.times[i : i + part]
+            tdm_timestamps += self.tdm_timestamps[i : i + part]
+            values += self.values[i * n : (i + part) * n]
+            start += part
+            num -= part
+        return times, tdm_timestamps, values
+
+    def to_numpy(self, duration=None, last=None):
+        """Same as window, with numpy arrays; values has one row per entry.
+        """
+        import numpy
+        times, tdm_timestamps, values = self.window(duration, last)
+        return (numpy.array(times), numpy.array(tdm_timestamps),
+                numpy.array(values, dtype=numpy.int16).reshape((len(times), self.var_size or 0)))
+
+
 class TDMIncompatibleVarSizeError(Exception):
     """Assignment of value whose size is incompatible with variable.
     """
@@ -58,16 +203,112 @@ class TDMIncompatibleVarSizeError(Exception):
         return self.message
 
 
+class FlushScheduler:
+    """Write-behind of the variables changed in the cache of
+    ClientAsyncCacheNode objects: changes are sent by poll() without calling
+    flush(), all the variables of a node in a single SetVariables message.
+    """
+
+    def __init__(self, rate=50, max_changes=None, link_rate=None):
+        """New scheduler.
+
+        Arguments:
+            rate - maximum number of messages per second for each node
+            max_changes - number of changed variables of a node which
+            triggers a message immediately (None for no limit)
+            link_rate - maximum number of messages per second for all the
+            nodes, e.g. for nodes sharing a radio link (None for no limit)
+        """
+        self.interval = 1 / rate
+        self.max_changes = max_changes
+        self.link_interval = None if link_rate is None else 1 / link_rate
+        # nodes with changes (dict used as an ordered set), in the order of
+        # their first change
+        self.pending = {}
+        # time of last message by node, and for all the nodes
+        self.last_send_time = {}
+        self.link_last_send_time = None
+        self.message_count = 0
+
+    def link_deadline(self):
+        return (None if self.link_interval is None or self.link_last_send_time is None
+                else self.link_last_send_time + self.link_interval)
+
+    def node_deadline(self, node):
+        return (self.last_send_time[node] + self.interval
+                if node in self.last_send_time else None)
+
+    def changed(self, node, now=None):
+        """Register a node whose variables have been changed in its cache.
+        """
+        if node not in self.pending:
+            self.pending[node] = None
+        if self.max_changes is not None and len(node.var_to_send) >= self.max_changes:
+            now = monotonic() if now is None else now
+            link_deadline = self.link_deadline()
+            if link_deadline is None or link_deadline <= now:
+                self.send(node, now)
+
+    def next_deadline(self):
+        """Time (monotonic) of the next message to send, or None if there are
+        no pending changes.
+        """
+        if len(self.pending) == 0:
+            return None
+        deadline = None
+        for node in self.pending:
+            node_deadline = self.node_deadline(node)
+            if node_deadline is None:
+                deadline = None
+                break
+            deadline = node_deadline if deadline is None else min(deadline, node_deadline)
+        link_deadline = self.link_deadline()
+        if link_deadline is not None and (deadline is None or deadline < link_deadline):
+            deadline = link_deadline
+        return 0 if deadline is None else deadline
+
+    def poll(self, now=None):
+        """Send the changes of the nodes whose deadline has been reached, and
+        return the next deadline (see next_deadline).
+        """
+        now = monotonic() if now is None else now
+        for node in list(self.pending):
+            link_deadline = self.link_deadline()
+            if link_deadline is not None and link_deadline > now:
+                break
+            node_deadline = self.node_deadline(node)
+            if node_deadline is None or node_deadline <= now:
+                self.send(node, now)
+        return self.next_deadline()
+
+    def send(self, node, now):
+        del self.pending[node]
+        if len(node.send_changes()) > 0:
+            self.last_send_time[node] = now
+            self.link_last_send_time = now
+            self.message_count += 1
+
+
 class ClientAsyncCacheNode(ClientAsyncNode):
 
     def __init__(self, thymio, node_dict):
         super(ClientAsyncCacheNode, self).__init__(thymio, node_dict)
         self.var = {}
+        # version incremented for each update of received variables, and
+        # version (in order of update) and monotonic time of each variable
+        self.var_version = 0
+        self.var_versions = {}
+        self.var_timestamps = {}
+        # VariableHistory by name of variables whose values are recorded
+        self.history = {}
         self.var_to_send = {}
+        # previous value of changed elements (dict index: value) of each
+        # variable in var_to_send, or None if the whole variable must be sent
+        self.var_changes = {}
         self.v = VarPrefix(self)
 
         def on_variables_changed(node, variables):
-            self.var = {**self.var, **variables}
+            self.update_variables(variables, tdm_timestamp=self.variables_timestamp)
 
         self.add_variables_changed_listener(on_variables_changed)
 
@@ -84,18 +325,40 @@ class ClientAsyncCacheNode(ClientAsyncNode):
             return ArrayCache(self, key)
 
     def __setitem__(self, key, value):
-        var_len = len(self.var[key])
+        old_value = self.var[key]
+        var_len = len(old_value)
         if isinstance(value, int):
             # scalar
             if var_len != 1:
                 raise TDMIncompatibleVarSizeError(key, var_len, 1)
-            self.var[key] = [value]
+            value = [value]
         else:
             # list
             if var_len != len(value):
-                raise TDMIncompatibleVarSizeError(key, var_len, 1)
-            self.var[key] = value
-        self.mark_change(key)
+                raise TDMIncompatibleVarSizeError(key, var_len, len(value))
+        # copy, since elements are changed in place by ArrayCache
+        self.var[key] = self.storage_value(value, copy=True)
+        self.mark_change(key, dict(enumerate(old_value)))
+
+    def storage_value(self, value, copy=False):
+        """Convert a sequence of int to the type of cached values, depending
+        on the array_type of the client: list (None), array.array("h")
+        ("array") or numpy int16 array ("numpy"). With copy=True, the result
+        never shares memory with value.
+        """
+        array_type = self.thymio.array_type
+        if array_type == "array":
+            if copy or not (isinstance(value, array.array) and value.typecode == "h"):
+                value = array.array("h", value)
+        elif array_type == "numpy":
+            import numpy
+            if copy:
+                value = numpy.array(value, dtype=numpy.int16)
+            else:
+                value = numpy.asarray(value, dtype=numpy.int16)
+        elif copy or not isinstance(value, list):
+            value = list(value)
+        return value
 
     @types.coroutine
     def var_description(self):
@@ -133,22 +396,117 @@ class ClientAsyncCacheNode(ClientAsyncNode):
             var_set = set(descr.keys())
 
         while not set(self.var).issuperset(var_set):
-            if not self.thymio.process_waiting_messages():
-                yield from self.thymio.sleep(self.thymio.DEFAULT_SLEEP)
-            else:
-                yield
+            yield from self.thymio.wait_for_messages()
 
-    def mark_change(self, var_name):
+    def record_history(self, names, size=1000):
+        """Record the last size values of the specified variables in
+        self.history.
+        """
+        for name in names:
+            self.history[name] = VariableHistory(name, size)
+
+    def stop_history(self, names=None):
+        """Stop recording the values of the specified variables (default: all).
+        """
+        for name in list(self.history) if names is None else names:
+            self.history.pop(name, None)
+
+    def update_variables(self, variables, timestamp=None, tdm_timestamp=None):
+        """Update the cache in place with received variables, with a new
+        version and the specified time (default: now), and record the values
+        of the variables in self.history.
+        """
+        if timestamp is None:
+            timestamp = monotonic()
+        self.var_version += 1
+        version = self.var_version
+        var_versions = self.var_versions
+        for name in variables:
+            # move name to the end to keep var_versions sorted by version
+            var_versions.pop(name, None)
+            var_versions[name] = version
+        if self.thymio.array_type is not None:
+            variables = {
+                name: self.storage_value(variables[name])
+                for name in variables
+            }
+        self.var.update(variables)
+        self.var_timestamps.update(dict.fromkeys(variables, timestamp))
+        if len(self.history) > 0:
+            for name in self.history:
+                if name in variables:
+                    self.history[name].append(variables[name], timestamp, tdm_timestamp)
+
+    def changed_since(self, version):
+        """Return a dict of the variables updated after the specified version,
+        typically the value of var_version when the cache was checked last time.
+        """
+        changed = {}
+        if version >= self.var_version:
+            # nothing received since then
+            return changed
+        var_versions = self.var_versions
+        # newest first; dicts are reversible only since python 3.8
+        names = (reversed(var_versions) if sys.version_info >= (3, 8)
+                 else reversed(list(var_versions)))
+        for name in names:
+            if var_versions[name] <= version:
+                break
+            changed[name] = self.var[name]
+        return changed
+
+    def mark_change(self, var_name, old_values=None):
+        """Mark a variable whose elements have been changed in the cache, to
+        be sent by the next flush. old_values is a dict of the previous value
+        of changed elements by index; if it's None, the whole variable is
+        sent even if its value hasn't changed. Successive changes are
+        merged, keeping the value before the first change.
+        """
         self.var_to_send[var_name] = self.var[var_name]
+        if old_values is None:
+            self.var_changes[var_name] = None
+        elif var_name not in self.var_changes:
+            self.var_changes[var_name] = old_values
+        elif self.var_changes[var_name] is not None:
+            changes = self.var_changes[var_name]
+            for i in old_values:
+                if i not in changes:
+                    changes[i] = old_values[i]
+        self.thymio.schedule_flush(self)
+
+    def changed_variables(self):
+        """Return a dict of the variables marked as changed whose value is
+        actually different from the value before the first change.
+        """
+        changed = {}
+        for name, value in self.var_to_send.items():
+            changes = self.var_changes.get(name)
+            if changes is None or any(value[i] != changes[i] for i in changes):
+                changed[name] = value
+        return changed
+
+    def send_changes(self):
+        """Send the variables which have been changed in the cache (only those
+        whose value is different, since SetVariables messages contain whole
+        variables) with set_variables_nowait, and return them in a dict.
+        """
+        var_dict = self.changed_variables()
+        if len(var_dict) > 0:
+            # errors collected by the client
+            self.set_variables_nowait(var_dict)
+        self.var_to_send = {}
+        self.var_changes = {}
+        return var_dict
 
     def flush(self):
-        # send new variable values
-        self.send_set_variables(self.var_to_send)
+        """Send the variables which have been changed in the cache and
+        process waiting messages.
+        """
+        var_dict = self.send_changes()
         # process waiting messages, possibly changing self.var
         self.thymio.process_waiting_messages()
         # overwrite variables just sent in case they've been replaced by older values
-        self.var = {**self.var, **self.var_to_send}
-        self.var_to_send = {}
+        self.var.update(var_dict)
 
     @types.coroutine
     def filter_out_vm_events(self, events):
@@ -169,3 +527,57 @@ class ClientAsyncCacheNode(ClientAsyncNode):
         events = yield from self.filter_out_vm_events(events)
         result = yield from super().register_events(events)
         return result
+
+    @types.coroutine
+    def deploy(self, program, events=None,
+               scratchpad=False, watch=False, run=True,
+               timings=None):
+        """Register events, compile and load an Aseba program, and optionally
+        send it to the scratchpad, watch events and vm state, and run it.
+        Events predefined in the vm must have been removed with
+        filter_out_vm_events. Return None for success, or the error of the
+        first stage which has failed with its name as "stage". If timings is
+        a dict, store the duration of each stage in seconds.
+        """
+
+        t = monotonic()
+
+        def end_stage(stage, error):
+            nonlocal t
+            t1 = monotonic()
+            if timings is not None:
+                timings[stage] = t1 - t
+            t = t1
+            return None if error is None else {**error, "stage": stage}
+
+        if events:
+            # already filtered
+            error = end_stage("register_events",
+                              (yield from super().register_events(events)))
+            if error is not None:
+                return error
+        error = end_stage("compile", (yield from self.compile(program)))
+        if error is not None:
+            return error
+        if scratchpad:
+            # don't wait for the reply, the scratchpad is for information only
+            self.send_set_scratchpad(program)
+        if watch:
+            error = end_stage("watch",
+                              (yield from self.watch(events=True, vm_state=True)))
+            if error is not None:
+                return error
+        if run:
+            error = end_stage("run", (yield from self.run()))
+            if error is not None:
+                return error
+        return None
+
+    @staticmethod
+    def format_timings(timings):
+        """Format stage durations stored by deploy.
+        """
+        return ", ".join(
+            f"{stage} {1000 * timings[stage]:.1f} ms"
+            for stage in timings
+        ) + f" (total {1000 * sum(timings.values()):.1f} ms)"
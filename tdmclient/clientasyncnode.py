@@ -99,6 +99,26 @@ class ClientAsyncNode(ClientNode):
         )
         return result
 
+    def send_events_nowait(self, event_dict):
+        """Send events without waiting for the reply and return a
+        RequestHandle (see ClientAsync.send_nowait).
+        """
+        return self.thymio.send_nowait(
+            lambda notify:
+                self.send_send_events(event_dict, request_id_notify=notify),
+            node=self
+        )
+
+    def set_variables_nowait(self, var_dict):
+        """Set variables without waiting for the reply and return a
+        RequestHandle (see ClientAsync.send_nowait).
+        """
+        return self.thymio.send_nowait(
+            lambda notify:
+                self.send_set_variables(var_dict, request_id_notify=notify),
+            node=self
+        )
+
     @types.coroutine
     def compile(self, program, load=True):
         result = yield from self.thymio.send_msg_and_get_result(
@@ -139,19 +159,39 @@ class ClientAsyncNode(ClientNode):
         )
         return result
 
-    @types.coroutine
-    def watch(self, flags=0, variables=False, events=False, vm_state=False):
+    def add_watch_flags(self, flags=0, variables=False, events=False, vm_state=False):
+        """Add flags to watch_flags, and return True if they've changed and
+        must be sent with a WatchNode message.
+        """
         flags |= ((ThymioFB.WATCHABLE_INFO_VARIABLES if variables else 0) |
                   (ThymioFB.WATCHABLE_INFO_EVENTS if events else 0) |
                   (ThymioFB.WATCHABLE_INFO_VM_EXECUTION_STATE if vm_state else 0))
         if (self.watch_flags | flags) != self.watch_flags:
             self.watch_flags |= flags
+            return True
+        return False
+
+    @types.coroutine
+    def watch(self, flags=0, variables=False, events=False, vm_state=False):
+        if self.add_watch_flags(flags, variables, events, vm_state):
             result = yield from self.thymio.send_msg_and_get_result(
                 lambda notify:
                     self.watch_node(self.watch_flags, request_id_notify=notify)
             )
             return result
 
+    def watch_nowait(self, flags=0, variables=False, events=False, vm_state=False):
+        """Same as watch, without waiting for the reply. Return a
+        RequestHandle, or None if the watch flags haven't changed.
+        """
+        if self.add_watch_flags(flags, variables, events, vm_state):
+            return self.thymio.send_nowait(
+                lambda notify:
+                    self.watch_node(self.watch_flags, request_id_notify=notify),
+                node=self
+            )
+        return None
+
     @types.coroutine
     def unwatch(self, flags=0, variables=False, events=False):
         flags |= ((ThymioFB.WATCHABLE_INFO_VARIABLES if variables else 0) |
@@ -53,7 +53,7 @@ class ClientNode(Node):
     def watch_node(self, flags, **kwargs):
         if self.thymio.debug >= 1:
             print(f"send watch node flags={flags} to {self.id_str}")
-        self.thymio.send_packet(self.create_msg_watch_node(flags, **kwargs))
+        self.thymio.send_packet(self.create_msg_watch_node(flags, reuse_buffer=True, **kwargs))
 
     def send_register_events(self, events, **kwargs):
         if self.thymio.debug >= 1:
@@ -63,9 +63,9 @@ class ClientNode(Node):
     def send_send_events(self, event_dict, **kwargs):
         if self.thymio.debug >= 1:
             print(f"send events to {self.id_str} {', '.join([f'{name}={event_dict[name]}' for name in event_dict])}")
-        self.thymio.send_packet(self.create_msg_send_events(event_dict, **kwargs))
+        self.thymio.send_packet(self.create_msg_send_events(event_dict, reuse_buffer=True, **kwargs))
 
     def send_set_variables(self, var_dict, **kwargs):
         if self.thymio.debug >= 1:
             print(f"send set variables for {self.id_str} {', '.join([f'{name}={var_dict[name]}' for name in var_dict])}")
-        self.thymio.send_packet(self.create_msg_set_variables(var_dict, **kwargs))
+        self.thymio.send_packet(self.create_msg_set_variables(var_dict, reuse_buffer=True, **kwargs))
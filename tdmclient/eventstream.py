@@ -0,0 +1,116 @@
+# This file is part of tdmclient.
+# Copyright 2021-2026 ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE,
+# Miniature Mobile Robots group, Switzerland
+# Author: Yves Piguet
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Iteration over events received by a client
+"""
+
+import types
+from collections import deque
+
+
+class EventStream:
+    """Events received by a ClientAsync or ClientAio, as tuples (node,
+    event_name, event_data) obtained by iteration ("for" with ClientAsync,
+    "async for" with both). Events are kept in a buffer of max_size
+    events; when it's full, new events are processed according to overflow:
+        EventStream.DROP_OLDEST - the oldest event is discarded
+        EventStream.DROP_NEWEST - the new event is discarded
+        EventStream.BLOCK - the client stops processing incoming messages
+        until events have been consumed
+    Should be closed with close() or used in a "with" construct.
+    """
+
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    BLOCK = "block"
+
+    def __init__(self, client, names=None, node=None,
+                 max_size=1000, overflow=DROP_OLDEST):
+        """New stream of the events whose name is in names (default: all)
+        and which are emitted by node (default: all nodes).
+        """
+        if overflow not in (EventStream.DROP_OLDEST, EventStream.DROP_NEWEST,
+                            EventStream.BLOCK):
+            raise Exception(f"Unknown overflow policy {overflow}")
+        self.client = client
+        self.max_size = max_size
+        self.overflow = overflow
+        self.buffer = deque()
+        self.received_count = 0
+        self.dropped_count = 0
+        self.closed = False
+        self.paused = False
+        # same bound method for add_ and remove_event_received_listener
+        self.listener = self.on_event_received
+        client.add_event_received_listener(self.listener, names=names, node=node)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def on_event_received(self, node, event_name, event_data):
+        self.received_count += 1
+        if len(self.buffer) >= self.max_size:
+            if self.overflow == EventStream.DROP_NEWEST:
+                self.dropped_count += 1
+                return
+            elif self.overflow == EventStream.DROP_OLDEST:
+                self.buffer.popleft()
+                self.dropped_count += 1
+        self.buffer.append((node, event_name, event_data))
+        if (self.overflow == EventStream.BLOCK and not self.paused
+                and len(self.buffer) >= self.max_size):
+            self.paused = True
+            self.client.pause_receiving(self)
+
+    def pop(self):
+        """Remove and return the oldest event (the buffer must not be empty).
+        """
+        event = self.buffer.popleft()
+        if self.paused and len(self.buffer) < self.max_size:
+            self.paused = False
+            self.client.resume_receiving(self)
+        return event
+
+    def close(self):
+        """Stop receiving events. Events already received can still be
+        obtained by iteration.
+        """
+        if not self.closed:
+            self.closed = True
+            self.client.remove_event_received_listener(self.listener)
+            if self.paused:
+                self.paused = False
+                self.client.resume_receiving(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self.buffer) == 0:
+            if self.closed:
+                raise StopIteration
+            if not self.client.process_waiting_messages():
+                self.client.wait_for_packet(self.client.DEFAULT_SLEEP)
+        return self.pop()
+
+    def __aiter__(self):
+        return self
+
+    @types.coroutine
+    def __anext__(self):
+        while len(self.buffer) == 0:
+            if self.closed:
+                raise StopAsyncIteration
+            yield from self.client.wait_for_messages()
+        return self.pop()
@@ -10,6 +10,9 @@ Flatbuffer support for communication with TDM.
 """
 
 import re
+import struct
+import array
+import sys
 
 class Table:
 
@@ -43,10 +46,10 @@ class Table:
         return table
 
     def encode(self):
-        data = b""
-        values = b""
-        vtable = b""
-        offsets = set()
+        data = bytearray()
+        values = bytearray()
+        vtable = bytearray()
+        offsets = []
 
         # encode all fields
         for i, field in enumerate(self.fields):
@@ -62,36 +65,37 @@ class Table:
                     if is_inline:
                         data += encoded_field
                     else:
-                        offsets.add((len(data), len(values)))
+                        offsets.append((len(data), len(values)))
                         data += b"1234" # offset placeholder
                         values += encoded_field
 
-        # prepend vtable header
-        vtable = (FlatBuffer.encode_16(len(vtable) + 4)
-                  + FlatBuffer.encode_16(4 + len(data))
-                  + vtable)
+        # vtable header
+        vtable_header = (FlatBuffer.encode_16(len(vtable) + 4)
+                         + FlatBuffer.encode_16(4 + len(data)))
 
         # append padding to vtable to align on 32-bit words
         if len(vtable) % 4 == 2:
             vtable += bytes([0, 0])
 
-        # resolve offsets
+        # resolve offsets in place
         for offset_pos, offset_val in offsets:
             # adjust offset to be from here to encoded field
             offset_val += len(data) - offset_pos
             if offset_val % 4 == 2:
                 raise Exception("internal (misaligned)")
-            # insert it in table
-            data = (data[:offset_pos]
-                    + FlatBuffer.encode_32(offset_val)
-                    + data[offset_pos+4:])
+            FlatBuffer.STRUCT_U32.pack_into(data, offset_pos, offset_val)
 
-        # prepend vtable negated offset to table
+        # vtable negated offset to table, then data, values and vtable
         # (vtable follows field values)
         vtable_pos_offset = 4 + len(data) + len(values)
-        data = FlatBuffer.encode_32(-vtable_pos_offset) + data
+        enc = bytearray(vtable_pos_offset + 4 + len(vtable))
+        FlatBuffer.STRUCT_I32.pack_into(enc, 0, -vtable_pos_offset)
+        enc[4 : 4 + len(data)] = data
+        enc[4 + len(data) : vtable_pos_offset] = values
+        enc[vtable_pos_offset : vtable_pos_offset + 4] = vtable_header
+        enc[vtable_pos_offset + 4 :] = vtable
 
-        return self, data + values + vtable, False
+        return self, bytes(enc), False
 
 class Union(Table):
 
@@ -125,8 +129,476 @@ class Union(Table):
         return union
 
 
+class SchemaItem:
+    """Schema element compiled once from a schema string (see
+    FlatBuffer.parse for the syntax), with its decoder.
+    """
+
+    def __init__(self, kind, items=None, array_type=None):
+        self.kind = kind
+        # S, T, U: fields or union types; *: vector element
+        self.items = items if items is not None else []
+        # type of decoded vectors of integers: None for list, "array" for
+        # array.array, or "numpy" for numpy arrays
+        self.array_type = array_type
+        self.is_inline = kind in "i2ubld"
+        self.data_size = (4 if kind in "i*TUsx"
+                          else 2 if kind == "2"
+                          else 8 if kind in "ld"
+                          else 1)
+        # decode(encoded_fb, pos) -> value
+        self.decode = self.make_decoder()
+        # view(encoded_fb, pos) -> value, with TableView and UnionView
+        # for tables and unions
+        self.view = self.make_viewer()
+        # encode_into(out, value): append encoded value to bytearray out
+        self.encode_into = self.make_encoder()
+
+    def __repr__(self):
+        if self.kind in "STU":
+            return f"{self.kind}({''.join(repr(item) for item in self.items)})"
+        elif self.kind == "*":
+            return f"*{self.items[0]!r}"
+        else:
+            return self.kind
+
+    @staticmethod
+    def compile(schema, array_type=None):
+        """Compile a schema string (blanks and c++ comments are ignored).
+        Vectors of integers are decoded to lists by default, to array.array
+        if array_type is "array", or to numpy arrays if array_type is "numpy".
+        """
+        schema = FlatBuffer.normalize_schema(schema)
+        item, length = SchemaItem.compile_at(schema, 0, array_type)
+        if length != len(schema):
+            raise Exception("schema syntax error")
+        return item
+
+    @staticmethod
+    def compile_at(schema, index, array_type=None):
+        """Compile the normalized schema element at specified index and
+        return (item, length).
+        """
+        kind = schema[index]
+        if kind in "ibusl2dx.":
+            return SchemaItem(kind, array_type=array_type), 1
+        if kind in "STU":
+            if schema[index + 1] != "(":
+                raise Exception("schema syntax error")
+            items = []
+            i = index + 2
+            while schema[i] != ")":
+                item, length = SchemaItem.compile_at(schema, i, array_type)
+                items.append(item)
+                i += length
+            return SchemaItem(kind, items, array_type), i + 1 - index
+        if kind == "*":
+            item, length = SchemaItem.compile_at(schema, index + 1, array_type)
+            return SchemaItem(kind, [item], array_type), 1 + length
+        raise Exception(f"unexpected schema {kind}")
+
+    # array typecodes for vectors of scalars, by schema element
+    ARRAY_TYPECODES = {"2": "h", "i": "i", "l": "q"}
+    NUMPY_DTYPES = {"2": "i2", "i": "i4", "l": "i8"}
+
+    def make_decoder(self):
+        """Make a function decode(encoded_fb, pos) specific to this element,
+        equivalent to FlatBuffer.parse_value, and for elements referenced by
+        an offset, a function decode_target(encoded_fb, target_pos).
+        Vectors of integers are decoded in bulk (to a list, an array.array or
+        a numpy array depending on array_type), and offsets in vectors of
+        strings, tables and unions are decoded in one call.
+        """
+
+        decode_u16 = FlatBuffer.decode_u16
+        decode_u32 = FlatBuffer.decode_u32
+        decode_i32 = FlatBuffer.decode_i32
+        unpack_from = struct.unpack_from
+        kind = self.kind
+
+        if kind == "i":
+            return decode_i32
+        elif kind == "l":
+            return FlatBuffer.decode_i64
+        elif kind == "2":
+            return FlatBuffer.decode_i16
+        elif kind == "u":
+            return lambda b, pos: b[pos : pos + 1]
+        elif kind == "b":
+            return lambda b, pos: b[pos] != 0
+        elif kind == "s":
+            def decode_target(b, str_pos):
+                str_len = decode_u32(b, str_pos)
+                return str(b[str_pos + 4 : str_pos + 4 + str_len], "utf-8", "replace")
+            self.decode_target = decode_target
+            return lambda b, pos: decode_target(b, pos + decode_i32(b, pos))
+        elif kind == "*":
+            el = self.items[0]
+            if el.kind == "u":
+                # special case for bytes: decode as byte array
+                def decode(b, pos):
+                    vec_pos = pos + decode_i32(b, pos)
+                    vec_len = decode_u32(b, vec_pos)
+                    return b[vec_pos + 4 : vec_pos + 4 + vec_len]
+            elif el.kind in SchemaItem.ARRAY_TYPECODES and self.array_type == "numpy":
+                dtype = SchemaItem.NUMPY_DTYPES[el.kind]
+                def decode(b, pos):
+                    import numpy
+                    vec_pos = pos + decode_i32(b, pos)
+                    vec_len = decode_u32(b, vec_pos)
+                    return numpy.frombuffer(b, dtype="<" + dtype, count=vec_len,
+                                            offset=vec_pos + 4).astype(dtype)
+            elif el.kind in SchemaItem.ARRAY_TYPECODES:
+                typecode = SchemaItem.ARRAY_TYPECODES[el.kind]
+                to_list = self.array_type is None
+                def decode(b, pos):
+                    vec_pos = pos + decode_i32(b, pos)
+                    vec_len = decode_u32(b, vec_pos)
+                    a = array.array(typecode)
+                    a.frombytes(b[vec_pos + 4 : vec_pos + 4 + vec_len * a.itemsize])
+                    if sys.byteorder == "big":
+                        a.byteswap()
+                    return a.tolist() if to_list else a
+            elif el.kind in "sTU":
+                el_decode_target = el.decode_target
+                def decode(b, pos):
+                    vec_pos = pos + decode_i32(b, pos)
+                    vec_len = decode_u32(b, vec_pos)
+                    offsets = unpack_from(f"<{vec_len}I", b, vec_pos + 4)
+                    return [
+                        el_decode_target(b, p + offset)
+                        for p, offset in zip(range(vec_pos + 4, vec_pos + 4 + 4 * vec_len, 4),
+                                             offsets)
+                    ]
+            else:
+                el_decode = el.decode
+                el_size = el.data_size
+                def decode(b, pos):
+                    vec_pos = pos + decode_i32(b, pos)
+                    vec_len = decode_u32(b, vec_pos)
+                    return [
+                        el_decode(b, p)
+                        for p in range(vec_pos + 4,
+                                       vec_pos + 4 + vec_len * el_size,
+                                       el_size)
+                    ]
+            return decode
+        elif kind == "T":
+            fields = [(item.decode, item.is_inline) for item in self.items]
+            num_fields = len(fields)
+            def decode_target(b, table_pos):
+                vtable_pos = table_pos - decode_i32(b, table_pos)
+                n = min(decode_u16(b, vtable_pos) // 2 - 2, num_fields)
+                # missing value: None (stands for default value)
+                values = [None] * num_fields
+                for i, offset in enumerate(unpack_from(f"<{n}H", b, vtable_pos + 4)):
+                    if offset:
+                        field_decode, is_inline = fields[i]
+                        values[i] = (field_decode(b, table_pos + offset), None, is_inline)
+                return Table(fields=values)
+            self.decode_target = decode_target
+            return lambda b, pos: decode_target(b, pos + decode_u32(b, pos))
+        elif kind == "U":
+            members = [(item.decode, item.is_inline) for item in self.items]
+            def decode_target(b, table_pos):
+                vtable_pos = table_pos - decode_i32(b, table_pos)
+                n = decode_u16(b, vtable_pos) // 2 - 2
+                offset_type = decode_u16(b, vtable_pos + 4) if n > 0 else 0
+                union_type = b[table_pos + offset_type] if offset_type else 0
+                union_data = None
+                if union_type > len(members):
+                    raise Exception(f"_type={union_type} too large for schema")
+                if union_type > 0 and n > 1:
+                    offset = decode_u16(b, vtable_pos + 6)
+                    if offset:
+                        member_decode, is_inline = members[union_type - 1]
+                        union_data = (member_decode(b, table_pos + offset), None, is_inline)
+                return Union(union_type, union_data)
+            self.decode_target = decode_target
+            return lambda b, pos: decode_target(b, pos + decode_u32(b, pos))
+        elif kind == "x":
+            def decode(b, pos):
+                vec_pos = pos + decode_i32(b, pos)
+                vec_len = decode_u32(b, vec_pos)
+                return FlexBuffer.parse(b[vec_pos + 4 : vec_pos + 4 + vec_len])
+            return decode
+        elif kind == ".":
+            # don't parse
+            return lambda b, pos: None
+        else:
+            def decode(b, pos):
+                raise Exception(f"unknown schema char {kind}")
+            return decode
+
+    def make_viewer(self):
+        """Make a function view(encoded_fb, pos) specific to this element,
+        which decodes scalars, strings and vectors like decode but returns
+        TableView or UnionView objects for tables and unions.
+        """
+
+        decode_u32 = FlatBuffer.decode_u32
+        decode_i32 = FlatBuffer.decode_i32
+        kind = self.kind
+
+        if kind == "*" and self.items[0].kind in "TU":
+            el_view_target = self.items[0].view_target
+            def view(b, pos):
+                vec_pos = pos + decode_i32(b, pos)
+                vec_len = decode_u32(b, vec_pos)
+                offsets = struct.unpack_from(f"<{vec_len}I", b, vec_pos + 4)
+                return [
+                    el_view_target(b, p + offset)
+                    for p, offset in zip(range(vec_pos + 4, vec_pos + 4 + 4 * vec_len, 4),
+                                         offsets)
+                ]
+            return view
+        elif kind == "T":
+            self.view_target = lambda b, table_pos: TableView(b, table_pos, self)
+            return lambda b, pos: TableView(b, pos + decode_u32(b, pos), self)
+        elif kind == "U":
+            self.view_target = lambda b, table_pos: UnionView(b, table_pos, self)
+            return lambda b, pos: UnionView(b, pos + decode_u32(b, pos), self)
+        else:
+            return self.decode
+
+    # struct formats of packed vectors of scalars
+    VECTOR_FORMATS = {"2": "H", "i": "I", "l": "Q", "b": "B"}
+
+    def make_encoder(self):
+        """Make a function encode_into(out, value) specific to this element,
+        which appends the encoded value to bytearray out: inline value padded
+        to 32 bits for scalars, or data referenced by an offset otherwise.
+        All nested data are written in a single pass in the same bytearray
+        with offsets patched in place; the result is the same as
+        FlatBuffer.convert_with_schema.
+        """
+
+        kind = self.kind
+        pack_u32 = FlatBuffer.STRUCT_U32.pack
+        pack_into_u32 = FlatBuffer.STRUCT_U32.pack_into
+
+        def encode_table(out, items, values):
+            """Encode table fields described by items with their values.
+            """
+            start = len(out)
+            out += b"\0\0\0\0"  # offset to vtable, set below
+            vtable = []
+            deferred = []  # (offset_pos, item, value)
+            for item, value in zip(items, values):
+                if value is None:
+                    # no value (default)
+                    vtable.append(0)
+                else:
+                    vtable.append(len(out) - start)
+                    if item.is_inline:
+                        item.encode_into(out, value)
+                    else:
+                        deferred.append((len(out), item, value))
+                        out += b"\0\0\0\0"  # offset placeholder
+            data_len = len(out) - start
+            # values referenced by offsets, following table data
+            for offset_pos, item, value in deferred:
+                pack_into_u32(out, offset_pos, len(out) - offset_pos)
+                item.encode_into(out, value)
+            # vtable, aligned on 32-bit words
+            vtable_pos = len(out)
+            out += struct.pack(f"<{len(vtable) + 2}H", 4 + 2 * len(vtable), data_len, *vtable)
+            if len(vtable) % 2 == 1:
+                out += b"\0\0"
+            FlatBuffer.STRUCT_I32.pack_into(out, start, start - vtable_pos)
+
+        def pad(out, start):
+            # append 0 to 3 nul bytes
+            out += bytes((start - len(out)) % 4)
+
+        if kind == "i":
+            return lambda out, value: out.extend(pack_u32(value & 0xffffffff))
+        elif kind == "l":
+            return lambda out, value: out.extend(FlatBuffer.STRUCT_U64.pack(value & 0xffffffffffffffff))
+        elif kind == "2":
+            return lambda out, value: out.extend(FlatBuffer.STRUCT_U32.pack(value & 0xffff))
+        elif kind == "u":
+            return lambda out, value: out.extend(pack_u32(value & 0xff))
+        elif kind == "b":
+            return lambda out, value: out.extend(pack_u32(1 if value else 0))
+        elif kind == "s":
+            def encode(out, value):
+                str_utf8 = bytes(value, "utf-8")
+                out += pack_u32(len(str_utf8))
+                out += str_utf8
+                # append 1 to 4 nul bytes
+                out += bytes(4 - len(str_utf8) % 4)
+            return encode
+        elif kind == "*":
+            el = self.items[0]
+            if el.kind == "u":
+                def encode(out, value):
+                    start = len(out)
+                    out += pack_u32(len(value))
+                    out.extend(value)
+                    pad(out, start)
+            elif el.kind in SchemaItem.VECTOR_FORMATS:
+                format = SchemaItem.VECTOR_FORMATS[el.kind]
+                mask = (1 << 8 * struct.calcsize(format)) - 1
+                def encode(out, value):
+                    start = len(out)
+                    out += struct.pack(f"<I{len(value)}{format}",
+                                       len(value),
+                                       *(v & mask for v in value))
+                    pad(out, start)
+            else:
+                el_encode_into = el.encode_into
+                def encode(out, value):
+                    start = len(out)
+                    out += pack_u32(len(value))
+                    offset_pos = len(out)
+                    out += bytes(4 * len(value))  # offset placeholders
+                    for el_value in value:
+                        pack_into_u32(out, offset_pos, len(out) - offset_pos)
+                        el_encode_into(out, el_value)
+                        offset_pos += 4
+                    pad(out, start)
+            return encode
+        elif kind == "T":
+            items = self.items
+            def encode(out, value):
+                if type(value) is Table:
+                    # already a table
+                    out += value.encode()[1]
+                else:
+                    encode_table(out, items, value)
+            return encode
+        elif kind == "U":
+            members = self.items
+            type_item = SchemaItem("u")
+            def encode(out, value):
+                if type(value) is Union:
+                    # already a union
+                    out += value.encode()[1]
+                else:
+                    union_type, union_value = value
+                    encode_table(out,
+                                 (type_item, members[union_type - 1]),
+                                 (union_type, union_value))
+            return encode
+        elif kind == "x":
+            def encode(out, value):
+                start = len(out)
+                # list of int, or already encoded FlexBuffer
+                enc = (value if isinstance(value, (bytes, bytearray))
+                       else FlexBuffer.encode_vec_int(value))
+                out += pack_u32(len(enc))
+                out += enc
+                pad(out, start)
+            return encode
+        else:
+            def encode(out, value):
+                raise Exception(f"cannot encode schema char {kind}")
+            return encode
+
+
+class TableView:
+    """Read-only view of a table in an encoded flatbuffer (preferably a
+    memoryview), whose fields are decoded only when they're accessed.
+    """
+
+    __slots__ = ("buf", "table_pos", "vtable_pos", "num_entries", "schema")
+
+    def __init__(self, buf, table_pos, schema):
+        self.buf = buf
+        self.table_pos = table_pos
+        self.vtable_pos = table_pos - FlatBuffer.decode_i32(buf, table_pos)
+        self.num_entries = FlatBuffer.decode_u16(buf, self.vtable_pos) // 2 - 2
+        self.schema = schema
+
+    def __repr__(self):
+        return f"TableView({[self.field(i) for i in range(len(self.schema.items))]})"
+
+    def field_pos(self, i):
+        """Position of field i in the buffer, or None if it's missing.
+        """
+        if i >= self.num_entries:
+            return None
+        offset = FlatBuffer.decode_u16(self.buf, self.vtable_pos + 4 + 2 * i)
+        return self.table_pos + offset if offset else None
+
+    def field(self, i, default=None):
+        """Decode field i, or return default if it's missing.
+        """
+        pos = self.field_pos(i)
+        return default if pos is None else self.schema.items[i].view(self.buf, pos)
+
+    @property
+    def fields(self):
+        """Fields as a sequence of (value, None, is_inline) or None,
+        like Table.fields.
+        """
+        return TableViewFields(self)
+
+
+class TableViewFields:
+    """Sequence of lazily-decoded fields of a TableView.
+    """
+
+    __slots__ = ("table_view",)
+
+    def __init__(self, table_view):
+        self.table_view = table_view
+
+    def __len__(self):
+        return len(self.table_view.schema.items)
+
+    def __getitem__(self, i):
+        table_view = self.table_view
+        item = table_view.schema.items[i]
+        pos = table_view.field_pos(i)
+        return None if pos is None else (item.view(table_view.buf, pos), None, item.is_inline)
+
+
+class UnionView:
+    """Read-only view of a union in an encoded flatbuffer, whose content is
+    decoded only when union_data is accessed.
+    """
+
+    __slots__ = ("table_view", "union_type")
+
+    def __init__(self, buf, table_pos, schema):
+        self.table_view = TableView(buf, table_pos, schema)
+        pos_type = self.table_view.field_pos(0)
+        self.union_type = buf[pos_type] if pos_type is not None else 0
+        if self.union_type > len(schema.items):
+            raise Exception(f"_type={self.union_type} too large for schema")
+
+    def __repr__(self):
+        return f"UnionView(type={self.union_type},data={self.union_data})"
+
+    @property
+    def union_data(self):
+        """Union content as (value, None, is_inline), or None.
+        """
+        if self.union_type == 0:
+            return None
+        table_view = self.table_view
+        pos = table_view.field_pos(1)
+        if pos is None:
+            return None
+        item = table_view.schema.items[self.union_type - 1]
+        return item.view(table_view.buf, pos), None, item.is_inline
+
+
 class FlatBuffer:
 
+    # compiled schemas, by schema string
+    compiled_schemas = {}
+
+    # little-endian numbers
+    STRUCT_U16 = struct.Struct("<H")
+    STRUCT_I16 = struct.Struct("<h")
+    STRUCT_U32 = struct.Struct("<I")
+    STRUCT_I32 = struct.Struct("<i")
+    STRUCT_U64 = struct.Struct("<Q")
+    STRUCT_I64 = struct.Struct("<q")
+
     def __init__(self):
         self.root = Table()
 
@@ -140,6 +612,18 @@ class FlatBuffer:
         encoded_root_table = self.root[1]
         return FlatBuffer.encode_32(4) + encoded_root_table
 
+    @staticmethod
+    def peek_union_type(encoded_fb):
+        """Get the type of the root union of an encoded flatbuffer without
+        decoding anything else.
+        """
+        table_pos = FlatBuffer.decode_u32(encoded_fb, 0)
+        vtable_pos = table_pos - FlatBuffer.decode_i32(encoded_fb, table_pos)
+        if FlatBuffer.decode_u16(encoded_fb, vtable_pos) < 6:
+            return 0
+        offset_type = FlatBuffer.decode_u16(encoded_fb, vtable_pos + 4)
+        return encoded_fb[table_pos + offset_type] if offset_type else 0
+
     @staticmethod
     def field_val(f, default):
         return f[0] if f is not None else default
@@ -152,18 +636,45 @@ class FlatBuffer:
                   .replace(" ", "")
                   .replace("\t", ""))
 
-    def parse(self, encoded_fb, schema):
+    def parse(self, encoded_fb, schema, lazy=False, array_type=None):
         """Decode an encoded flatbuffer and populate self.
         Parameter schema is a string which describes what's expected:
         i=int32, u=uint8, b=bool, 2=short, s=string, *...=vector, S(...)=struct, T(...)=table, U(...)=union
         blanks and c++ comments are ignored
+        Schema strings are compiled on first use; schema can also be a
+        SchemaItem obtained with FlatBuffer.compile_schema.
+        With lazy=True, root is a TableView or UnionView over a memoryview
+        of encoded_fb: fields are decoded when they're accessed and byte
+        vectors are memoryview slices instead of copies.
+        Vectors of integers are decoded to lists by default, to array.array
+        if array_type is "array", or to numpy arrays if array_type is "numpy"
+        (for a SchemaItem, array_type of FlatBuffer.compile_schema).
         """
 
-        schema = FlatBuffer.normalize_schema(schema)
+        if not isinstance(schema, SchemaItem):
+            schema = FlatBuffer.compile_schema(schema, array_type)
 
-        if schema[0] not in "TU":
+        if schema.kind not in "TU":
             raise Exception("unexpected schema")
-        self.root = FlatBuffer.parse_value(encoded_fb, 0, schema)
+        if lazy:
+            if not isinstance(encoded_fb, memoryview):
+                encoded_fb = memoryview(encoded_fb)
+            self.root = schema.view(encoded_fb, 0)
+        else:
+            self.root = schema.decode(encoded_fb, 0)
+
+    @staticmethod
+    def compile_schema(schema, array_type=None):
+        """Compile a schema string to a SchemaItem, or get it from the cache
+        if it has already been compiled (see SchemaItem.compile).
+        """
+        key = (schema, array_type)
+        try:
+            return FlatBuffer.compiled_schemas[key]
+        except KeyError:
+            compiled_schema = SchemaItem.compile(schema, array_type)
+            FlatBuffer.compiled_schemas[key] = compiled_schema
+            return compiled_schema
 
     @staticmethod
     def schema_item_length(schema, index=0):
@@ -348,14 +859,11 @@ class FlatBuffer:
             if value is None:
                 # default value
                 return value, None, False
-            enc = FlatBuffer.encode_32(len(value))
+            enc = bytearray(FlatBuffer.encode_32(len(value)))
             if schema[1] == "u":
-                if type(value) is bytes:
-                    enc += value
-                else:
-                    enc += bytes(value)
+                enc.extend(value)
             else:
-                vector_data = b""
+                vector_data = bytearray()
                 for i, el in enumerate(value):
                     _, el_enc, el_inline = FlatBuffer.convert_with_schema(el, schema[1:])
                     if el_inline:
@@ -366,8 +874,8 @@ class FlatBuffer:
                         vector_data += el_enc
                 enc += vector_data
             # append 0 to 3 nul bytes
-            enc += bytes([0 for i in range((4 - len(enc)) % 4)])
-            return value, enc, False
+            enc += bytes((4 - len(enc)) % 4)
+            return value, bytes(enc), False
         elif schema[0] == "T":
             if value is None:
                 return value, None, False
@@ -377,7 +885,8 @@ class FlatBuffer:
             union = Union.create_with_schema(value, schema)
             return union.encode()
         elif schema[0] == "x":
-            enc = FlexBuffer.encode_vec_untyped_int16(value)
+            enc = (value if isinstance(value, (bytes, bytearray))
+                   else FlexBuffer.encode_vec_int(value))
             # prepend size
             enc = FlatBuffer.encode_32(len(enc)) + enc
             # append 0 to 3 nul bytes
@@ -387,57 +896,64 @@ class FlatBuffer:
             raise Exception("unknown schema char {schema[0]}")
 
     def load_with_schema(self, value, schema):
-        schema = FlatBuffer.normalize_schema(schema)
-        self.root = FlatBuffer.convert_with_schema(value, schema)
+        if not isinstance(schema, SchemaItem):
+            schema = FlatBuffer.compile_schema(schema)
+        out = bytearray()
+        schema.encode_into(out, value)
+        self.root = value, out, False
+
+    @staticmethod
+    def encode_with_schema(value, schema):
+        """Encode a value as a complete flatbuffer with a schema (string or
+        SchemaItem), in a single bytearray.
+        """
+        if not isinstance(schema, SchemaItem):
+            schema = FlatBuffer.compile_schema(schema)
+        out = bytearray(FlatBuffer.encode_32(4))
+        schema.encode_into(out, value)
+        return bytes(out)
 
     @staticmethod
     def decode_u16(b, pos):
-        return b[pos] | (b[pos + 1] << 8)
+        return FlatBuffer.STRUCT_U16.unpack_from(b, pos)[0]
 
     @staticmethod
     def decode_i16(b, pos):
-        u16 = FlatBuffer.decode_u16(b, pos)
-        return u16 - 0x10000 if u16 & 0x8000 else u16
+        return FlatBuffer.STRUCT_I16.unpack_from(b, pos)[0]
 
     @staticmethod
     def decode_u32(b, pos):
-        return (b[pos] | (b[pos + 1] << 8)
-                | (b[pos + 2] << 16) | (b[pos + 3] << 24))
+        return FlatBuffer.STRUCT_U32.unpack_from(b, pos)[0]
 
     @staticmethod
     def decode_i32(b, pos):
-        u32 = FlatBuffer.decode_u32(b, pos)
-        return u32 - 0x100000000 if u32 & 0x80000000 else u32
+        return FlatBuffer.STRUCT_I32.unpack_from(b, pos)[0]
 
     @staticmethod
     def decode_u64(b, pos):
-        return (b[pos] | (b[pos + 1] << 8)
-                | (b[pos + 2] << 16) | (b[pos + 3] << 24)
-                | (b[pos + 4] << 32) | (b[pos + 5] << 40)
-                | (b[pos + 6] << 48) | (b[pos + 7] << 56))
+        return FlatBuffer.STRUCT_U64.unpack_from(b, pos)[0]
 
     @staticmethod
     def decode_i64(b, pos):
-        u64 = FlatBuffer.decode_u64(b, pos)
-        return u64 - 0x10000000000000000 if u64 & 0x8000000000000000 else u64
+        return FlatBuffer.STRUCT_I64.unpack_from(b, pos)[0]
 
     @staticmethod
     def encode_16(w16):
         """Encode a 16-bit word.
         """
-        return bytes([w16 & 0xff, w16 >> 8 & 0xff])
+        return FlatBuffer.STRUCT_U16.pack(w16 & 0xffff)
 
     @staticmethod
     def encode_32(w32):
         """Encode a 32-bit word.
         """
-        return bytes([w32 >> 8 * i & 0xff for i in range(4)])
+        return FlatBuffer.STRUCT_U32.pack(w32 & 0xffffffff)
 
     @staticmethod
     def encode_64(w64):
         """Encode a 64-bit word.
         """
-        return bytes([w64 >> 8 * i & 0xff for i in range(8)])
+        return FlatBuffer.STRUCT_U64.pack(w64 & 0xffffffffffffffff)
 
     @staticmethod
     def encode_value(value):
@@ -469,6 +985,8 @@ class FlatBuffer:
                 print("int", value)
             elif type(value) == bytes:
                 print("byte", value[0])
+            elif type(value) == memoryview:
+                print(f"bytes {bytes(value).hex()}")
             elif type(value) == bool:
                 print("bool", value)
             elif type(value) == str:
@@ -486,10 +1004,19 @@ class FlatBuffer:
                     for field in value.fields:
                         dump_value("None" if field is None else field[1])
                     print("]")
+            elif type(value) is TableView:
+                print(f"table len={len(value.fields)} [")
+                for field in value.fields:
+                    dump_value(None if field is None else field[0])
+                print("]")
             elif type(value) is Union:
                 print(f"union type={value.union_type} [")
                 dump_value(value.union_data[1])
                 print("]")
+            elif type(value) is UnionView:
+                print(f"union type={value.union_type} [")
+                dump_value(value.union_data[0] if value.union_data is not None else None)
+                print("]")
             elif value is None:
                 print("none")
             else:
@@ -530,9 +1057,17 @@ class FlexBuffer:
     TYPE_VECTOR_STRING = 15
     TYPE_BLOB = 25
 
+    # array typecodes of integers by (byte size, signed)
+    ARRAY_TYPECODES = {
+        (1, True): "b", (2, True): "h", (4, True): "i", (8, True): "q",
+        (1, False): "B", (2, False): "H", (4, False): "I", (8, False): "Q",
+    }
+
     @staticmethod
-    def parse(buf):
-        """Convert flexbuffer.
+    def parse(buf, array_type=None):
+        """Convert flexbuffer. Vectors of integers are converted to lists
+        by default, to array.array if array_type is "array", or to numpy
+        arrays if array_type is "numpy".
         """
 
         def parse_int(el_byte_size, p, index, type):
@@ -559,16 +1094,39 @@ class FlexBuffer:
                     val -= 0x10000000000000000
             return val
 
+        def convert_array(el_byte_size, signed, p, num_el):
+            # decode all the elements at once
+            data = buf[p : p + num_el * el_byte_size]
+            if array_type == "numpy":
+                import numpy
+                dtype = f"{'i' if signed else 'u'}{el_byte_size}"
+                return numpy.frombuffer(data, dtype="<" + dtype).astype(dtype)
+            a = array.array(FlexBuffer.ARRAY_TYPECODES[(el_byte_size, signed)])
+            a.frombytes(data)
+            if sys.byteorder == "big":
+                a.byteswap()
+            return a if array_type == "array" else a.tolist()
+
         def parse_array(el_byte_size, p):
             num_el = parse_int(el_byte_size, p, -1, FlexBuffer.TYPE_UINT << 2)
             type_array_offset = p + num_el * el_byte_size
-            array = [
+            if num_el == 0:
+                return convert_array(el_byte_size, True, p, 0)
+            else:
+                # fast path for homogeneous vectors of integers
+                el_type = buf[type_array_offset]
+                if (el_type >> 2 in (FlexBuffer.TYPE_INT, FlexBuffer.TYPE_UINT)
+                        and buf[type_array_offset : type_array_offset + num_el]
+                            == bytes((el_type,)) * num_el):
+                    return convert_array(el_byte_size,
+                                         el_type >> 2 == FlexBuffer.TYPE_INT,
+                                         p, num_el)
+            return [
                 parse_int(el_byte_size, p, i, buf[type_array_offset + i])
                 for i in range(num_el)
             ]
-            return array
 
-        def parse_element(type, p):
+        def parse_element(type, p, width):
             flex_size = type & 3
             el_byte_size = 2 ** flex_size
             actual_type = type >> 2
@@ -577,7 +1135,17 @@ class FlexBuffer:
             elif actual_type in (FlexBuffer.TYPE_INT, FlexBuffer.TYPE_UINT):
                 return parse_int(el_byte_size, p, 0, actual_type << 2)
             elif actual_type == FlexBuffer.TYPE_VECTOR:
-                return parse_array(el_byte_size, p - buf[p])
+                # backward offset to the vector, stored on width bytes
+                offset = parse_int(width, p, 0, FlexBuffer.TYPE_UINT << 2)
+                return parse_array(el_byte_size, p - offset)
+            elif actual_type in (FlexBuffer.TYPE_VECTOR_INT, FlexBuffer.TYPE_VECTOR_UINT):
+                # typed vector: no element types
+                offset = parse_int(width, p, 0, FlexBuffer.TYPE_UINT << 2)
+                p -= offset
+                num_el = parse_int(el_byte_size, p, -1, FlexBuffer.TYPE_UINT << 2)
+                return convert_array(el_byte_size,
+                                     actual_type == FlexBuffer.TYPE_VECTOR_INT,
+                                     p, num_el)
             raise Exception(f"flex not impl (actual type {actual_type})")
 
         # last byte: root width in bytes
@@ -585,66 +1153,62 @@ class FlexBuffer:
         # previous byte: root type
         root_type = buf[-2]
 
-        root = parse_element(root_type, len(buf) - 2 - root_width)
+        root = parse_element(root_type, len(buf) - 2 - root_width, root_width)
 
         return root
 
     @staticmethod
-    def encode_vec_int16(a):
-        # straight encoding as TYPE_VECTOR_INT without any optimization attempt,
-        # 16-bit offsets
-
-        def enc16(n):
-            return bytes([n & 0xff, (n >> 8) & 0xff])
-
-        enc = enc16(len(a))
-        for el in a:
-            enc += enc16(el)
-        # backward offset to array beginning (not size) in bytes
-        enc += enc16(2 * len(a))
-        # root trailer
-        enc += bytes([
-            # type
-            (FlexBuffer.TYPE_VECTOR_INT << 2) | FlexBuffer.BIT_WIDTH_16,
-            # root byte width (just the backward offset)
-            2
-        ])
-        return enc
-
-    @staticmethod
-    def encode_vec_untyped_int16(a):
-        # straight encoding as TYPE_VECTOR without much optimization attempt
-
-        def enc8(n):
-            return bytes([n & 0xff])
-
-        def enc16(n):
-            return bytes([n & 0xff, (n >> 8) & 0xff])
-
-        # array length
-        enc = enc16(len(a))
-        # array elements
-        for el in a:
-            enc += enc16(el)
-        # element types in uint8
-        el_type = enc8((FlexBuffer.TYPE_INT << 2) | FlexBuffer.BIT_WIDTH_16)
-        enc += len(a) * el_type
-        # backward offset to array beginning (not size) in bytes
-        backward_offset = 3 * len(a)
-        backward_offset_size = 1 if backward_offset < 256 else 2
-        if backward_offset_size == 2:
+    def encode_vec_int(a, min_width=1, typed=False):
+        """Encode a vector of integers as a TYPE_VECTOR, or a TYPE_VECTOR_INT
+        if typed is True, with the narrowest element width (1 or 2 bytes) not
+        smaller than min_width. Elements are truncated to 16 bits.
+        """
+        n = len(a)
+        width = min_width
+        if width == 1 and n > 0 and (n > 255 or min(a) < -128 or max(a) > 127):
+            width = 2
+        bit_width = FlexBuffer.BIT_WIDTH_8 if width == 1 else FlexBuffer.BIT_WIDTH_16
+        code = "B" if width == 1 else "H"
+
+        # vector size followed by elements
+        enc = bytearray(width * (n + 1))
+        struct.pack_into("<" + code, enc, 0, n)
+        try:
+            struct.pack_into(f"<{n}{code.lower()}", enc, width, *a)
+        except struct.error:
+            # keep 16 lsb
+            struct.pack_into(f"<{n}H", enc, width, *[x & 0xffff for x in a])
+        if not typed:
+            # element types in uint8
+            enc += bytes(((FlexBuffer.TYPE_INT << 2) | bit_width,)) * n
+        # backward offset to vector elements in bytes
+        backward_offset = len(enc) - width
+        if backward_offset < 256:
+            enc += struct.pack("<B", backward_offset)
+            backward_offset_size = 1
+        else:
             # add padding if necessary to align int16
-            if backward_offset & 1:
+            if len(enc) & 1:
                 enc += b"\0"
                 backward_offset += 1
-            enc += enc16(backward_offset)
-        else:
-            enc += enc8(backward_offset)
-        # root trailer
-        enc += bytes([
-            # type
-            (FlexBuffer.TYPE_VECTOR << 2) | FlexBuffer.BIT_WIDTH_16,
-            # root byte width (just the backward offset)
+            enc += struct.pack("<H", backward_offset)
+            backward_offset_size = 2
+        # root trailer: type and root byte width (just the backward offset)
+        enc += bytes((
+            ((FlexBuffer.TYPE_VECTOR_INT if typed else FlexBuffer.TYPE_VECTOR) << 2)
+            | bit_width,
             backward_offset_size
-        ])
-        return enc
+        ))
+        return bytes(enc)
+
+    @staticmethod
+    def encode_vec_int16(a):
+        """Encode a vector of integers as a TYPE_VECTOR_INT of int16.
+        """
+        return FlexBuffer.encode_vec_int(a, min_width=2, typed=True)
+
+    @staticmethod
+    def encode_vec_untyped_int16(a):
+        """Encode a vector of integers as a TYPE_VECTOR of int16.
+        """
+        return FlexBuffer.encode_vec_int(a, min_width=2)
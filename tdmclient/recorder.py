@@ -0,0 +1,222 @@
+# This file is part of tdmclient.
+# Copyright 2021-2026 ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE,
+# Miniature Mobile Robots group, Switzerland
+# Author: Yves Piguet
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Recording of variables and events to files
+"""
+
+import array
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+
+class NpyFile:
+    """Append-only file in the .npy format of numpy, with a 1d array or a 2d
+    array of rows of the same width, whose header is updated after each
+    append so that it can be read at any time, e.g. with
+    numpy.load(path, mmap_mode="r").
+    """
+
+    # size of magic string, version, header length and header, padded with
+    # spaces to keep room for larger shapes
+    HEADER_SIZE = 128
+
+    def __init__(self, path, typecode, width=None):
+        """New file for array.array elements of type typecode, with rows of
+        width elements (None for a 1d array).
+        """
+        self.file = open(path, "w+b")
+        byte_order = "<" if sys.byteorder == "little" else ">"
+        self.descr = {
+            "d": byte_order + "f8",
+            "h": byte_order + "i2",
+            "q": byte_order + "i8",
+        }[typecode]
+        self.width = width
+        self.length = 0
+        self.write_header()
+
+    def write_header(self):
+        shape = (self.length,) if self.width is None else (self.length, self.width)
+        header = f"{{'descr': '{self.descr}', 'fortran_order': False, 'shape': {shape}, }}"
+        header = header.ljust(self.HEADER_SIZE - 11) + "\n"
+        self.file.seek(0)
+        self.file.write(b"\x93NUMPY\x01\x00"
+                        + struct.pack("<H", len(header))
+                        + header.encode("latin1"))
+        self.file.seek(0, os.SEEK_END)
+
+    def append(self, a):
+        """Append the content of an array.array.
+        """
+        self.file.write(a.tobytes())
+        self.length += len(a) if self.width is None else len(a) // self.width
+        self.write_header()
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class RecorderColumn:
+    """Times and values of a variable or an event of a node, buffered in
+    arrays until they're written to files by the recorder thread.
+    """
+
+    def __init__(self, path, width):
+        self.path = path
+        self.width = width
+        self.times = array.array("d")
+        self.values = array.array("h")
+        # NpyFile objects, created by the recorder thread
+        self.time_file = None
+        self.value_file = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def take(self):
+        """Return and replace the arrays of times and values.
+        """
+        times, values = self.times, self.values
+        self.times = array.array("d")
+        self.values = array.array("h")
+        return times, values
+
+
+class Recorder:
+    """Recorder of the values of variables and the data of events received
+    by a client, written to files by a background thread. For each node,
+    variable and event, there are two files in the .npy format of numpy in
+    directory/node_id: kind.name.time.npy with the reception time of each
+    value (seconds since the epoch, float64), and kind.name.value.npy with
+    one row of int16 values per reception time, where kind is "var" or
+    "event". Values are written in chunks of chunk_size rows; files can be
+    read while they're written with numpy.load(path, mmap_mode="r").
+    """
+
+    def __init__(self, client, directory, variables=None, events=None,
+                 nodes=None, chunk_size=500):
+        """New recorder.
+
+        Arguments:
+            client -- client whose variables and events are recorded
+            directory -- directory where files are written (created if needed)
+            variables -- names of variables to record (default: none)
+            events -- names of events to record (default: none)
+            nodes -- nodes to record (default: all of them)
+            chunk_size -- number of rows written at once
+        """
+        self.client = client
+        self.directory = directory
+        self.variables = set(variables) if variables else set()
+        self.events = set(events) if events else set()
+        self.nodes = set(nodes) if nodes is not None else None
+        self.chunk_size = chunk_size
+        # columns[(node_id_str, kind, name)] = RecorderColumn
+        self.columns = {}
+        # number of values discarded because their size has changed
+        self.skipped_count = 0
+        # exception raised in the recorder thread
+        self.error = None
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write_chunks, daemon=True)
+        self.thread.start()
+
+        if len(self.variables) > 0:
+            client.add_variables_changed_listener(self.on_variables_changed)
+        if len(self.events) > 0:
+            client.add_event_received_listener(self.on_event_received,
+                                               names=self.events)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def on_variables_changed(self, node, variables):
+        if node is not None and (self.nodes is None or node in self.nodes):
+            t = time.time()
+            for name in self.variables:
+                if name in variables:
+                    self.record(node, "var", name, variables[name], t)
+
+    def on_event_received(self, node, event_name, event_data):
+        if node is not None and (self.nodes is None or node in self.nodes):
+            self.record(node, "event", event_name, event_data, time.time())
+
+    def record(self, node, kind, name, value, t):
+        key = (node.id_str, kind, name)
+        column = self.columns.get(key)
+        if column is None:
+            path = os.path.join(self.directory, node.id_str, f"{kind}.{name}")
+            column = RecorderColumn(path, len(value))
+            self.columns[key] = column
+        elif len(value) != column.width:
+            self.skipped_count += 1
+            return
+        column.times.append(t)
+        if isinstance(value, array.array) and value.typecode != "h":
+            value = value.tolist()
+        column.values.extend(value)
+        if len(column) >= self.chunk_size:
+            self.queue.put((column,) + column.take())
+
+    def flush(self):
+        """Pass partial chunks to the recorder thread.
+        """
+        for column in self.columns.values():
+            if len(column) > 0:
+                self.queue.put((column,) + column.take())
+
+    def write_chunks(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # don't write anymore after an error
+                continue
+            column, times, values = item
+            try:
+                if column.time_file is None:
+                    os.makedirs(os.path.dirname(column.path), exist_ok=True)
+                    column.time_file = NpyFile(column.path + ".time.npy", "d")
+                    column.value_file = NpyFile(column.path + ".value.npy", "h",
+                                                column.width)
+                column.time_file.append(times)
+                column.value_file.append(values)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        """Stop recording, write remaining values and close files. Raise the
+        exception which has occurred in the recorder thread, if any.
+        """
+        if not self.closed:
+            self.closed = True
+            if len(self.variables) > 0:
+                self.client.remove_variables_changed_listener(self.on_variables_changed)
+            if len(self.events) > 0:
+                self.client.remove_event_received_listener(self.on_event_received)
+            self.flush()
+            self.queue.put(None)
+            self.thread.join()
+            for column in self.columns.values():
+                if column.time_file is not None:
+                    column.time_file.close()
+                    column.value_file.close()
+        if self.error is not None:
+            raise self.error
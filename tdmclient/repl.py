@@ -9,8 +9,9 @@ import code
 import ast
 import re
 import sys
+from collections import deque
 
-from tdmclient import ClientAsync, ArrayCache
+from tdmclient import ClientAsync, ClientAsyncCacheNode, ArrayCache
 from tdmclient.atranspiler import ATranspiler
 from tdmclient.module_thymio import ModuleThymio
 from tdmclient.module_clock import ModuleClock
@@ -36,8 +37,14 @@ class TDMConsole(code.InteractiveConsole):
         self.client = None
         self.node = None
 
-        # self.event_data_dict[node_id][event_name] = list of event data
+        # self.event_data_dict[node_id][event_name] = deque of event data,
+        # with at most max_event_data items (oldest dropped)
         self.event_data_dict = {}
+        self.max_event_data = 10000
+
+        # self.deploy_timings[node][stage] = duration in seconds of the
+        # last deployment of a program by run_program
+        self.deploy_timings = {}
 
         def onevent(fun):
             """Function decorator @onevent for event handlers. The event name
@@ -341,13 +348,23 @@ class TDMConsole(code.InteractiveConsole):
             elif event_name in self.event_data_dict[node_id]:
                 del self.event_data_dict[node_id][event_name]
 
+    def store_event_data(self, node, event_name, event_data):
+        if node.id_str not in self.event_data_dict:
+            self.event_data_dict[node.id_str] = {}
+        if event_name not in self.event_data_dict[node.id_str]:
+            self.event_data_dict[node.id_str][event_name] = deque(maxlen=self.max_event_data)
+        self.event_data_dict[node.id_str][event_name].append(event_data)
+
     def get_event_data(self, event_name=None, node=None):
         node_id = (self.node if node is None else node).id_str
         if node_id in self.event_data_dict:
             if event_name is None:
-                return self.event_data_dict[node_id]
+                return {
+                    name: list(data)
+                    for name, data in self.event_data_dict[node_id].items()
+                }
             else:
-                return self.event_data_dict[node_id][event_name] if event_name in self.event_data_dict[node_id] else []
+                return list(self.event_data_dict[node_id][event_name]) if event_name in self.event_data_dict[node_id] else []
         else:
             return {} if event_name is None else []
 
@@ -380,11 +397,7 @@ class TDMConsole(code.InteractiveConsole):
                     print(print_str)
                 else:
                     if len(event_data) > 0:
-                        if node.id_str not in self.event_data_dict:
-                            self.event_data_dict[node.id_str] = {}
-                        if event_name not in self.event_data_dict[node.id_str]:
-                            self.event_data_dict[node.id_str][event_name] = []
-                        self.event_data_dict[node.id_str][event_name].append(event_data)
+                        self.store_event_data(node, event_name, event_data)
                         if on_event_data is not None:
                             on_event_data(node, event_name)
 
@@ -438,9 +451,19 @@ class TDMConsole(code.InteractiveConsole):
                          nodes):
                 self.default_node = default_node
                 self.nodes = nodes
-                for node in nodes:
-                    if node != default_node:
-                        ClientAsync.aw(node.lock())
+                # lock all nodes concurrently
+                nodes_to_lock = [node for node in nodes if node != default_node]
+                results = ClientAsync.aw(console.client.gather(
+                    *[node.lock() for node in nodes_to_lock],
+                    return_exceptions=True
+                ))
+                errors = [r for r in results if isinstance(r, Exception)]
+                if len(errors) > 0:
+                    # unlock nodes which have been locked successfully
+                    for node, r in zip(nodes_to_lock, results):
+                        if not isinstance(r, Exception):
+                            node.send_unlock_node(ignore_disconnected_error=True)
+                    raise errors[0]
 
             def __enter__(self):
                 return self.nodes
@@ -448,7 +471,7 @@ class TDMConsole(code.InteractiveConsole):
             def __exit__(self, type, value, traceback):
                 for node in nodes:
                     if node != self.default_node:
-                        node.unlock()
+                        node.send_unlock_node(ignore_disconnected_error=True)
 
         return Robot(self, self.node, nodes)
 
@@ -458,7 +481,14 @@ class TDMConsole(code.InteractiveConsole):
                     language="aseba",
                     warning_missing_global=False,
                     wait=False,
-                    import_thymio=True):
+                    import_thymio=True,
+                    concurrency=None,
+                    timings=False):
+        """Run a program on nodes (default: self.node), transpiled once if
+        it's in Python, with requests sent to at most concurrency nodes at
+        the same time (no limit if None). Durations of deployment stages are
+        stored in self.deploy_timings[node] and displayed if timings is True.
+        """
         if nodes is None:
             nodes = [self.node]
 
@@ -493,11 +523,7 @@ class TDMConsole(code.InteractiveConsole):
                     print(print_str)
                 else:
                     if len(event_data) > 0:
-                        if node.id_str not in self.event_data_dict:
-                            self.event_data_dict[node.id_str] = {}
-                        if event_name not in self.event_data_dict[node.id_str]:
-                            self.event_data_dict[node.id_str][event_name] = []
-                        self.event_data_dict[node.id_str][event_name].append(event_data)
+                        self.store_event_data(node, event_name, event_data)
 
         def on_vm_state_changed(node, state, line, error, error_msg):
             if error != ClientAsync.ERROR_NO_ERROR:
@@ -505,61 +531,78 @@ class TDMConsole(code.InteractiveConsole):
             if error_msg:
                 print(f"{error_msg} (line {line}{' in Aseba' if language != 'aseba' else ''})")
 
-        def run_node(node):
-            """Compile, configure node, load and start program on a node.
-            Return True if the node requires waiting.
-            """
-            print_statements[node] = []
-            events = []
-            if language == "python":
-                # transpile from Python to Aseba
-                transpiler = self.transpile(src,
-                                            import_thymio=import_thymio,
-                                            warning_missing_global=warning_missing_global)
-                src_aseba = transpiler.get_output()
-                print_statements[node] = transpiler.print_format_strings
-                if len(print_statements[node]) > 0:
-                    events.append(("_print", 1 + transpiler.print_max_num_args))
-                if transpiler.has_exit_event:
-                    events.append(("_exit", 1))
-                for event_name in transpiler.events_in:
-                    events.append((event_name, transpiler.events_in[event_name]))
-                for event_name in transpiler.events_out:
-                    events.append((event_name, transpiler.events_out[event_name]))
-                if len(events) > 0:
-                    events = ClientAsync.aw(node.filter_out_vm_events(events))
-                if len(events) > 0:
-                    ClientAsync.aw(node.register_events(events))
-            elif language == "aseba":
-                src_aseba = src
-            else:
-                raise Exception(f"Unsupported language {language}")
-            error = ClientAsync.aw(node.compile(src_aseba))
-            if error is not None:
-                raise Exception(error["error_msg"])
-            node.send_set_scratchpad(src_aseba)
-            wait_for_node = wait
-            if wait is None:
-                # default: wait if there are events to receive
-                wait_for_node = len(events) > 0
-            if wait_for_node:
-                ClientAsync.aw(node.watch(events=True, vm_state=True))
-            error = ClientAsync.aw(node.run())
-            if error is not None:
-                raise Exception(f"Error {error['error_code']}")
-            return wait_for_node
+        # transpile once for all nodes
+        events = []
+        print_format_strings = []
+        if language == "python":
+            # transpile from Python to Aseba
+            transpiler = self.transpile(src,
+                                        import_thymio=import_thymio,
+                                        warning_missing_global=warning_missing_global)
+            src_aseba = transpiler.get_output()
+            print_format_strings = transpiler.print_format_strings
+            if len(print_format_strings) > 0:
+                events.append(("_print", 1 + transpiler.print_max_num_args))
+            if transpiler.has_exit_event:
+                events.append(("_exit", 1))
+            for event_name in transpiler.events_in:
+                events.append((event_name, transpiler.events_in[event_name]))
+            for event_name in transpiler.events_out:
+                events.append((event_name, transpiler.events_out[event_name]))
+        elif language == "aseba":
+            src_aseba = src
+        else:
+            raise Exception(f"Unsupported language {language}")
 
         self.reset_sync_var()
         self.client.clear_event_received_listeners()
-        self.client.add_event_received_listener(on_event_received)
-        self.client.add_vm_state_changed_listener(on_vm_state_changed)
-        wait_for_nodes = False
+        self.deploy_timings = {}
         with self.lock_robots(nodes) as nodes_l:
-            # transpile, compile, load, set scratchpad, and run
+            if len(events) > 0:
+                # same vm for all nodes
+                events = ClientAsync.aw(nodes_l[0].filter_out_vm_events(events))
+            wait_for_nodes = wait
+            if wait is None:
+                # default: wait if there are events to receive
+                wait_for_nodes = len(events) > 0
+            self.client.add_event_received_listener(
+                on_event_received,
+                # python: only events of the program (other events aren't decoded)
+                names=[event[0] for event in events] if language == "python" else None
+            )
+            self.client.add_vm_state_changed_listener(on_vm_state_changed)
+            # register events, compile, load, set scratchpad, and run,
+            # with requests to all nodes pipelined
             for node in nodes_l:
-                wait_for_node = run_node(node)
-                wait_for_nodes = wait_for_nodes or wait_for_node
-                running_nodes.add(node)
+                print_statements[node] = print_format_strings
+                self.deploy_timings[node] = {}
+            errors = ClientAsync.aw(self.client.gather(
+                *[
+                    node.deploy(src_aseba, events=events,
+                                scratchpad=True, watch=wait_for_nodes,
+                                timings=self.deploy_timings[node])
+                    for node in nodes_l
+                ],
+                limit=concurrency
+            ))
+            for node, error in zip(nodes_l, errors):
+                if error is None:
+                    running_nodes.add(node)
+            if timings:
+                for node in nodes_l:
+                    timings_str = ClientAsyncCacheNode.format_timings(self.deploy_timings[node])
+                    if len(nodes) > 1:
+                        # multiple nodes: add prefix
+                        timings_str = f"[R{nodes.index(node)}] " + timings_str
+                    print(timings_str)
+            for node, error in zip(nodes_l, errors):
+                if error is not None:
+                    error_str = (error["error_msg"] if "error_msg" in error
+                                 else f"Error {error['error_code']}")
+                    if len(nodes) > 1:
+                        # multiple nodes: add prefix
+                        error_str = f"[R{nodes.index(node)}] " + error_str
+                    raise Exception(error_str)
 
         # wait until all nodes have exited
         if wait_for_nodes:
@@ -13,7 +13,7 @@ import threading
 import queue
 import uuid
 import time
-from tdmclient import ThymioFB, FlatBuffer, Union
+from tdmclient import ThymioFB, FlatBuffer, Union, PacketReader
 
 
 class ServerRawTDMHandler:
@@ -33,7 +33,8 @@ class ServerNode:
                  group_id=None,
                  type=ThymioFB.NODE_TYPE_DUMMY_NODE,
                  name=None,
-                 variables=None):
+                 variables=None,
+                 vm_events=None):
         self.id = id or str(uuid.uuid4())
         self.group_id = group_id or str(uuid.uuid4())
         if name is None:
@@ -48,6 +49,8 @@ class ServerNode:
         self.data_size = 600
         self.stack_size = 100
         self.variables = variables or {}
+        # names of the events predefined in the vm
+        self.vm_events = vm_events or []
         self.events = {}
         self.execution_state = ThymioFB.VM_EXECUTION_STATE_STOPPED
         self.watch_flags = 0
@@ -97,8 +100,12 @@ class ServerHandler:
         self.send_packet_fun = send_packet_fun
         self.thymio = ThymioFB()
         self.debug = debug
+        # message_handlers[message_type] = fun(msg_view) or None to ignore
+        self.message_handlers = self.default_message_handlers()
 
     def find_node(self, node_id_str):
+        # linear search, without index: self.nodes is a small collection
+        # modified directly by applications (e.g. Server.nodes.add(node))
         for node in self.nodes:
             if node.id == node_id_str or node.group_id == node_id_str:
                 return node
@@ -155,6 +162,43 @@ class ServerHandler:
         if self.debug:
             print(f"-> var of {node.id} changed")
 
+    def default_message_handlers(self):
+        """Get a dict of the default handlers of incoming messages by type
+        (None to ignore messages of that type).
+        """
+        return {
+            ThymioFB.MESSAGE_TYPE_CONNECTION_HANDSHAKE: self.process_msg_connection_handshake,
+            ThymioFB.MESSAGE_TYPE_REQUEST_NODE_ASEBA_VM_DESCRIPTION: self.process_msg_request_node_aseba_vm_description,
+            ThymioFB.MESSAGE_TYPE_LOCK_NODE: self.process_msg_lock_node,
+            ThymioFB.MESSAGE_TYPE_UNLOCK_NODE: self.process_msg_unlock_node,
+            ThymioFB.MESSAGE_TYPE_COMPILE_AND_LOAD_CODE_ON_VM: self.process_msg_compile_and_load_code_on_vm,
+            ThymioFB.MESSAGE_TYPE_WATCH_NODE: self.process_msg_watch_node,
+            ThymioFB.MESSAGE_TYPE_SET_VARIABLES: self.process_msg_set_variables,
+            ThymioFB.MESSAGE_TYPE_REGISTER_EVENTS: self.process_msg_register_events,
+            ThymioFB.MESSAGE_TYPE_SEND_EVENTS: self.process_msg_send_events,
+            ThymioFB.MESSAGE_TYPE_SET_BREAKPOINTS: self.process_msg_set_breakpoints,
+            ThymioFB.MESSAGE_TYPE_SET_VM_EXECUTION_STATE: self.process_msg_set_vm_execution_state,
+            ThymioFB.MESSAGE_TYPE_SCRATCHPAD_UPDATE: self.process_msg_scratchpad_update,
+        }
+
+    def set_message_handler(self, message_type, handler):
+        """Set the function handler(msg_view) called for incoming messages
+        of the specified type, or None to ignore them, and return the
+        previous handler. msg_view is the message content as a Table.
+        """
+        previous_handler = self.message_handlers.get(message_type)
+        self.message_handlers[message_type] = handler
+        return previous_handler
+
+    def reset_message_handler(self, message_type):
+        """Restore the default handler of messages of the specified type.
+        """
+        default_handlers = self.default_message_handlers()
+        if message_type in default_handlers:
+            self.message_handlers[message_type] = default_handlers[message_type]
+        elif message_type in self.message_handlers:
+            del self.message_handlers[message_type]
+
     def process_message(self, msg, connection_data=None) -> None:
         if self.raw_packet_handler is not None:
             self.raw_packet_handler.handle_packet(msg, connection_data=connection_data)
@@ -165,300 +209,320 @@ class ServerHandler:
         if type(fb.root) is Union:
             if self.debug:
                 print(f"<- type={fb.root.union_type}")
-            if fb.root.union_type == ThymioFB.MESSAGE_TYPE_CONNECTION_HANDSHAKE:
-                # send back handshake
-                msg = self.thymio.create_message((
-                    ThymioFB.MESSAGE_TYPE_CONNECTION_HANDSHAKE,
-                    ()
-                ), ThymioFB.SCHEMA)
+            message_type = fb.root.union_type
+            msg_view = fb.root.union_data[0] if fb.root.union_data is not None else None
+            if message_type in self.message_handlers:
+                handler = self.message_handlers[message_type]
+                if handler is not None:
+                    handler(msg_view)
+            elif self.debug:
+                print("Not handled")
+
+    def process_msg_connection_handshake(self, msg_view):
+        # send back handshake
+        msg = self.thymio.create_message((
+            ThymioFB.MESSAGE_TYPE_CONNECTION_HANDSHAKE,
+            ()
+        ), ThymioFB.SCHEMA)
+        if self.debug:
+            print("-> handshake")
+        self.send_packet_fun(msg)
+        # send node changed for all nodes
+        self.send_nodes_changed()
+        # send variables changed for all nodes
+        for node in self.nodes:
+            self.send_variables_changed(node)
+
+    def process_msg_request_node_aseba_vm_description(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        node = self.find_node(node_id_str)
+        if node is not None:
+            msg = self.thymio.create_message((
+                ThymioFB.MESSAGE_TYPE_NODE_ASEBA_VM_DESCRIPTION,
+                (
+                    request_id,
+                    (
+                        ThymioFB.id_str_to_bytes(node.id),
+                    ),
+                    node.bytecode_size,
+                    node.data_size,
+                    node.stack_size,
+                    [
+                        (
+                            i,
+                            name,
+                            len(node.variables[name]),
+                        )
+                        for i, name in enumerate(node.variables)
+                    ],
+                    [
+                        (i, name, "")
+                        for i, name in enumerate(node.vm_events)
+                    ],
+                    [],
+                )
+            ), ThymioFB.SCHEMA)
+            if self.debug:
+                print(f"-> vm description {node.id}: bc_s={node.bytecode_size}, data_s={node.data_size}, stack_s={node.stack_size}")
+                for i, name in enumerate(node.variables):
+                    print(f"var {name}[{len(node.variables[name])}]")
+        else:
+            msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
+            if self.debug:
+                print(f"-> unknown {node.id}")
+        self.send_packet_fun(msg)
+
+    def process_msg_lock_node(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        node = self.find_node(node_id_str)
+        if node is not None:
+            if node.status == ThymioFB.NODE_STATUS_AVAILABLE:
+                node.status = ThymioFB.NODE_STATUS_READY
+                msg = self.thymio.create_msg_request_completed(request_id)
                 if self.debug:
-                    print("-> handshake")
+                    print(f"-> {node.id} locked")
+                self.send_nodes_changed()
+            else:
+                msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_NODE_BUSY)
+                if self.debug:
+                    print(f"-> lock error: {node.id} busy")
+        else:
+            msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
+            if self.debug:
+                print(f"-> unknown {node.id}")
+        self.send_packet_fun(msg)
+
+    def process_msg_unlock_node(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        node = self.find_node(node_id_str)
+        if node is not None:
+            if node.status == ThymioFB.NODE_STATUS_READY:
+                node.status = ThymioFB.NODE_STATUS_AVAILABLE
+                msg = self.thymio.create_msg_request_completed(request_id)
                 self.send_packet_fun(msg)
-                # send node changed for all nodes
+                if self.debug:
+                    print(f"-> {node.id} unlocked")
                 self.send_nodes_changed()
-                # send variables changed for all nodes
-                for node in self.nodes:
-                    self.send_variables_changed(node)
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_REQUEST_NODE_ASEBA_VM_DESCRIPTION:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                node = self.find_node(node_id_str)
-                if node is not None:
-                    msg = self.thymio.create_message((
-                        ThymioFB.MESSAGE_TYPE_NODE_ASEBA_VM_DESCRIPTION,
-                        (
-                            request_id,
-                            (
-                                ThymioFB.id_str_to_bytes(node.id),
-                            ),
-                            node.bytecode_size,
-                            node.data_size,
-                            node.stack_size,
-                            [
-                                (
-                                    i,
-                                    name,
-                                    len(node.variables[name]),
-                                )
-                                for i, name in enumerate(node.variables)
-                            ],
-                            [],
-                            [],
-                        )
-                    ), ThymioFB.SCHEMA)
-                    if self.debug:
-                        print(f"-> vm description {node.id}: bc_s={node.bytecode_size}, data_s={node.data_size}, stack_s={node.stack_size}")
-                        for i, name in enumerate(node.variables):
-                            print(f"var {name}[{len(node.variables[name])}]")
-                else:
-                    msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
-                    if self.debug:
-                        print(f"-> unknown {node.id}")
+            else:
+                msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN)
                 self.send_packet_fun(msg)
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_LOCK_NODE:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                node = self.find_node(node_id_str)
-                if node is not None:
-                    if node.status == ThymioFB.NODE_STATUS_AVAILABLE:
-                        node.status = ThymioFB.NODE_STATUS_READY
-                        msg = self.thymio.create_msg_request_completed(request_id)
-                        if self.debug:
-                            print(f"-> {node.id} locked")
-                        self.send_nodes_changed()
-                    else:
-                        msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_NODE_BUSY)
-                        if self.debug:
-                            print(f"-> lock error: {node.id} busy")
-                else:
-                    msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
-                    if self.debug:
-                        print(f"-> unknown {node.id}")
+                if self.debug:
+                    print(f"-> unlock error: {node.id} not locked")
+        else:
+            msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
+            self.send_packet_fun(msg)
+            if self.debug:
+                print(f"-> unknown node {node.id}")
+
+    def process_msg_compile_and_load_code_on_vm(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        node = self.find_node(node_id_str)
+        if node is not None:
+            language = FlatBuffer.field_val(msg_view.fields[2], ThymioFB.PROGRAMMING_LANGUAGE_ASEBA)
+            program = FlatBuffer.field_val(msg_view.fields[3], "")
+            options = FlatBuffer.field_val(msg_view.fields[4], 0)
+            error = node.compile_and_load(language, program, options)
+            if self.debug:
+                print(f"Source code:\n{program}")
+            if error is None:
+                msg = self.thymio.create_msg_compilation_result_success(request_id,
+                                                                        0, node.bytecode_size,
+                                                                        0, node.data_size)
                 self.send_packet_fun(msg)
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_UNLOCK_NODE:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                node = self.find_node(node_id_str)
-                if node is not None:
-                    if node.status == ThymioFB.NODE_STATUS_READY:
-                        node.status = ThymioFB.NODE_STATUS_AVAILABLE
-                        msg = self.thymio.create_msg_request_completed(request_id)
-                        self.send_packet_fun(msg)
-                        if self.debug:
-                            print(f"-> {node.id} unlocked")
-                        self.send_nodes_changed()
-                    else:
-                        msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN)
-                        self.send_packet_fun(msg)
-                        if self.debug:
-                            print(f"-> unlock error: {node.id} not locked")
-                else:
-                    msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        print(f"-> unknown node {node.id}")
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_COMPILE_AND_LOAD_CODE_ON_VM:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                node = self.find_node(node_id_str)
-                if node is not None:
-                    language = FlatBuffer.field_val(fb.root.union_data[0].fields[2], ThymioFB.PROGRAMMING_LANGUAGE_ASEBA)
-                    program = FlatBuffer.field_val(fb.root.union_data[0].fields[3], "")
-                    options = FlatBuffer.field_val(fb.root.union_data[0].fields[4], 0)
-                    error = node.compile_and_load(language, program, options)
-                    if self.debug:
-                        print(f"Source code:\n{program}")
-                    if error is None:
-                        msg = self.thymio.create_msg_compilation_result_success(request_id,
-                                                                                0, node.bytecode_size,
-                                                                                0, node.data_size)
-                        self.send_packet_fun(msg)
-                        if self.debug:
-                            print(f"-> compilation ok")
-                    else:
-                        msg = self.thymio.create_msg_compilation_result_failure(request_id,
-                                                                                *error)
-                else:
-                    msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        print(f"-> unknown node {node.id}")
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_WATCH_NODE:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                flags = FlatBuffer.field_val(fb.root.union_data[0].fields[2], 0)
-                node = self.find_node(node_id_str)
-                if node is not None:
-                    node.set_watch_flags(flags)
-                    if self.debug:
-                        print(f"Node {node_id_str}: watch flags := 0x{flags:x}")
-                    msg = self.thymio.create_msg_request_completed(request_id)
-                    self.send_packet_fun(msg)
-                else:
-                    msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        print(f"-> unknown node {node_id_str}")
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_SET_VARIABLES:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                variables = {
-                    v.fields[0][0]: v.fields[1][0] if isinstance(v.fields[1][0], list) else [v.fields[1][0]]
-                    for v in fb.root.union_data[0].fields[2][0]
-                }
-                node = self.find_node(node_id_str)
-                if node is not None:
-                    node.variables = {**node.variables, **variables}
-                    msg = self.thymio.create_msg_request_completed(request_id)
-                    self.send_packet_fun(msg)
-                    self.send_variables_changed(node)
-                    if self.debug:
-                        for variable in variables:
-                            print(f"set variable {variable}")
-                else:
-                    msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        print(f"-> unknown node {node.id}")
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_REGISTER_EVENTS:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                events = {
-                    e.fields[0]: e.fields[1]
-                    for e in fb.root.union_data[0].fields[2][0]
-                }
-                node = self.find_node(node_id_str)
-                if node is not None:
-                    node.events = events
-                    msg = self.thymio.create_msg_request_completed(request_id)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        for event in events:
-                            print(f"register event {event}")
-                else:
-                    msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        print(f"-> unknown node {node.id}")
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_SEND_EVENTS:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                events = [
-                    (v.fields[0][0], v.fields[1][0] if isinstance(v.fields[1][0], list) else [v.fields[1][0]])
-                    for v in fb.root.union_data[0].fields[2][0]
-                ]
-                node = self.find_node(node_id_str)
-                if node is not None:
-                    msg = self.thymio.create_msg_request_completed(request_id)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        for event in events:
-                            print(f"emit {event[0]} {event[1]}")
-                else:
-                    msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        print(f"-> unknown node {node.id}")
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_SET_BREAKPOINTS:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                breakpoints = [
-                    bp.fields[0][0]
-                    for bp in fb.root.union_data[0].fields[2][0]
-                ]
-                node = self.find_node(node_id_str)
-                if node is not None:
-                    msg = self.thymio.create_message((
-                        ThymioFB.MESSAGE_TYPE_SET_BREAKPOINTS_RESPONSE,
+                if self.debug:
+                    print(f"-> compilation ok")
+            else:
+                msg = self.thymio.create_msg_compilation_result_failure(request_id,
+                                                                        *error)
+        else:
+            msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
+            self.send_packet_fun(msg)
+            if self.debug:
+                print(f"-> unknown node {node.id}")
+
+    def process_msg_watch_node(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        flags = FlatBuffer.field_val(msg_view.fields[2], 0)
+        node = self.find_node(node_id_str)
+        if node is not None:
+            node.set_watch_flags(flags)
+            if self.debug:
+                print(f"Node {node_id_str}: watch flags := 0x{flags:x}")
+            msg = self.thymio.create_msg_request_completed(request_id)
+            self.send_packet_fun(msg)
+        else:
+            msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
+            self.send_packet_fun(msg)
+            if self.debug:
+                print(f"-> unknown node {node_id_str}")
+
+    def process_msg_set_variables(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        variables = {
+            v.fields[0][0]: v.fields[1][0] if isinstance(v.fields[1][0], list) else [v.fields[1][0]]
+            for v in msg_view.fields[2][0]
+        }
+        node = self.find_node(node_id_str)
+        if node is not None:
+            node.variables = {**node.variables, **variables}
+            msg = self.thymio.create_msg_request_completed(request_id)
+            self.send_packet_fun(msg)
+            self.send_variables_changed(node)
+            if self.debug:
+                for variable in variables:
+                    print(f"set variable {variable}")
+        else:
+            msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
+            self.send_packet_fun(msg)
+            if self.debug:
+                print(f"-> unknown node {node.id}")
+
+    def process_msg_register_events(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        events = {
+            e.fields[0]: e.fields[1]
+            for e in msg_view.fields[2][0]
+        }
+        node = self.find_node(node_id_str)
+        if node is not None:
+            node.events = events
+            msg = self.thymio.create_msg_request_completed(request_id)
+            self.send_packet_fun(msg)
+            if self.debug:
+                for event in events:
+                    print(f"register event {event}")
+        else:
+            msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
+            self.send_packet_fun(msg)
+            if self.debug:
+                print(f"-> unknown node {node.id}")
+
+    def process_msg_send_events(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        events = [
+            (v.fields[0][0], v.fields[1][0] if isinstance(v.fields[1][0], list) else [v.fields[1][0]])
+            for v in msg_view.fields[2][0]
+        ]
+        node = self.find_node(node_id_str)
+        if node is not None:
+            msg = self.thymio.create_msg_request_completed(request_id)
+            self.send_packet_fun(msg)
+            if self.debug:
+                for event in events:
+                    print(f"emit {event[0]} {event[1]}")
+        else:
+            msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
+            self.send_packet_fun(msg)
+            if self.debug:
+                print(f"-> unknown node {node.id}")
+
+    def process_msg_set_breakpoints(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        breakpoints = [
+            bp.fields[0][0]
+            for bp in msg_view.fields[2][0]
+        ]
+        node = self.find_node(node_id_str)
+        if node is not None:
+            msg = self.thymio.create_message((
+                ThymioFB.MESSAGE_TYPE_SET_BREAKPOINTS_RESPONSE,
+                (
+                    request_id,
+                    ThymioFB.ERROR_NO_ERROR,
+                    [
                         (
-                            request_id,
-                            ThymioFB.ERROR_NO_ERROR,
-                            [
-                                (
-                                    bp,
-                                )
-                                for bp in breakpoints
-                            ],
+                            bp,
                         )
-                    ), ThymioFB.SCHEMA)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        for bp in breakpoints:
-                            print(f"set breakpoint {bp}")
-                else:
-                    msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        print(f"-> unknown node {node.id}")
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_SET_VM_EXECUTION_STATE:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                node = self.find_node(node_id_str)
-                if node is not None:
-                    command = FlatBuffer.field_val(fb.root.union_data[0].fields[2], ThymioFB.VM_EXECUTION_STATE_COMMAND_STOP)
-                    if command == ThymioFB.VM_EXECUTION_STATE_COMMAND_STOP:
-                        node.stop()
-                        if self.debug:
-                            print("Set vm execution state: stop")
-                    elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_RUN:
-                        node.run()
-                        if self.debug:
-                            print("Set vm execution state: run")
-                    elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_STEP:
-                        node.step()
-                        if self.debug:
-                            print("Set vm execution state: step")
-                    elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_STEP_TO_NEXT_LINE:
-                        node.step_to_next_line()
-                        if self.debug:
-                            print("Set vm execution state: step to next line")
-                    elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_PAUSE:
-                        node.pause()
-                        if self.debug:
-                            print("Set vm execution state: pause")
-                    elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_RESET:
-                        node.reset()
-                        if self.debug:
-                            print("Set vm execution state: reset")
-                    elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_REBOOT:
-                        node.reboot()
-                        if self.debug:
-                            print("Set vm execution state: reboot")
-                    elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_SUSPEND:
-                        node.suspend()
-                        if self.debug:
-                            print("Set vm execution state: suspend")
-                    elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_WRITE_PROGRAM_TO_DEVICE_MEMORY:
-                        node.write_program_to_device_memory()
-                        if self.debug:
-                            print("Set vm execution state: write program to device memory")
-                    msg = self.thymio.create_msg_request_completed(request_id)
-                    self.send_packet_fun(msg)
-                    msg = self.thymio.create_msg_request_completed(request_id)
-                    self.send_packet_fun(msg)
-                    msg = self.thymio.create_msg_vm_execution_state_changed(node_id_str, node.execution_state, 1, ThymioFB.ERROR_NO_ERROR, "")
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        print(f"-> state = {node.execution_state}")
-                else:
-                    msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
-                    self.send_packet_fun(msg)
-                    if self.debug:
-                        print(f"-> unknown node {node.id}")
-            elif fb.root.union_type == ThymioFB.MESSAGE_TYPE_SCRATCHPAD_UPDATE:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                scratchpad_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                group_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[2])
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[3])
-                language = FlatBuffer.field_val(fb.root.union_data[0].fields[4], ThymioFB.PROGRAMMING_LANGUAGE_ASEBA)
-                text = FlatBuffer.field_val(fb.root.union_data[0].fields[5], "")
-                name = FlatBuffer.field_val(fb.root.union_data[0].fields[6], "")
-                deleted = FlatBuffer.field_val(fb.root.union_data[0].fields[7], False)
+                        for bp in breakpoints
+                    ],
+                )
+            ), ThymioFB.SCHEMA)
+            self.send_packet_fun(msg)
+            if self.debug:
+                for bp in breakpoints:
+                    print(f"set breakpoint {bp}")
+        else:
+            msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
+            self.send_packet_fun(msg)
+            if self.debug:
+                print(f"-> unknown node {node.id}")
+
+    def process_msg_set_vm_execution_state(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        node = self.find_node(node_id_str)
+        if node is not None:
+            command = FlatBuffer.field_val(msg_view.fields[2], ThymioFB.VM_EXECUTION_STATE_COMMAND_STOP)
+            if command == ThymioFB.VM_EXECUTION_STATE_COMMAND_STOP:
+                node.stop()
                 if self.debug:
-                    print(f"Scratchpad language={language} name={name} deleted={deleted}:\n{text}")
-            else:
+                    print("Set vm execution state: stop")
+            elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_RUN:
+                node.run()
+                if self.debug:
+                    print("Set vm execution state: run")
+            elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_STEP:
+                node.step()
+                if self.debug:
+                    print("Set vm execution state: step")
+            elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_STEP_TO_NEXT_LINE:
+                node.step_to_next_line()
+                if self.debug:
+                    print("Set vm execution state: step to next line")
+            elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_PAUSE:
+                node.pause()
+                if self.debug:
+                    print("Set vm execution state: pause")
+            elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_RESET:
+                node.reset()
+                if self.debug:
+                    print("Set vm execution state: reset")
+            elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_REBOOT:
+                node.reboot()
+                if self.debug:
+                    print("Set vm execution state: reboot")
+            elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_SUSPEND:
+                node.suspend()
                 if self.debug:
-                    print("Not handled")
+                    print("Set vm execution state: suspend")
+            elif command == ThymioFB.VM_EXECUTION_STATE_COMMAND_WRITE_PROGRAM_TO_DEVICE_MEMORY:
+                node.write_program_to_device_memory()
+                if self.debug:
+                    print("Set vm execution state: write program to device memory")
+            msg = self.thymio.create_msg_request_completed(request_id)
+            self.send_packet_fun(msg)
+            msg = self.thymio.create_msg_request_completed(request_id)
+            self.send_packet_fun(msg)
+            msg = self.thymio.create_msg_vm_execution_state_changed(node_id_str, node.execution_state, 1, ThymioFB.ERROR_NO_ERROR, "")
+            self.send_packet_fun(msg)
+            if self.debug:
+                print(f"-> state = {node.execution_state}")
+        else:
+            msg = self.thymio.create_msg_error(request_id, ThymioFB.ERROR_UNKNOWN_NODE)
+            self.send_packet_fun(msg)
+            if self.debug:
+                print(f"-> unknown node {node.id}")
+
+    def process_msg_scratchpad_update(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        scratchpad_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        group_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[2])
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[3])
+        language = FlatBuffer.field_val(msg_view.fields[4], ThymioFB.PROGRAMMING_LANGUAGE_ASEBA)
+        text = FlatBuffer.field_val(msg_view.fields[5], "")
+        name = FlatBuffer.field_val(msg_view.fields[6], "")
+        deleted = FlatBuffer.field_val(msg_view.fields[7], False)
+        if self.debug:
+            print(f"Scratchpad language={language} name={name} deleted={deleted}:\n{text}")
 
 
 class ServerThread(threading.Thread):
@@ -472,6 +536,7 @@ class ServerThread(threading.Thread):
         self.server = server
         self.socket = socket
         self.socket.settimeout(0.1)
+        self.packet_reader = PacketReader(self.socket.recv_into)
         self.address_client = address_client
         self.output_packet_queue = output_packet_queue
         self.connection_data = connection_data
@@ -481,21 +546,10 @@ class ServerThread(threading.Thread):
                                             lambda p: self.send_packet(p),
                                             debug=debug)
 
-    def read_uint32(self) -> int:
-        """Read an unsigned 32-bit number.
-        """
-        b = self.socket.recv(4)
-        if len(b) < 4:
-            raise socket.timeout()
-        else:
-            return b[0] + 256 * (b[1] + 256 * (b[2] + 256 * b[3]))
-
-    def read_packet(self):
-        """Read a complete packet.
+    def read_packets(self):
+        """Read all the complete packets received.
         """
-        packet_len = self.read_uint32()
-        packet = self.socket.recv(packet_len)
-        return packet
+        return self.packet_reader.read_packets()
 
     def send_packet(self, packet):
         """Send a packet prefixed by its length.
@@ -518,8 +572,8 @@ class ServerThread(threading.Thread):
                             print("sending packet in the queue")
                         self.send_packet(packet)
                 try:
-                    msg = self.read_packet()
-                    self.server_handler.process_message(msg, connection_data=self.connection_data)
+                    for msg in self.read_packets():
+                        self.server_handler.process_message(msg, connection_data=self.connection_data)
                 except socket.timeout:
                     pass
                 except ConnectionResetError:
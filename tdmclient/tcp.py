@@ -12,20 +12,139 @@ Author: Yves Piguet, EPFL
 
 import socket
 import io
+import struct
 import threading
 import queue
 
 
+class PacketReader:
+    """Reader of packets prefixed by their length (32-bit little-endian),
+    which receives with a single call to recv_into as much data as
+    available and splits it into all the complete packets it contains.
+    Packets smaller than copy_size are copied to bytes objects, so that the
+    receive buffer can be reused; larger packets are memoryview slices of
+    the receive buffer, without copy, and the remaining data are then moved
+    to a new buffer instead of overwriting them. Each memoryview packet
+    keeps its whole buffer alive.
+    """
+
+    BUFFER_SIZE = 16384
+    COPY_SIZE = 4096
+
+    def __init__(self, recv_into=None, buffer_size=None, copy_size=None):
+        """Arguments:
+            recv_into - fun(buffer) which receives data in a writable buffer
+            and returns the number of bytes received, 0 if the connection
+            has been closed (typically socket.recv_into), or None if data
+            are stored with get_buffer and buffer_updated
+            buffer_size - minimum size of receive buffer (default: BUFFER_SIZE)
+            copy_size - size of the smallest packet handed out as a
+            memoryview instead of bytes (default: COPY_SIZE)
+        """
+        self.recv_into = recv_into
+        self.buffer_size = buffer_size or self.BUFFER_SIZE
+        self.copy_size = self.COPY_SIZE if copy_size is None else copy_size
+        self.buf = bytearray(self.buffer_size)
+        # number of buffers allocated
+        self.buffer_count = 1
+        # received data not handed out yet: self.buf[self.start:self.end]
+        self.start = 0
+        self.end = 0
+
+    def pending_size(self):
+        """Size of the incomplete packet at the beginning of the pending data
+        (including its length prefix), or 4 if its length isn't known yet.
+        """
+        if self.end - self.start < 4:
+            return 4
+        return 4 + struct.unpack_from("<I", self.buf, self.start)[0]
+
+    def move_to_new_buffer(self, size):
+        """Move pending data to a new buffer of at least the specified size.
+        """
+        buf = bytearray(max(size, self.buffer_size))
+        buf[:self.end - self.start] = self.buf[self.start:self.end]
+        self.buf = buf
+        self.buffer_count += 1
+        self.end -= self.start
+        self.start = 0
+
+    def move_to_start(self):
+        """Move pending data to the beginning of the buffer, which mustn't be
+        referenced by packets.
+        """
+        self.buf[:self.end - self.start] = self.buf[self.start:self.end]
+        self.end -= self.start
+        self.start = 0
+
+    def get_buffer(self):
+        """Get a writable buffer where received data must be stored before
+        calling buffer_updated.
+        """
+        if self.end == len(self.buf):
+            # no space left: pending packet larger than buffer
+            self.move_to_new_buffer(self.pending_size())
+        return memoryview(self.buf)[self.end:]
+
+    def buffer_updated(self, n):
+        """Process n bytes stored in the buffer returned by get_buffer, and
+        return the list of complete packets as bytes or memoryview objects
+        (possibly empty if the last packet is still incomplete).
+        """
+        self.end += n
+
+        packets = []
+        mv = memoryview(self.buf)
+        buffer_referenced = False
+        while self.end - self.start >= 4:
+            packet_len = struct.unpack_from("<I", self.buf, self.start)[0]
+            if self.end - self.start - 4 < packet_len:
+                break
+            self.start += 4
+            if packet_len < self.copy_size:
+                packets.append(bytes(mv[self.start : self.start + packet_len]))
+            else:
+                packets.append(mv[self.start : self.start + packet_len])
+                buffer_referenced = True
+            self.start += packet_len
+
+        if buffer_referenced:
+            # buffer referenced by packets: continue in a new one
+            self.move_to_new_buffer(self.pending_size())
+        elif self.start + self.pending_size() > len(self.buf):
+            # pending packet doesn't fit in the rest of the buffer
+            if self.pending_size() <= len(self.buf):
+                self.move_to_start()
+            else:
+                self.move_to_new_buffer(self.pending_size())
+        elif self.start == self.end:
+            # no pending data: restart at the beginning of the buffer
+            self.start = self.end = 0
+        return packets
+
+    def read_packets(self):
+        """Receive data with recv_into and return the list of complete
+        packets. Raise ConnectionResetError if the connection is closed.
+        """
+        n = self.recv_into(self.get_buffer())
+        if n == 0:
+            raise ConnectionResetError("connection closed")
+        return self.buffer_updated(n)
+
+
 class InputThread(threading.Thread):
     """Thread which reads packets asynchronously.
     """
 
-    def __init__(self, io, io_lock, packet_queue=None):
+    def __init__(self, io, io_lock, packet_queue=None, packet_event=None):
         threading.Thread.__init__(self)
         self.running = True
         self.io = io
         self.io_lock = io_lock
         self.packet_queue = packet_queue
+        # threading.Event set when packets are put in packet_queue
+        self.packet_event = packet_event
+        self.packet_reader = PacketReader(io.readinto)
         self.comm_error = None
         self.on_terminated = []
 
@@ -40,27 +159,16 @@ class InputThread(threading.Thread):
             self.on_terminated.append(on_terminated)
         self.running = False
 
-    def read_uint32(self) -> int:
-        """Read an unsigned 32-bit number.
-        """
-        b = self.io.read(4)
-        if len(b) < 4:
-            raise TimeoutError()
-        else:
-            return b[0] + 256 * (b[1] + 256 * (b[2] + 256 * b[3]))
-
-    def read_packet(self):
-        """Read a complete packet.
+    def read_packets(self):
+        """Read all the complete packets received.
         """
         try:
             with self.io_lock:
                 if not self.running:
                     raise Exception("closing")
-                packet_len = self.read_uint32()
-                packet = b""
-                while len(packet) < packet_len:
-                    packet += self.io.read(packet_len - len(packet))
-            return packet
+                return self.packet_reader.read_packets()
+        except TimeoutError:
+            raise
         except Exception as error:
             self.comm_error = error
             raise error
@@ -70,11 +178,17 @@ class InputThread(threading.Thread):
         """
         while self.running:
             try:
-                packet = self.read_packet()
+                packets = self.read_packets()
                 if self.packet_queue is not None:
-                    self.packet_queue.put(packet)
+                    for packet in packets:
+                        self.packet_queue.put(packet)
+                    if self.packet_event is not None and len(packets) > 0:
+                        self.packet_event.set()
             except TimeoutError:
                 pass
+            except ConnectionError:
+                # connection closed (error kept in self.comm_error)
+                self.running = False
 
         # executed all on_terminated callbacks in turn
         while len(self.on_terminated) > 0:
@@ -98,6 +212,9 @@ class TDMConnection:
             def read(self, n):
                 return self.socket.recv(n)
 
+            def readinto(self, b):
+                return self.socket.recv_into(b)
+
             def write(self, b):
                 self.socket.sendall(b)
 
@@ -106,12 +223,14 @@ class TDMConnection:
         self.timeout = 3
         self.comm_error = None
         self.input_queue = queue.Queue()
+        self.input_event = threading.Event()
 
         self.io_lock = threading.Lock()
         self.input_lock = threading.Lock()
         self.input_thread = InputThread(self.io,
                                         self.io_lock,
-                                        packet_queue=self.input_queue)
+                                        packet_queue=self.input_queue,
+                                        packet_event=self.input_event)
         self.input_thread.start()
 
         self.output_lock = threading.Lock()
@@ -175,3 +294,12 @@ class TDMConnection:
             return self.input_queue.get_nowait()
         except queue.Empty:
             return None
+
+    def wait_for_packet(self, timeout=None):
+        """Wait until a packet has been received, or for timeout seconds
+        (forever if None). Return True if packets are waiting.
+        """
+        self.input_event.clear()
+        if not self.input_queue.empty():
+            return True
+        return self.input_event.wait(timeout)
@@ -11,7 +11,20 @@ Author: Yves Piguet, EPFL
 """
 
 
-from tdmclient import FlatBuffer, Union
+import struct
+from time import monotonic
+
+from tdmclient import FlatBuffer, FlexBuffer, UnionView
+
+
+class RequestTimeoutError(Exception):
+    """No reply received for a request before its deadline, or request
+    discarded because too many requests were pending.
+    """
+
+    def __init__(self, request_id):
+        super().__init__(f"No reply to request {request_id}")
+        self.request_id = request_id
 
 
 class Listener:
@@ -24,8 +37,14 @@ class Listener:
         self.on_variables_changed = set()
         # on_events_received(node, event_dict)
         self.on_events_received = set()
-        # on_event_received(node, event_name, event_data)
+        # on_event_received(node, event_name, event_data) for all events
         self.on_event_received = set()
+        # event_received_subscriptions[listener] = (names, node) for
+        # listeners of specific events (names) or of a specific node
+        self.event_received_subscriptions = {}
+        # event_received_index[name] = list of (listener, node) from
+        # event_received_subscriptions (name None for all events)
+        self.event_received_index = {}
         # on_vm_state_changed(node, state, line, error, error_msg)
         self.on_vm_state_changed = set()
 
@@ -47,14 +66,55 @@ class Listener:
     def clear_events_received_listeners(self):
         self.on_events_received = set()
 
-    def add_event_received_listener(self, listener):
-        self.on_event_received.add(listener)
+    def add_event_received_listener(self, listener, names=None, node=None):
+        """Add a function listener(node, event_name, event_data) called for
+        each event received, or only for events whose name is in names
+        and/or which are emitted by node.
+        """
+        if names is None and node is None:
+            self.on_event_received.add(listener)
+        else:
+            self.event_received_subscriptions[listener] = (
+                set(names) if names is not None else None,
+                node
+            )
+            self.index_event_received_subscriptions()
 
     def remove_event_received_listener(self, listener):
-        self.on_event_received.remove(listener)
+        if listener in self.event_received_subscriptions:
+            del self.event_received_subscriptions[listener]
+            self.index_event_received_subscriptions()
+        else:
+            self.on_event_received.remove(listener)
 
     def clear_event_received_listeners(self):
         self.on_event_received = set()
+        self.event_received_subscriptions = {}
+        self.event_received_index = {}
+
+    def index_event_received_subscriptions(self):
+        self.event_received_index = {}
+        for listener, (names, node) in self.event_received_subscriptions.items():
+            for name in names if names is not None else (None,):
+                if name not in self.event_received_index:
+                    self.event_received_index[name] = []
+                self.event_received_index[name].append((listener, node))
+
+    def subscribed_event_names(self, node):
+        """Get the set of names of the events emitted by node which are
+        expected by listeners, or None if all events are.
+        """
+        if self.on_events_received or self.on_event_received:
+            return None
+        names = set()
+        for name, subscriptions in self.event_received_index.items():
+            for _, listener_node in subscriptions:
+                if listener_node is None or listener_node is node:
+                    if name is None:
+                        return None
+                    names.add(name)
+                    break
+        return names
 
     def add_vm_state_changed_listener(self, listener):
         self.on_vm_state_changed.add(listener)
@@ -75,22 +135,111 @@ class Listener:
         for f in self.on_event_received:
             for name in event_dict:
                 f(node, name, event_dict[name])
+        if self.event_received_index:
+            for name in event_dict:
+                for f, listener_node in self.event_received_index.get(name, ()):
+                    if listener_node is None or listener_node is node:
+                        f(node, name, event_dict[name])
+            for f, listener_node in self.event_received_index.get(None, ()):
+                if listener_node is node:
+                    for name in event_dict:
+                        f(node, name, event_dict[name])
 
     def notify_vm_state_changed(self, node, state, line, error, error_msg):
         for f in self.on_vm_state_changed:
             f(node, state, line, error, error_msg)
 
 
+class MessageTemplate:
+    """Encoded message for a given node, given names and given sizes of
+    values, whose request id and values are patched in place for each new
+    message instead of encoding the whole message again.
+    """
+
+    def __init__(self, msg, values_field=None, min_widths=None, typed=False):
+        """Encode msg (union type and table whose first field is the request
+        id) once. If values_field is not None, it's the index of a field of
+        type *T(sx) (name and FlexBuffer vector of integers) whose values can
+        be replaced with values of the same size. Vectors have the narrowest
+        element width (1 or 2 bytes) for their initial values, not smaller
+        than min_widths (list of minimum widths), and are typed vectors if
+        typed is True.
+        """
+        self.widths = []
+        sizes = []
+        if values_field is not None:
+            named_values = msg[1][values_field]
+            sizes = [len(value) for name, value in named_values]
+            if min_widths is None:
+                min_widths = [1] * len(named_values)
+            named_values = [
+                (name, FlexBuffer.encode_vec_int(value, min_width, typed))
+                for (name, value), min_width in zip(named_values, min_widths)
+            ]
+            # root type of each FlexBuffer has bit width 0 (8) or 1 (16)
+            self.widths = [1 << (enc[-2] & 3) for name, enc in named_values]
+            msg = (
+                msg[0],
+                msg[1][:values_field] + (named_values,) + msg[1][values_field + 1:]
+            )
+        encoded = ThymioFB.create_message(msg, ThymioFB.SCHEMA)
+        self.buf = bytearray(encoded)
+        fb = FlatBuffer()
+        fb.parse(encoded, ThymioFB.SCHEMA, lazy=True)
+        table = fb.root.union_data[0]
+        self.request_id_pos = table.field_pos(0)
+        # (pos, struct) of the elements of each FlexBuffer vector
+        self.value_packers = []
+        if values_field is not None:
+            for el, size, width in zip(table.field(values_field), sizes, self.widths):
+                pos = el.field_pos(1)
+                # skip offset to [ubyte], its size and FlexBuffer vector size
+                pos += FlatBuffer.decode_u32(encoded, pos) + 4 + width
+                self.value_packers.append(
+                    (pos, struct.Struct(f"<{size}{'b' if width == 1 else 'h'}"))
+                )
+
+    def fill(self, request_id, values=()):
+        """Patch the request id and values (sequence of sequences of int in
+        the same order and with the same sizes as when the template was
+        created), and return the encoded message, or None if a value doesn't
+        fit in 8-bit elements. The bytearray is reused by the next call.
+        """
+        FlatBuffer.STRUCT_U32.pack_into(self.buf, self.request_id_pos, request_id)
+        for (pos, packer), value, width in zip(self.value_packers, values, self.widths):
+            try:
+                packer.pack_into(self.buf, pos, *value)
+            except struct.error:
+                if width == 1:
+                    return None
+                # out of int16 range: keep 16 lsb like FlexBuffer encoder
+                packer.pack_into(self.buf, pos,
+                                 *[(((x & 0xffff) ^ 0x8000) - 0x8000) for x in value])
+        return self.buf
+
+
 class Node(Listener):
 
+    # maximum number of message templates kept per node
+    MAX_MSG_TEMPLATES = 32
+
     def __init__(self, thymio, properties):
         super(Node, self).__init__()
 
         self.thymio = thymio
+        self.msg_templates = {}
+        self.props = None
         self.set_properties(properties)
         self.vm_description = None
+        # timestamp of the last VariablesChanged message, set by the TDM
+        self.variables_timestamp = None
 
     def set_properties(self, properties):
+        if (self.props is not None
+                and (properties["node_id"] != self.props["node_id"]
+                     or properties.get("group_id") != self.props.get("group_id"))):
+            # templates contain the target id
+            self.msg_templates.clear()
         self.props = properties
         self.id = properties["node_id"]
         self.id_str = properties["node_id_str"]
@@ -190,17 +339,41 @@ class Node(Listener):
             )
         ), ThymioFB.SCHEMA)
 
-    def create_msg_watch_node(self, flags, **kwargs):
-        return ThymioFB.create_message((
-            ThymioFB.MESSAGE_TYPE_WATCH_NODE,
-            (
-                self.thymio.next_request_id(**kwargs),
+    def get_msg_template(self, key, create_msg, values_field=None,
+                         min_widths=None):
+        """Get the message template for key, or create it with the message
+        returned by create_msg(). A new template is always created if
+        min_widths is not None.
+        """
+        template = self.msg_templates.get(key)
+        if template is None or min_widths is not None:
+            if len(self.msg_templates) >= self.MAX_MSG_TEMPLATES:
+                self.msg_templates.clear()
+            template = MessageTemplate(create_msg(), values_field, min_widths,
+                                       self.thymio.typed_vectors)
+            self.msg_templates[key] = template
+        return template
+
+    def create_msg_watch_node(self, flags, reuse_buffer=False, **kwargs):
+        """Create a WatchNode message. If reuse_buffer is True, return a
+        bytearray which is overwritten by the next message of the same kind.
+        """
+        request_id = self.thymio.next_request_id(**kwargs)
+        template = self.get_msg_template(
+            (ThymioFB.MESSAGE_TYPE_WATCH_NODE, flags),
+            lambda: (
+                ThymioFB.MESSAGE_TYPE_WATCH_NODE,
                 (
-                    self.id,
-                ),
-                flags
+                    request_id,
+                    (
+                        self.id,
+                    ),
+                    flags
+                )
             )
-        ), ThymioFB.SCHEMA)
+        )
+        msg = template.fill(request_id)
+        return msg if reuse_buffer else bytes(msg)
 
     def create_msg_register_events(self, events, **kwargs):
         return ThymioFB.create_message((
@@ -221,41 +394,59 @@ class Node(Listener):
             )
         ), ThymioFB.SCHEMA)
 
-    def create_msg_send_events(self, event_dict, **kwargs):
-        return ThymioFB.create_message((
-            ThymioFB.MESSAGE_TYPE_SEND_EVENTS,
-            (
-                self.thymio.next_request_id(**kwargs),
-                (
-                    self.props["group_id"],
-                ),
-                [
-                    (
-                        name,
-                        event_dict[name],
-                    )
-                    for name in event_dict
-                ]
-            )
-        ), ThymioFB.SCHEMA)
+    def create_msg_named_values(self, message_type, id, value_dict,
+                                reuse_buffer, **kwargs):
+        """Create a message of type SetVariables or SendEvents from a template
+        specific to the names and sizes of the values.
+        """
+        request_id = self.thymio.next_request_id(**kwargs)
+        values = value_dict.values()
 
-    def create_msg_set_variables(self, var_dict, **kwargs):
-        return ThymioFB.create_message((
-            ThymioFB.MESSAGE_TYPE_SET_VARIABLES,
-            (
-                self.thymio.next_request_id(**kwargs),
+        def create_msg():
+            return (
+                message_type,
                 (
-                    self.id,
-                ),
-                [
+                    request_id,
                     (
-                        name,
-                        var_dict[name],
-                    )
-                    for name in var_dict
-                ]
+                        id,
+                    ),
+                    [
+                        (
+                            name,
+                            value_dict[name],
+                        )
+                        for name in value_dict
+                    ]
+                )
             )
-        ), ThymioFB.SCHEMA)
+
+        key = (message_type, tuple(value_dict), tuple(len(value) for value in values))
+        template = self.get_msg_template(key, create_msg, values_field=2)
+        msg = template.fill(request_id, values)
+        if msg is None:
+            # some values don't fit anymore in 8 bits: wider template
+            template = self.get_msg_template(key, create_msg, values_field=2,
+                                             min_widths=template.widths)
+            msg = template.fill(request_id, values)
+        return msg if reuse_buffer else bytes(msg)
+
+    def create_msg_send_events(self, event_dict, reuse_buffer=False, **kwargs):
+        """Create a SendEvents message. If reuse_buffer is True, return a
+        bytearray which is overwritten by the next message with the same
+        event names and sizes.
+        """
+        return self.create_msg_named_values(ThymioFB.MESSAGE_TYPE_SEND_EVENTS,
+                                            self.props["group_id"], event_dict,
+                                            reuse_buffer, **kwargs)
+
+    def create_msg_set_variables(self, var_dict, reuse_buffer=False, **kwargs):
+        """Create a SetVariables message. If reuse_buffer is True, return a
+        bytearray which is overwritten by the next message with the same
+        variable names and sizes.
+        """
+        return self.create_msg_named_values(ThymioFB.MESSAGE_TYPE_SET_VARIABLES,
+                                            self.id, var_dict,
+                                            reuse_buffer, **kwargs)
 
 
 class ThymioFB(Listener):
@@ -351,31 +542,156 @@ class ThymioFB(Listener):
     VM_EXECUTION_STATE_RUNNING = 1
     VM_EXECUTION_STATE_PAUSED = 2
 
-    def __init__(self, debug=0):
+    DEFAULT_MAX_PENDING_REQUESTS = 1000
+
+    def __init__(self, debug=0, array_type=None, typed_vectors=False,
+                 request_timeout=None,
+                 max_pending_requests=DEFAULT_MAX_PENDING_REQUESTS):
+        """Arguments (all are optional):
+            debug - debug level (default: 0)
+            array_type - type of variable and event values: None for lists,
+            "array" for array.array or "numpy" for numpy arrays (default: None)
+            typed_vectors - True to send variable and event values as typed
+            FlexBuffer vectors, which are smaller but not accepted by all
+            versions of the TDM (default: False)
+            request_timeout - default time in seconds to wait for the reply to
+            a request, or None to wait forever (default: None)
+            max_pending_requests - maximum number of requests waiting for
+            their reply, beyond which the oldest one is discarded, or None for
+            no limit (default: 1000)
+        """
         super(ThymioFB, self).__init__()
 
         self.debug = debug
+        self.array_type = array_type
+        self.typed_vectors = typed_vectors
+        self.request_timeout = request_timeout
+        self.max_pending_requests = max_pending_requests
 
         self.protocol_version = None
         self.localhost_peer = None
         self.nodes = []
+        # indexes of self.nodes, updated by index_nodes()
+        self.node_by_id = {}  # id (bytes): node
+        self.node_by_id_str = {}  # id (str): node
+        self.nodes_by_group_id = {}  # group id (bytes): list of nodes
+        self.nodes_by_name = {}  # name: list of nodes
         self.last_request_id = 0
+        # request_id_notify_dict[request_id] = fun(result) for pending requests
         self.request_id_notify_dict = {}
+        # request_time_dict[request_id] = (time sent, deadline or None)
+        self.request_time_dict = {}
+        # earliest deadline of pending requests, or None
+        self.next_request_deadline = None
+        # counters of requests with notification
+        self.request_counts = {
+            "sent": 0,
+            "completed": 0,
+            "timed_out": 0,
+            "cancelled": 0,
+            "discarded": 0,
+        }
 
         # on_nodes_changed(node_list)
         self.on_nodes_changed = None
 
+        # message_handlers[message_type] = fun(msg_view) or None to ignore
+        self.message_handlers = self.default_message_handlers()
+
     def create_node(self, node_dict):
         """Create a Node object, of class Node or a subclass.
         """
         return Node(self, node_dict)
 
-    def next_request_id(self, request_id_notify=None):
+    def next_request_id(self, request_id_notify=None, request_timeout=None):
+        """Get a new request id. If request_id_notify is not None, it's called
+        with the reply, or with a RequestTimeoutError object if there is no
+        reply within request_timeout seconds (default: self.request_timeout).
+        """
         self.last_request_id += 1
         if request_id_notify is not None:
+            if (self.max_pending_requests is not None
+                    and len(self.request_id_notify_dict) >= self.max_pending_requests):
+                # discard the oldest pending request
+                request_id = next(iter(self.request_id_notify_dict))
+                self.request_counts["discarded"] += 1
+                self.pop_request_notify(request_id)(RequestTimeoutError(request_id))
+            if request_timeout is None:
+                request_timeout = self.request_timeout
+            t = monotonic()
+            deadline = t + request_timeout if request_timeout is not None else None
+            if deadline is not None and (self.next_request_deadline is None
+                                         or deadline < self.next_request_deadline):
+                self.next_request_deadline = deadline
             self.request_id_notify_dict[self.last_request_id] = request_id_notify
+            self.request_time_dict[self.last_request_id] = (t, deadline)
+            self.request_counts["sent"] += 1
         return self.last_request_id
 
+    def pop_request_notify(self, request_id):
+        """Remove a pending request and return its notification function,
+        or None if it isn't pending.
+        """
+        self.request_time_dict.pop(request_id, None)
+        return self.request_id_notify_dict.pop(request_id, None)
+
+    def notify_request(self, request_id, result):
+        """Remove a pending request and notify it with the result of its
+        reply. Return False if it isn't pending.
+        """
+        notify = self.pop_request_notify(request_id)
+        if notify is None:
+            return False
+        self.request_counts["completed"] += 1
+        notify(result)
+        return True
+
+    def cancel_request(self, request_id):
+        """Remove a pending request without notifying it, e.g. because
+        nobody waits for its reply anymore. Return False if it isn't pending.
+        """
+        if self.pop_request_notify(request_id) is None:
+            return False
+        self.request_counts["cancelled"] += 1
+        return True
+
+    def expire_requests(self):
+        """Notify pending requests whose deadline has passed with a
+        RequestTimeoutError object and remove them. Return their number.
+        """
+        if self.next_request_deadline is None:
+            return 0
+        now = monotonic()
+        if now < self.next_request_deadline:
+            return 0
+        expired = []
+        self.next_request_deadline = None
+        for request_id, (_, deadline) in self.request_time_dict.items():
+            if deadline is not None:
+                if deadline <= now:
+                    expired.append(request_id)
+                elif self.next_request_deadline is None or deadline < self.next_request_deadline:
+                    self.next_request_deadline = deadline
+        for request_id in expired:
+            notify = self.pop_request_notify(request_id)
+            if notify is not None:
+                self.request_counts["timed_out"] += 1
+                notify(RequestTimeoutError(request_id))
+        return len(expired)
+
+    def pending_request_stats(self):
+        """Get a dict with the number of pending requests ("pending"), the
+        time in seconds since the oldest one was sent ("oldest_age", or None),
+        and counters of requests sent, completed, timed out, cancelled and
+        discarded.
+        """
+        oldest = next(iter(self.request_time_dict.values()), None)
+        return {
+            "pending": len(self.request_id_notify_dict),
+            "oldest_age": monotonic() - oldest[0] if oldest is not None else None,
+            **self.request_counts,
+        }
+
     SCHEMA = """
         // see https://github.com/Mobsya/aseba/blob/master/aseba/flatbuffers/thymio.fbs
         // root object: union AnyMessage
@@ -524,12 +840,12 @@ class ThymioFB(Listener):
 
     @staticmethod
     def create_message(msg, schema=None):
-        fb = FlatBuffer()
         if schema is None:
+            fb = FlatBuffer()
             fb.load_from_native_type(msg)
+            encoded_fb = fb.encode()
         else:
-            fb.load_with_schema(msg, schema)
-        encoded_fb = fb.encode()
+            encoded_fb = FlatBuffer.encode_with_schema(msg, schema)
 
         return encoded_fb
 
@@ -616,226 +932,363 @@ class ThymioFB(Listener):
             )
         ), ThymioFB.SCHEMA)
 
-    def find_node(self, node_id_str):
+    def index_nodes(self):
+        """Update the indexes of self.nodes used to find nodes by id,
+        group id or name.
+        """
+        self.node_by_id = {}
+        self.node_by_id_str = {}
+        self.nodes_by_group_id = {}
+        self.nodes_by_name = {}
         for node in self.nodes:
-            if node.id_str == node_id_str:
-                return node
+            self.node_by_id[node.id] = node
+            self.node_by_id_str[node.id_str] = node
+            group_id = node.props.get("group_id")
+            if group_id not in self.nodes_by_group_id:
+                self.nodes_by_group_id[group_id] = []
+            self.nodes_by_group_id[group_id].append(node)
+            name = node.props.get("name")
+            if name not in self.nodes_by_name:
+                self.nodes_by_name[name] = []
+            self.nodes_by_name[name].append(node)
+
+    def find_node(self, node_id):
+        """Find a node by id (string or bytes), or return None.
+        """
+        if isinstance(node_id, str):
+            return self.node_by_id_str.get(node_id)
+        return self.node_by_id.get(bytes(node_id))
+
+    def find_nodes(self, node_id=None, node_name=None, group_id=None):
+        """Find the nodes matching id (string or bytes), name and group id
+        (string or bytes), all optional, in the order of self.nodes.
+        """
+        if isinstance(group_id, str):
+            group_id = ThymioFB.id_str_to_bytes(group_id)
+        if node_id is not None:
+            node = self.find_node(node_id)
+            nodes = [node] if node is not None else []
+        elif node_name is not None:
+            nodes = self.nodes_by_name.get(node_name, [])
+        elif group_id is not None:
+            nodes = self.nodes_by_group_id.get(group_id, [])
+        else:
+            nodes = self.nodes
+        return [
+            node
+            for node in nodes
+            if ((node_name is None or node.props.get("name") == node_name)
+                and (group_id is None or node.props.get("group_id") == group_id))
+        ]
+
+    @staticmethod
+    def id_to_bytes(f):
+        """Convert a decoded NodeId field to bytes.
+        """
+        if f is None:
+            return None
+        b = f[0].fields[0][0]
+        return b"".join(b) if isinstance(b, list) else bytes(b)
+
+    # id_str_cache[id] = id string, for ids (bytes) converted recently
+    id_str_cache = {}
+    ID_STR_CACHE_SIZE = 1024
+
+    @staticmethod
+    def id_bytes_to_str(b):
+        """Convert an id (bytes) to a string, with a cache, or return None
+        if b is None (missing id field).
+        """
+        if b is None:
+            return None
+        id_str = ThymioFB.id_str_cache.get(b)
+        if id_str is None:
+            h = b.hex()
+            id_str = h[:8] + "-" + h[8:12] + "-" + h[12:16] + "-" + h[16:20] + "-" + h[20:]
+            if len(ThymioFB.id_str_cache) >= ThymioFB.ID_STR_CACHE_SIZE:
+                ThymioFB.id_str_cache.clear()
+            ThymioFB.id_str_cache[b] = id_str
+        return id_str
 
     @staticmethod
     def bytes_to_id_str(f):
         if f is None:
             return None
         else:
-            str = "".join([f"{b if type(b) is int else ord(b):02x}" for b in f[0].fields[0][0]])
-            str = str[:8] + "-" + str[8:12] + "-" + str[12:16] + "-" + str[16:20] + "-" + str[20:]
-            return str
+            return ThymioFB.id_bytes_to_str(ThymioFB.id_to_bytes(f))
 
     @staticmethod
     def id_str_to_bytes(id_str):
-        id_str = id_str.replace("-", "")
-        b = []
-        for i in range(0, len(id_str), 2):
-            b.append(int(id_str[i : i + 2], 16))
-        return bytes(b)
+        return bytes.fromhex(id_str.replace("-", ""))
+
+    def decode_values(self, named_values):
+        """Decode the FlexBuffer values of a TableView of type T(sx) (variable
+        or event) to the type specified by self.array_type.
+        """
+        buf = named_values.buf
+        pos = named_values.field_pos(1)
+        if pos is None:
+            return None
+        vec_pos = pos + FlatBuffer.decode_u32(buf, pos)
+        vec_len = FlatBuffer.decode_u32(buf, vec_pos)
+        return FlexBuffer.parse(buf[vec_pos + 4 : vec_pos + 4 + vec_len], self.array_type)
+
+    def default_message_handlers(self):
+        """Get a dict of the default handlers of incoming messages by type
+        (None to ignore messages of that type).
+        """
+        return {
+            self.MESSAGE_TYPE_PING: None,
+            self.MESSAGE_TYPE_CONNECTION_HANDSHAKE: self.process_msg_connection_handshake,
+            self.MESSAGE_TYPE_NODES_CHANGED: self.process_msg_nodes_changed,
+            self.MESSAGE_TYPE_NODE_ASEBA_VM_DESCRIPTION: self.process_msg_node_aseba_vm_description,
+            self.MESSAGE_TYPE_REQUEST_COMPLETED: self.process_msg_request_completed,
+            self.MESSAGE_TYPE_ERROR: self.process_msg_error,
+            self.MESSAGE_TYPE_COMPILATION_RESULT_FAILURE: self.process_msg_compilation_result_failure,
+            self.MESSAGE_TYPE_COMPILATION_RESULT_SUCCESS: self.process_msg_compilation_result_success,
+            self.MESSAGE_TYPE_VARIABLES_CHANGED: self.process_msg_variables_changed,
+            self.MESSAGE_TYPE_EVENTS_DESCRIPTIONS_CHANGED: self.process_msg_events_descriptions_changed,
+            self.MESSAGE_TYPE_EVENTS_EMITTED: self.process_msg_events_emitted,
+            self.MESSAGE_TYPE_VM_EXECUTION_STATE_CHANGED: self.process_msg_vm_execution_state_changed,
+            self.MESSAGE_TYPE_SCRATCHPAD_UPDATE: self.process_msg_scratchpad_update,
+        }
+
+    def set_message_handler(self, message_type, handler):
+        """Set the function handler(msg_view) called for incoming messages
+        of the specified type, or None to ignore them, and return the
+        previous handler. msg_view is the message content as a TableView.
+        """
+        previous_handler = self.message_handlers.get(message_type)
+        self.message_handlers[message_type] = handler
+        return previous_handler
+
+    def reset_message_handler(self, message_type):
+        """Restore the default handler of messages of the specified type.
+        """
+        default_handlers = self.default_message_handlers()
+        if message_type in default_handlers:
+            self.message_handlers[message_type] = default_handlers[message_type]
+        elif message_type in self.message_handlers:
+            del self.message_handlers[message_type]
+
+    def process_unknown_message(self, message_type, msg_view):
+        """Process an incoming message without handler.
+        """
+        print(f"Got unprocessed message {message_type}")
 
     def process_message(self, msg):
 
         fb = FlatBuffer()
-        fb.parse(msg, ThymioFB.SCHEMA)
+        # decode lazily only the fields used by the handlers
+        fb.parse(msg, ThymioFB.SCHEMA, lazy=True)
         if self.debug >= 2:
             fb.dump("Receive")
-        if type(fb.root) is Union:
-            if fb.root.union_type == self.MESSAGE_TYPE_PING:
-                pass
-            elif fb.root.union_type == self.MESSAGE_TYPE_CONNECTION_HANDSHAKE:
-                self.protocol_version = FlatBuffer.field_val(fb.root.union_data[0].fields[1], 1)
-                self.localhost_peer = FlatBuffer.field_val(fb.root.union_data[0].fields[4], False)
-            elif fb.root.union_type == self.MESSAGE_TYPE_NODES_CHANGED:
-                if fb.root.union_data[0] is not None:
-                    nodes = fb.root.union_data[0].fields[0][0]
-                    for node in nodes:
-                        node_id_str = ThymioFB.bytes_to_id_str(node.fields[0])
-                        node_properties = {
-                            "node_id":
-                                None if node.fields[0] is None
-                                else node.fields[0][0].fields[0][0] if type(node.fields[0][0].fields[0][0]) is bytes
-                                else b"".join(node.fields[0][0].fields[0][0]),
-                            "node_id_str": ThymioFB.bytes_to_id_str(node.fields[0]),
-                            "group_id":
-                                None if node.fields[1] is None
-                                else node.fields[1][0].fields[0][0] if type(node.fields[1][0].fields[0][0]) is bytes
-                                else b"".join(node.fields[1][0].fields[0][0]),
-                            "group_id_str": ThymioFB.bytes_to_id_str(node.fields[1]),
-                            "status": FlatBuffer.field_val(node.fields[2], -1),
-                            "type": FlatBuffer.field_val(node.fields[3], -1),
-                            "name": FlatBuffer.field_val(node.fields[4], ""),
-                            "capabilities": FlatBuffer.field_val(node.fields[5], 0),
-                            "fw_version": FlatBuffer.field_val(node.fields[6], None),
-                        }
-                        existing_node = self.find_node(node_id_str)
-                        if existing_node is not None:
-                            existing_node.set_properties(node_properties)
-                        else:
-                            self.nodes.append(self.create_node(node_properties))
-                    if self.on_nodes_changed is not None:
-                        self.on_nodes_changed(self.nodes)
-                    if self.debug >= 1:
-                        print("NodesChanged",
-                              ", ".join(f"{node.id_str}: status={node.status}" for node in self.nodes))
-            elif fb.root.union_type == self.MESSAGE_TYPE_NODE_ASEBA_VM_DESCRIPTION:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                vm_descr = fb.root.union_data[0]
-                node_id_str = ThymioFB.bytes_to_id_str(vm_descr.fields[1])
-                node = self.find_node(node_id_str)
-                vm_description = {
-                    "node_id":
-                        None if vm_descr.fields[1] is None
-                        else vm_descr.fields[1][0].fields[0][0] if type(vm_descr.fields[1][0].fields[0][0]) is bytes
-                        else b"".join(vm_descr.fields[1][0].fields[0][0]),
-                    "node_id_str": node_id_str,
-                    "bytecode_size": FlatBuffer.field_val(vm_descr.fields[2], None),
-                    "data_size": FlatBuffer.field_val(vm_descr.fields[3], None),
-                    "stack_size": FlatBuffer.field_val(vm_descr.fields[4], None),
-                    "variables": {
-                        FlatBuffer.field_val(var_descr.fields[1], ""):
-                            (lambda s: None if s == 1 else s)(FlatBuffer.field_val(var_descr.fields[2], None))
-                        for var_descr in vm_descr.fields[5][0]
-                    },
-                    "events": [
-                        FlatBuffer.field_val(event_descr.fields[1], "")
-                        for event_descr in vm_descr.fields[6][0]
-                    ],
-                    "functions": {
-                        FlatBuffer.field_val(fun_descr.fields[1], ""): [
-                            FlatBuffer.field_val(param.fields[1], None)
-                            for param in fun_descr.fields[3][0]
-                        ]
-                        for fun_descr in vm_descr.fields[7][0]
-                    },
-                }
-                if node is not None:
-                    node.vm_description = vm_description
-                if request_id in self.request_id_notify_dict:
-                    self.request_id_notify_dict[request_id](vm_description)
-                elif self.debug >= 1:
-                    print(f"vm description request_id={request_id} (ignored)")
-            elif fb.root.union_type == self.MESSAGE_TYPE_REQUEST_COMPLETED:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                if request_id in self.request_id_notify_dict:
-                    self.request_id_notify_dict[request_id](None)
-                    del self.request_id_notify_dict[request_id]
-                    if self.debug >= 1:
-                        print("ok")
-                elif self.debug >= 1:
-                    print(f"ok request_id={request_id} (ignored)")
-            elif fb.root.union_type == self.MESSAGE_TYPE_ERROR:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                error_code = FlatBuffer.field_val(fb.root.union_data[0].fields[1], 0)
-                if request_id in self.request_id_notify_dict:
-                    self.request_id_notify_dict[request_id]({"error_code": error_code})
-                    del self.request_id_notify_dict[request_id]
-                    if self.debug >= 1:
-                        print(f"error {error_code}")
-                elif self.debug >= 1:
-                    print(f"error {error_code} request_id={request_id} (ignored)")
-            elif fb.root.union_type == self.MESSAGE_TYPE_COMPILATION_RESULT_FAILURE:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                error_msg = FlatBuffer.field_val(fb.root.union_data[0].fields[1], "")
-                error_line = FlatBuffer.field_val(fb.root.union_data[0].fields[3], 0)
-                error_col = FlatBuffer.field_val(fb.root.union_data[0].fields[4], 0)
-                if request_id in self.request_id_notify_dict:
-                    self.request_id_notify_dict[request_id]({
-                        "error_msg": error_msg,
-                        "error_line": error_line,
-                        "error_col": error_col,
-                    })
-                    del self.request_id_notify_dict[request_id]
-                    if self.debug >= 1:
-                        print(f"compilation error: {error_msg}")
-                elif self.debug >= 1:
-                    print(f"compilation error: {error_msg} request_id={request_id} (ignored)")
-            elif fb.root.union_type == self.MESSAGE_TYPE_COMPILATION_RESULT_SUCCESS:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                if request_id in self.request_id_notify_dict:
-                    self.request_id_notify_dict[request_id](None)
-                    del self.request_id_notify_dict[request_id]
-                    if self.debug >= 1:
-                        print("compilation ok")
-                elif self.debug >= 1:
-                    print(f"compilation ok request_id={request_id} (ignored)")
-            elif fb.root.union_type == self.MESSAGE_TYPE_VARIABLES_CHANGED:
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[0])
-                node = self.find_node(node_id_str)
-                variables = {
-                    v.fields[0][0]: v.fields[1][0]
-                    for v in fb.root.union_data[0].fields[1][0]
-                    if v.fields[1][0] is not None
+        if type(fb.root) is UnionView:
+            message_type = fb.root.union_type
+            msg_view = fb.root.union_data[0] if fb.root.union_data is not None else None
+            if message_type in self.message_handlers:
+                handler = self.message_handlers[message_type]
+                if handler is not None:
+                    handler(msg_view)
+            else:
+                self.process_unknown_message(message_type, msg_view)
+
+    def process_msg_connection_handshake(self, msg_view):
+        self.protocol_version = FlatBuffer.field_val(msg_view.fields[1], 1)
+        self.localhost_peer = FlatBuffer.field_val(msg_view.fields[4], False)
+
+    def process_msg_nodes_changed(self, msg_view):
+        if msg_view is not None:
+            nodes = msg_view.fields[0][0]
+            for node in nodes:
+                node_id = ThymioFB.id_to_bytes(node.fields[0])
+                node_properties = {
+                    "node_id": node_id,
+                    "node_id_str": ThymioFB.id_bytes_to_str(node_id),
+                    "group_id": ThymioFB.id_to_bytes(node.fields[1]),
+                    "group_id_str": ThymioFB.bytes_to_id_str(node.fields[1]),
+                    "status": FlatBuffer.field_val(node.fields[2], -1),
+                    "type": FlatBuffer.field_val(node.fields[3], -1),
+                    "name": FlatBuffer.field_val(node.fields[4], ""),
+                    "capabilities": FlatBuffer.field_val(node.fields[5], 0),
+                    "fw_version": FlatBuffer.field_val(node.fields[6], None),
                 }
-                self.notify_variables_changed(node, variables)
-                if node is not None:
-                    node.notify_variables_changed(node, variables)
-                if self.debug >= 1:
-                    print(f"variables of node {node_id_str} changed")
-                    if self.debug >= 2:
-                        for name in variables:
-                            print(name, variables[name])
-            elif fb.root.union_type == self.MESSAGE_TYPE_EVENTS_DESCRIPTIONS_CHANGED:
-                node_or_group_id = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[0])
-                if fb.root.union_data[0].fields[1] is not None:
-                    event_size = {
-                        e.fields[0][0]: FlatBuffer.field_val(e.fields[1], 0)
-                        for e in fb.root.union_data[0].fields[1][0]
-                    }
-                    event_index = {
-                        e.fields[0][0]: FlatBuffer.field_val(e.fields[2], 0)
-                        for e in fb.root.union_data[0].fields[1][0]
-                    }
+                existing_node = self.node_by_id.get(node_id)
+                if existing_node is not None:
+                    existing_node.set_properties(node_properties)
                 else:
-                    event_size = []
-                    event_index = []
-                if self.debug >= 1:
-                    print(f"event sizes of node or group {node_or_group_id} changed")
-                    if self.debug >= 2:
-                        print("\n".join([
-                            f"{name}[{event_size[name]}]" for name in event_size
-                        ]))
-            elif fb.root.union_type == self.MESSAGE_TYPE_EVENTS_EMITTED:
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[0])
-                node = self.find_node(node_id_str)
-                events = {
-                    e.fields[0][0]: e.fields[1][0]
-                    for e in fb.root.union_data[0].fields[1][0]
-                }
-                self.notify_events_received(node, events)
-                node.notify_events_received(node, events)
-                if self.debug >= 1:
-                    print(f"events emitted by node {node_id_str}")
-                    if self.debug >= 2:
-                        for name in events:
-                            print(name,
-                                  events[name] if events[name] is not None else "")
-            elif fb.root.union_type == self.MESSAGE_TYPE_VM_EXECUTION_STATE_CHANGED:
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[0])
-                node = self.find_node(node_id_str)
-                state = FlatBuffer.field_val(fb.root.union_data[0].fields[1], 0)
-                line = FlatBuffer.field_val(fb.root.union_data[0].fields[2], 0)
-                error = FlatBuffer.field_val(fb.root.union_data[0].fields[3], 0)
-                error_msg = FlatBuffer.field_val(fb.root.union_data[0].fields[4], "")
-                self.notify_vm_state_changed(node, state, line, error, error_msg)
-                node.notify_vm_state_changed(node, state, line, error, error_msg)
-                if self.debug >= 1:
-                    print(f"execution state of node {node_id_str} changed to {state}, line={line}, error={error} {error_msg}")
-            elif fb.root.union_type == self.MESSAGE_TYPE_SCRATCHPAD_UPDATE:
-                request_id = FlatBuffer.field_val(fb.root.union_data[0].fields[0], 0)
-                scratchpad_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[1])
-                group_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[2])
-                node_id_str = ThymioFB.bytes_to_id_str(fb.root.union_data[0].fields[3])
-                language = FlatBuffer.field_val(fb.root.union_data[0].fields[4], self.PROGRAMMING_LANGUAGE_ASEBA)
-                text = FlatBuffer.field_val(fb.root.union_data[0].fields[5], "")
-                name = FlatBuffer.field_val(fb.root.union_data[0].fields[6], "")
-                deleted = FlatBuffer.field_val(fb.root.union_data[0].fields[7], False)
-                if self.debug >= 1:
-                    print(f"scratchpad {scratchpad_id_str} of node {node_id_str} / group {group_id_str} updated")
-                    print(text)
-            else:
-                print(f"Got unprocessed message {fb.root.union_type}")
+                    new_node = self.create_node(node_properties)
+                    self.nodes.append(new_node)
+                    # index now in case the same id appears twice
+                    self.node_by_id[node_id] = new_node
+            self.index_nodes()
+            if self.on_nodes_changed is not None:
+                self.on_nodes_changed(self.nodes)
+            if self.debug >= 1:
+                print("NodesChanged",
+                      ", ".join(f"{node.id_str}: status={node.status}" for node in self.nodes))
+
+    def process_msg_node_aseba_vm_description(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        vm_descr = msg_view
+        node_id = ThymioFB.id_to_bytes(vm_descr.fields[1])
+        node_id_str = ThymioFB.id_bytes_to_str(node_id)
+        node = self.node_by_id.get(node_id)
+        vm_description = {
+            "node_id": node_id,
+            "node_id_str": node_id_str,
+            "bytecode_size": FlatBuffer.field_val(vm_descr.fields[2], None),
+            "data_size": FlatBuffer.field_val(vm_descr.fields[3], None),
+            "stack_size": FlatBuffer.field_val(vm_descr.fields[4], None),
+            "variables": {
+                FlatBuffer.field_val(var_descr.fields[1], ""):
+                    (lambda s: None if s == 1 else s)(FlatBuffer.field_val(var_descr.fields[2], None))
+                for var_descr in vm_descr.fields[5][0]
+            },
+            "events": [
+                FlatBuffer.field_val(event_descr.fields[1], "")
+                for event_descr in vm_descr.fields[6][0]
+            ],
+            "functions": {
+                FlatBuffer.field_val(fun_descr.fields[1], ""): [
+                    FlatBuffer.field_val(param.fields[1], None)
+                    for param in fun_descr.fields[3][0]
+                ]
+                for fun_descr in vm_descr.fields[7][0]
+            },
+        }
+        if node is not None:
+            node.vm_description = vm_description
+        if not self.notify_request(request_id, vm_description) and self.debug >= 1:
+            print(f"vm description request_id={request_id} (ignored)")
+
+    def process_msg_request_completed(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        if self.notify_request(request_id, None):
+            if self.debug >= 1:
+                print("ok")
+        elif self.debug >= 1:
+            print(f"ok request_id={request_id} (ignored)")
+
+    def process_msg_error(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        error_code = FlatBuffer.field_val(msg_view.fields[1], 0)
+        if self.notify_request(request_id, {"error_code": error_code}):
+            if self.debug >= 1:
+                print(f"error {error_code}")
+        elif self.debug >= 1:
+            print(f"error {error_code} request_id={request_id} (ignored)")
+
+    def process_msg_compilation_result_failure(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        error_msg = FlatBuffer.field_val(msg_view.fields[1], "")
+        error_line = FlatBuffer.field_val(msg_view.fields[3], 0)
+        error_col = FlatBuffer.field_val(msg_view.fields[4], 0)
+        if self.notify_request(request_id, {
+                    "error_msg": error_msg,
+                    "error_line": error_line,
+                    "error_col": error_col,
+                }):
+            if self.debug >= 1:
+                print(f"compilation error: {error_msg}")
+        elif self.debug >= 1:
+            print(f"compilation error: {error_msg} request_id={request_id} (ignored)")
+
+    def process_msg_compilation_result_success(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        if self.notify_request(request_id, None):
+            if self.debug >= 1:
+                print("compilation ok")
+        elif self.debug >= 1:
+            print(f"compilation ok request_id={request_id} (ignored)")
+
+    def process_msg_variables_changed(self, msg_view):
+        node_id = ThymioFB.id_to_bytes(msg_view.fields[0])
+        node = self.node_by_id.get(node_id)
+        variables = {
+            v.field(0): value
+            for v in msg_view.fields[1][0]
+            for value in (self.decode_values(v),)
+            if value is not None
+        }
+        if node is not None:
+            node.variables_timestamp = FlatBuffer.field_val(msg_view.fields[2], None)
+        self.notify_variables_changed(node, variables)
+        if node is not None:
+            node.notify_variables_changed(node, variables)
+        if self.debug >= 1:
+            print(f"variables of node {ThymioFB.id_bytes_to_str(node_id)} changed")
+            if self.debug >= 2:
+                for name in variables:
+                    print(name, variables[name])
+
+    def process_msg_events_descriptions_changed(self, msg_view):
+        node_or_group_id = ThymioFB.bytes_to_id_str(msg_view.fields[0])
+        if msg_view.fields[1] is not None:
+            event_size = {
+                e.fields[0][0]: FlatBuffer.field_val(e.fields[1], 0)
+                for e in msg_view.fields[1][0]
+            }
+            event_index = {
+                e.fields[0][0]: FlatBuffer.field_val(e.fields[2], 0)
+                for e in msg_view.fields[1][0]
+            }
+        else:
+            event_size = []
+            event_index = []
+        if self.debug >= 1:
+            print(f"event sizes of node or group {node_or_group_id} changed")
+            if self.debug >= 2:
+                print("\n".join([
+                    f"{name}[{event_size[name]}]" for name in event_size
+                ]))
+
+    def process_msg_events_emitted(self, msg_view):
+        node_id = ThymioFB.id_to_bytes(msg_view.fields[0])
+        node = self.node_by_id.get(node_id)
+        if self.debug >= 1:
+            # all events, including those without listener
+            print(f"events emitted by node {ThymioFB.id_bytes_to_str(node_id)}")
+            if self.debug >= 2:
+                for e in msg_view.fields[1][0]:
+                    event_data = self.decode_values(e)
+                    print(e.field(0), event_data if event_data is not None else "")
+        # decode only events expected by listeners
+        names = self.subscribed_event_names(node)
+        if names is not None and node is not None:
+            node_names = node.subscribed_event_names(node)
+            names = names | node_names if node_names is not None else None
+        events = {
+            name: self.decode_values(e)
+            for e in msg_view.fields[1][0]
+            for name in (e.field(0),)
+            if names is None or name in names
+        }
+        self.notify_events_received(node, events)
+        if node is not None:
+            node.notify_events_received(node, events)
+
+    def process_msg_vm_execution_state_changed(self, msg_view):
+        node_id = ThymioFB.id_to_bytes(msg_view.fields[0])
+        node = self.node_by_id.get(node_id)
+        state = FlatBuffer.field_val(msg_view.fields[1], 0)
+        line = FlatBuffer.field_val(msg_view.fields[2], 0)
+        error = FlatBuffer.field_val(msg_view.fields[3], 0)
+        error_msg = FlatBuffer.field_val(msg_view.fields[4], "")
+        self.notify_vm_state_changed(node, state, line, error, error_msg)
+        node.notify_vm_state_changed(node, state, line, error, error_msg)
+        if self.debug >= 1:
+            print(f"execution state of node {ThymioFB.id_bytes_to_str(node_id)} changed to {state}, line={line}, error={error} {error_msg}")
+
+    def process_msg_scratchpad_update(self, msg_view):
+        request_id = FlatBuffer.field_val(msg_view.fields[0], 0)
+        scratchpad_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[1])
+        group_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[2])
+        node_id_str = ThymioFB.bytes_to_id_str(msg_view.fields[3])
+        language = FlatBuffer.field_val(msg_view.fields[4], self.PROGRAMMING_LANGUAGE_ASEBA)
+        text = FlatBuffer.field_val(msg_view.fields[5], "")
+        name = FlatBuffer.field_val(msg_view.fields[6], "")
+        deleted = FlatBuffer.field_val(msg_view.fields[7], False)
+        if self.debug >= 1:
+            print(f"scratchpad {scratchpad_id_str} of node {node_id_str} / group {group_id_str} updated")
+            print(text)
@@ -9,8 +9,9 @@ import sys
 import os
 import getopt
 import re
+from time import monotonic
 
-from tdmclient import ClientAsync
+from tdmclient import ClientAsync, ClientAsyncCacheNode
 from tdmclient.atranspiler import ATranspiler
 from tdmclient.module_thymio import ModuleThymio
 from tdmclient.module_clock import ModuleClock
@@ -21,6 +22,10 @@ def help(**kwargs):
 Run program on robot, from file or stdin
 
 Options:
+  --all          run on all the robots matching --robotid and --robotname
+  --concurrency=N
+                 deploy to at most N robots at the same time with --all
+                 (default: no limit)
   --debug=n      display diagnostic info (0=none, 1=basic, 2=more, 3=verbose)
   --event=N      register custom event without data
   --event=N[S]   register custom event with data of the specified size
@@ -35,6 +40,7 @@ Options:
   --sleep        sleep forever (default with events or print statement)
   --sponly       store program into the TDM without running it
   --stop         stop program (no filename or stdin expected)
+  --timings      display the duration of each deployment stage
   --tdmaddr=H    tdm address (default: localhost or from zeroconf)
   --tdmport=P    tdm port (default: 8596 (tcp) or 8597 (ws), or from zeroconf)
   --tdmws        connect to tdm with WebSocket (default: plain TCP)
@@ -57,39 +63,48 @@ def main(argv=None, tdm_transport=None):
     password = None
     robot_id = None
     robot_name = None
+    all_robots = False
+    concurrency = None
+    timings = False
     events = []
     event_re = re.compile(r"^([^[]*)(\[([0-9]]*)\])?")
     sleep = None  # True to sleep forever, False to exit immediately
     import_thymio = True
 
     print_statements = []
-    exit_received = None  # or exit status once received, or 1 if vm error
+    nodes = []
+    # exit_received[node] = exit status once received, or 1 if vm error
+    exit_received = {}
+
+    def prefix(node):
+        # multiple nodes: prefix for output
+        return f"[R{nodes.index(node)}] " if len(nodes) > 1 else ""
 
     def on_event_received(node, event_name, event_data):
         if event_name == "_exit":
-            global exit_received
-            exit_received = event_data[0]
+            exit_received[node] = event_data[0]
         elif event_name == "_print":
             print_id = event_data[0]
             print_format, print_num_args = print_statements[print_id]
             print_args = tuple(event_data[1 : 1 + print_num_args])
             print_str = print_format % print_args
-            print(print_str)
+            print(prefix(node) + print_str)
         else:
-            print(event_name + "".join(["," + str(d) for d in event_data]))
+            print(prefix(node) + event_name + "".join(["," + str(d) for d in event_data]))
 
     def on_vm_state_changed(node, state, line, error, error_msg):
         if error != ClientAsync.ERROR_NO_ERROR:
-            global exit_received
-            exit_received = 1
+            exit_received[node] = 1
         if error_msg:
-            print(f"{error_msg} (line {line}{' in Aseba' if language != 'aseba' else ''})")
+            print(f"{prefix(node)}{error_msg} (line {line}{' in Aseba' if language != 'aseba' else ''})")
 
     if argv is not None:
         try:
             arguments, values = getopt.getopt(argv[1:],
                                               "",
                                               [
+                                                  "all",
+                                                  "concurrency=",
                                                   "debug=",
                                                   "event=",
                                                   "help",
@@ -104,6 +119,7 @@ def main(argv=None, tdm_transport=None):
                                                   "sponly",
                                                   "stop",
                                                   "tdmaddr=",
+                                                  "timings",
                                                   "tdmport=",
                                                   "tdmws",
                                                   "zcall",
@@ -116,6 +132,10 @@ def main(argv=None, tdm_transport=None):
             if arg == "--help":
                 help()
                 return 0
+            elif arg == "--all":
+                all_robots = True
+            elif arg == "--concurrency":
+                concurrency = int(val)
             elif arg == "--debug":
                 debug = int(val)
             elif arg == "--event":
@@ -149,6 +169,8 @@ def main(argv=None, tdm_transport=None):
                 stop = True
             elif arg == "--tdmaddr":
                 tdm_addr = val
+            elif arg == "--timings":
+                timings = True
             elif arg == "--tdmport":
                 tdm_port = ClientAsync.DEFAULT_TDM_PORT if val == "default" else int(val)
             elif arg == "--tdmws":
@@ -222,47 +244,94 @@ def main(argv=None, tdm_transport=None):
                      password=password,
                      debug=debug) as client:
 
+        async def deploy_node(node, node_timings):
+            """Lock node, and stop it or deploy and run the program.
+            Return an error message, or None for success.
+            """
+            t = monotonic()
+            await node.lock()
+            node_timings["lock"] = monotonic() - t
+            locked_nodes.append(node)
+            if stop:
+                error = await node.stop()
+                if error is not None:
+                    return f"Stop error {error['error_code']}"
+                return None
+            if scratchpad < 2:
+                error = await node.deploy(program, events=events,
+                                          watch=sleep, timings=node_timings)
+                if error is not None:
+                    if error["stage"] == "compile":
+                        return f"Compilation error: {error['error_msg']}"
+                    stage_name = {
+                        "register_events": "Event registration",
+                        "watch": "Watch",
+                        "run": "Run",
+                    }.get(error["stage"], error["stage"])
+                    return f"{stage_name} error {error['error_code']}"
+            if scratchpad > 0:
+                error = await node.set_scratchpad(program)
+                if error is not None:
+                    return f"Scratchpad error {error['error_code']}"
+            return None
+
+        locked_nodes = []
+
         async def prog():
             nonlocal status, events, sleep
-            with await client.lock(node_id=robot_id, node_name=robot_name) as node:
-                if stop:
-                    error = await node.stop()
-                    if error is not None:
-                        print(f"Stop error {error['error_code']}")
+            await client.wait_for_status_set({client.NODE_STATUS_AVAILABLE,
+                                              client.NODE_STATUS_BUSY},
+                                             node_id=robot_id, node_name=robot_name)
+            if all_robots:
+                nodes.extend(client.find_nodes(node_id=robot_id, node_name=robot_name))
+            else:
+                nodes.append(client.first_node(node_id=robot_id, node_name=robot_name))
+            if not stop and scratchpad < 2 and len(events) > 0:
+                # same vm for all nodes
+                events = await nodes[0].filter_out_vm_events(events)
+            if sleep is None:
+                sleep = len(events) > 0
+            if not stop and scratchpad < 2 and sleep:
+                if len(events) > 0:
+                    client.add_event_received_listener(on_event_received,
+                                                       names=[event[0] for event in events])
+                client.add_vm_state_changed_listener(on_vm_state_changed)
+
+            try:
+                node_timings = {node: {} for node in nodes}
+                # requests to all nodes are pipelined
+                errors = await client.gather(
+                    *[deploy_node(node, node_timings[node]) for node in nodes],
+                    limit=concurrency,
+                    return_exceptions=True
+                )
+                if timings:
+                    for node in nodes:
+                        print(prefix(node)
+                              + ClientAsyncCacheNode.format_timings(node_timings[node]))
+                running_nodes = []
+                for node, error in zip(nodes, errors):
+                    if error is None:
+                        running_nodes.append(node)
+                    else:
+                        print(prefix(node) + str(error))
                         status = 2
-                else:
-                    if scratchpad < 2:
-                        if len(events) > 0:
-                            events = await node.filter_out_vm_events(events)
-                            await node.register_events(events)
-                            if sleep is None:
-                                sleep = len(events) > 0
-                        error = await node.compile(program)
-                        if error is not None:
-                            print(f"Compilation error: {error['error_msg']}")
-                            status = 2
-                        else:
-                            if sleep:
-                                if len(events) > 0:
-                                    client.add_event_received_listener(on_event_received)
-                                client.add_vm_state_changed_listener(on_vm_state_changed)
-                                await node.watch(events=True, vm_state=True)
-                            error = await node.run()
-                            if error is not None:
-                                print(f"Run error {error['error_code']}")
-                                status = 2
-                    if scratchpad > 0:
-                        error = await node.set_scratchpad(program)
-                        if error is not None:
-                            print(f"Scratchpad error {error['error_code']}")
-                            status = 2
-                    if scratchpad < 2 and sleep:
-                        # expect events: wait forever or until _exit is received
-                        def wake():
-                            return exit_received is not None
-                        await client.sleep(-1, wake)
+                if not stop and scratchpad < 2 and sleep and len(running_nodes) > 0:
+                    # expect events: wait forever or until _exit is received from all nodes
+                    def wake():
+                        return all(node in exit_received for node in running_nodes)
+                    await client.sleep(-1, wake)
+                    for node in running_nodes:
                         await node.stop()
-                        status = exit_received
+                    if status == 0:
+                        status = next(
+                            (exit_received[node] for node in running_nodes
+                             if exit_received[node]),
+                            0
+                        )
+            finally:
+                for node in locked_nodes:
+                    node.send_unlock_node(ignore_disconnected_error=True)
 
         client.run_async_program(prog)
 
@@ -5,20 +5,23 @@
 #
 # SPDX-License-Identifier: BSD-3-Clause
 
-from tdmclient import ClientAsync, ThymioFB
+from tdmclient import ClientAsync, NodeLockError
 import sys
 import getopt
 
 
 def help(**kwargs):
     print(f"""Usage: python3 -m tdmclient sendevent [options]
-Send event to robot
+Send events to robot
 
 Options:
-  --data=val     event data, as an int or array of int (default: empty)
+  --all          send events to all the robots
+  --data=val     event data, as an int or array of int (default: empty), for
+                 the previous --event option (or the first one)
   --debug=n      display diagnostic info
                  (0=none, 1=basic, 2=more (default), 3=verbose)
-  --event=name   event name (required)
+  --event=name   event name (required, can be repeated to send several events
+                 in the same message)
   --help         display this help message and exit
   --password=PWD specify password for remote tdm
   --robotid=I    robot id; default=any
@@ -42,8 +45,9 @@ def main(argv=None, tdm_transport=None):
     password = None
     robot_id = None
     robot_name = None
-    event_name = None
-    event_data = None
+    events = []  # list of [name, data]
+    data_first = None  # data specified before the first event
+    all_nodes = False
     lock_node = True  # current tdm restriction
 
     if argv is not None:
@@ -61,6 +65,7 @@ def main(argv=None, tdm_transport=None):
                                                   "tdmws",
                                                   "zcall",
                                                   "zeroconf",
+                                                  "all",
                                                   "event=",
                                                   "data=",
                                               ])
@@ -90,8 +95,10 @@ def main(argv=None, tdm_transport=None):
             elif arg == "--zcall":
                 zeroconf = True
                 zeroconf_all = True
+            elif arg == "--all":
+                all_nodes = True
             elif arg == "--event":
-                event_name = val
+                events.append([val, None])
             elif arg == "--data":
                 if val[0] == "[" and val[-1] == "]":
                     event_data = [
@@ -100,19 +107,20 @@ def main(argv=None, tdm_transport=None):
                     ]
                 else:
                     event_data = [int(val)]
+                if len(events) > 0:
+                    events[-1][1] = event_data
+                else:
+                    data_first = event_data
 
     if len(values) > 0:
         help(file=sys.stderr)
         return 1
 
-    if event_name is None:
+    if len(events) == 0:
         print("Missing --event option", file=sys.stderr)
-        sys.exit(1)
-        flags = ThymioFB.WATCHABLE_INFO_ALL
-
-    event_dict = {
-        event_name: event_data if event_data is not None else [],
-    }
+        return 1
+    if data_first is not None and events[0][1] is None:
+        events[0][1] = data_first
 
     with ClientAsync(zeroconf=zeroconf, zeroconf_all=zeroconf_all,
                      tdm_addr=tdm_addr, tdm_port=tdm_port, tdm_ws=tdm_ws,
@@ -120,13 +128,38 @@ def main(argv=None, tdm_transport=None):
                      password=password,
                      debug=debug) as client:
 
-        if lock_node:
-            async def prog():
-                with await client.lock(node_id=robot_id, node_name=robot_name) as node:
-                    await node.send_events(event_dict)
-        else:
-            async def prog():
-                node = await client.wait_for_node(node_id=robot_id, node_name=robot_name)
-                await node.send_events(event_dict)
+        locked_nodes = []
 
-        client.run_async_program(prog)
+        async def lock(node):
+            await node.lock()
+            locked_nodes.append(node)
+
+        async def prog():
+            if all_nodes:
+                await client.wait_for_status_set({ClientAsync.NODE_STATUS_AVAILABLE,
+                                                  ClientAsync.NODE_STATUS_BUSY},
+                                                 node_id=robot_id, node_name=robot_name)
+                nodes = client.find_nodes(node_id=robot_id, node_name=robot_name)
+            else:
+                nodes = [await client.wait_for_node(node_id=robot_id, node_name=robot_name)]
+            try:
+                if lock_node:
+                    await client.gather(*[lock(node) for node in nodes])
+                return await client.send_events_batch([
+                    (node, event_name, event_data if event_data is not None else [])
+                    for node in nodes
+                    for event_name, event_data in events
+                ])
+            finally:
+                for node in locked_nodes:
+                    node.send_unlock_node(ignore_disconnected_error=True)
+
+        try:
+            error = client.aw(prog())
+        except NodeLockError as e:
+            print(e, file=sys.stderr)
+            return 2
+        if error is not None:
+            print(f"Error {error['error_code']}", file=sys.stderr)
+            return 2
+    return 0
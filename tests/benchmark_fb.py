@@ -0,0 +1,205 @@
+# Benchmark of FlatBuffer decoding and encoding of TDM messages
+# Usage (with tdmclient installed, or PYTHONPATH=.): python3 tests/benchmark_fb.py
+
+import struct
+import timeit
+from tdmclient import FlatBuffer, ThymioFB, PacketReader
+
+
+def variables_changed_message(num_var=60, array_size=8):
+    """VariablesChanged message similar to what a Thymio sends.
+    """
+    return ThymioFB.create_message((
+        ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED,
+        (
+            (bytes(range(16)),),
+            [
+                (f"var{i}", list(range(array_size)) if i % 4 == 0 else [i])
+                for i in range(num_var)
+            ],
+            1234567,
+        )
+    ), ThymioFB.SCHEMA)
+
+
+def nodes_changed_message(num_nodes=20):
+    return ThymioFB.create_message((
+        ThymioFB.MESSAGE_TYPE_NODES_CHANGED,
+        (
+            [
+                (
+                    (bytes([i] * 16),),
+                    (bytes([i + 100] * 16),),
+                    ThymioFB.NODE_STATUS_AVAILABLE,
+                    ThymioFB.NODE_TYPE_THYMIO2,
+                    f"Robot {i}",
+                    ThymioFB.NODE_CAPABILITY_RENAME,
+                    "14",
+                    "14",
+                )
+                for i in range(num_nodes)
+            ],
+        )
+    ), ThymioFB.SCHEMA)
+
+
+def vm_description_message(num_var=300):
+    return ThymioFB.create_message((
+        ThymioFB.MESSAGE_TYPE_NODE_ASEBA_VM_DESCRIPTION,
+        (
+            1,
+            (bytes(range(16)),),
+            1600, 600, 100,
+            [(i, f"var.{i}", 1 + i % 5) for i in range(num_var)],
+            [(i, f"event.{i}", "") for i in range(20)],
+            [(i, f"fun.{i}", "", [("arg", 1)]) for i in range(20)],
+        )
+    ), ThymioFB.SCHEMA)
+
+
+def bench(label, fun, number):
+    t = timeit.timeit(fun, number=number)
+    print(f"{label:40s} {1e6 * t / number:10.1f} us")
+    return t
+
+
+def bench_decode(name, msg, number=2000):
+    print(f"{name} ({len(msg)} bytes)")
+
+    def before():
+        # schema normalized and interpreted for each message
+        schema = FlatBuffer.normalize_schema(ThymioFB.SCHEMA)
+        FlatBuffer.parse_value(msg, 0, schema)
+
+    def after():
+        fb = FlatBuffer()
+        fb.parse(msg, ThymioFB.SCHEMA)
+
+    def lazy():
+        # access only the first field of the message
+        fb = FlatBuffer()
+        fb.parse(msg, ThymioFB.SCHEMA, lazy=True)
+        fb.root.union_data[0].field(0)
+
+    t_before = bench("  before (interpreted schema)", before, number)
+    t_after = bench("  after (compiled schema)", after, number)
+    print(f"  speedup: {t_before / t_after:.1f}x")
+    bench("  lazy view, first field only", lazy, number)
+
+
+def set_variables_message(num_var=40, array_size=256):
+    """SetVariables message with many large arrays.
+    """
+    return (
+        ThymioFB.MESSAGE_TYPE_SET_VARIABLES,
+        (
+            1,
+            (bytes(range(16)),),
+            [
+                (f"var{i}", [(i * j) % 1000 - 500 for j in range(array_size)])
+                for i in range(num_var)
+            ],
+        )
+    )
+
+
+def bench_encode(name, msg, number=200):
+    print(f"{name} (encoding)")
+
+    def before():
+        # legacy conversion to Table objects and recursive encoding
+        schema = FlatBuffer.normalize_schema(ThymioFB.SCHEMA)
+        FlatBuffer.encode_32(4) + FlatBuffer.convert_with_schema(msg, schema)[1]
+
+    def after():
+        FlatBuffer.encode_with_schema(msg, ThymioFB.SCHEMA)
+
+    t_before = bench("  before (tables, concatenation)", before, number)
+    t_after = bench("  after (single bytearray pass)", after, number)
+    print(f"  speedup: {t_before / t_after:.1f}x")
+
+
+def bench_template(number=5000):
+    print("SetVariables for a control loop (motor targets and leds)")
+    thymio = ThymioFB()
+    thymio.process_message(nodes_changed_message(1))
+    node = thymio.nodes[0]
+    var_dict = {
+        "motor.left.target": [100],
+        "motor.right.target": [-100],
+        "leds.top": [32, 0, 0],
+    }
+
+    def before():
+        ThymioFB.create_message((
+            ThymioFB.MESSAGE_TYPE_SET_VARIABLES,
+            (
+                thymio.next_request_id(),
+                (node.id,),
+                [(name, var_dict[name]) for name in var_dict],
+            )
+        ), ThymioFB.SCHEMA)
+
+    def after():
+        node.create_msg_set_variables(var_dict, reuse_buffer=True)
+
+    t_before = bench("  before (full encoding)", before, number)
+    t_after = bench("  after (template)", after, number)
+    print(f"  speedup: {t_before / t_after:.1f}x")
+
+
+def bench_node_lookup(num_nodes=60, number=20000):
+    print(f"Node lookup for incoming messages ({num_nodes} nodes)")
+    thymio = ThymioFB()
+    thymio.process_message(nodes_changed_message(num_nodes))
+    fb = FlatBuffer()
+    fb.parse(ThymioFB.create_message((
+        ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED,
+        ((bytes([num_nodes - 1] * 16),), [("a", [0])], 0)
+    ), ThymioFB.SCHEMA), ThymioFB.SCHEMA, lazy=True)
+    node_id_field = fb.root.union_data[0].fields[0]
+
+    def before():
+        # id string built from bytes and linear search
+        h = ThymioFB.id_to_bytes(node_id_field).hex()
+        node_id_str = h[:8] + "-" + h[8:12] + "-" + h[12:16] + "-" + h[16:20] + "-" + h[20:]
+        for node in thymio.nodes:
+            if node.id_str == node_id_str:
+                return node
+
+    def after():
+        return thymio.node_by_id.get(ThymioFB.id_to_bytes(node_id_field))
+
+    assert before() is after()
+    t_before = bench("  before (linear search by id string)", before, number)
+    t_after = bench("  after (index by id bytes)", after, number)
+    print(f"  speedup: {t_before / t_after:.1f}x")
+
+
+def bench_packet_reader(number=20000):
+    msg = variables_changed_message(num_var=10)
+    data = struct.pack("<I", len(msg)) + msg
+    print(f"PacketReader, one {len(msg)}-byte packet per read")
+
+    def read(reader):
+        buf = reader.get_buffer()
+        buf[:len(data)] = data
+        return reader.buffer_updated(len(data))
+
+    for label, copy_size in [
+        ("  before (memoryview, new buffer)", 0),
+        ("  after (bytes copy, buffer reused)", None),
+    ]:
+        reader = PacketReader(copy_size=copy_size)
+        bench(label, lambda: read(reader), number)
+        print(f"  {reader.buffer_count} buffers of {reader.buffer_size} bytes allocated")
+
+
+if __name__ == "__main__":
+    bench_decode("VariablesChanged", variables_changed_message())
+    bench_decode("NodesChanged", nodes_changed_message())
+    bench_decode("NodeAsebaVMDescription", vm_description_message(), number=500)
+    bench_encode("SetVariables", set_variables_message())
+    bench_template()
+    bench_node_lookup()
+    bench_packet_reader()
@@ -0,0 +1,129 @@
+import unittest
+import asyncio
+import struct
+import sys
+
+if sys.version_info < (3, 8):
+    raise unittest.SkipTest("unittest.IsolatedAsyncioTestCase requires Python 3.8")
+
+from tdmclient import (ClientAio, ServerHandler, ServerNode, ThymioFB,
+                       RequestTimeoutError)
+from tdmclient.client import DisconnectedError
+
+
+class AioServer:
+    """TDM server with ServerHandler over asyncio streams.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.writers = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        handler = ServerHandler(
+            None, self.nodes,
+            lambda packet: writer.write(struct.pack("<I", len(packet)) + packet)
+        )
+        try:
+            while True:
+                packet_len = struct.unpack("<I", await reader.readexactly(4))[0]
+                handler.process_message(await reader.readexactly(packet_len))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def close(self):
+        for writer in self.writers:
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class TestClientAio(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server_nodes = [
+            ServerNode(name="A", variables={"a": [1], "b": [1, 2, 3]}),
+            ServerNode(name="B", variables={"a": [2], "b": [4, 5, 6]}),
+        ]
+        self.server = AioServer(self.server_nodes)
+        await self.server.start()
+        self.client = await ClientAio.create(tdm_port=self.server.port)
+
+    async def asyncTearDown(self):
+        self.client.disconnect()
+        await self.server.close()
+
+    async def test_wait_for_node(self):
+        node = await asyncio.wait_for(self.client.wait_for_node(node_name="B"), 2)
+        self.assertEqual(node.id_str, self.server_nodes[1].id)
+        self.assertIsNone(await self.client.wait_for_node(timeout=0.05, node_name="C"))
+
+    async def test_requests(self):
+        await asyncio.wait_for(self.client.wait_for_node(), 2)
+        await self.client.wait_for_status(ThymioFB.NODE_STATUS_AVAILABLE)
+        node_a = self.client.first_node(node_name="A")
+        future = self.client.send_request(
+            lambda notify: node_a.send_lock_node(request_id_notify=notify)
+        )
+        self.assertIsInstance(future, asyncio.Future)
+        self.assertIsNone(await asyncio.wait_for(future, 2))
+        self.assertEqual(self.client.pending_requests, set())
+        # concurrent requests
+        node_b = self.client.first_node(node_name="B")
+        await node_b.lock()
+        results = await asyncio.wait_for(asyncio.gather(
+            node_a.set_variables({"a": [10]}),
+            node_b.set_variables({"a": [20]}),
+        ), 2)
+        self.assertEqual(results, [None, None])
+        self.assertEqual(self.server_nodes[0].variables["a"], [10])
+        self.assertEqual(self.server_nodes[1].variables["a"], [20])
+
+    async def test_wait_for_variables(self):
+        node = await asyncio.wait_for(self.client.wait_for_node(node_name="A"), 2)
+        await asyncio.wait_for(node.wait_for_variables({"a", "b"}), 2)
+        self.assertEqual(node.var["b"], [1, 2, 3])
+
+    async def test_request_timeout(self):
+        node = await asyncio.wait_for(self.client.wait_for_node(), 2)
+        # the server doesn't reply to scratchpad updates
+        self.client.request_timeout = 0.05
+        with self.assertRaises(RequestTimeoutError):
+            await asyncio.wait_for(node.set_scratchpad("var x"), 2)
+        self.client.request_timeout = None
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(node.set_scratchpad("var x"), 0.05)
+        # request cancelled by wait_for
+        self.assertEqual(self.client.request_id_notify_dict, {})
+
+    async def test_disconnection(self):
+        node = await asyncio.wait_for(self.client.wait_for_node(), 2)
+        await self.server.close()
+        with self.assertRaises(DisconnectedError):
+            # request pending or sent after disconnection
+            await asyncio.wait_for(node.set_variables({"a": [0]}), 2)
+
+
+    async def test_write_behind(self):
+        node = await asyncio.wait_for(self.client.wait_for_node(node_name="A"), 2)
+        await node.lock()
+        self.client.set_write_behind(rate=50)
+        node.v.a = 3
+        node.v.b[2] = 4
+        self.assertEqual(self.client.flush_scheduler.message_count, 0)
+        await asyncio.wait_for(
+            self.client.sleep(wake=lambda: self.server_nodes[0].variables["a"] == [3]),
+            2
+        )
+        self.assertEqual(self.server_nodes[0].variables, {"a": [3], "b": [1, 2, 4]})
+        self.assertEqual(self.client.flush_scheduler.message_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,699 @@
+import unittest
+import array
+import ast
+import io
+import os
+import socket
+import struct
+import tempfile
+import threading
+import types
+from time import monotonic
+from contextlib import redirect_stderr
+from collections import deque
+from tdmclient import (ClientAsync, ServerHandler, ServerNode, ThymioFB,
+                       PacketReader, RequestTimeoutError, EventStream, Recorder,
+                       TDMConsole)
+from tdmclient.clientasynccachenode import TDMIncompatibleVarSizeError
+from tdmclient.tools import run, sendevent
+
+
+class LoopbackTransport:
+    """Transport which passes packets directly to a ServerHandler.
+    """
+
+    def __init__(self, nodes):
+        self.input_queue = deque()
+        self.server_handler = ServerHandler(None, nodes, self.input_queue.append)
+
+    def send_packet(self, packet):
+        self.server_handler.process_message(packet)
+
+    def receive_packet(self):
+        return self.input_queue.popleft() if len(self.input_queue) > 0 else None
+
+    def request_shutdown(self, on_terminated=None):
+        if on_terminated is not None:
+            on_terminated()
+
+
+class TCPServerThread(threading.Thread):
+    """Thread which accepts a single TCP connection and passes its packets
+    to a ServerHandler.
+    """
+
+    def __init__(self, nodes):
+        threading.Thread.__init__(self, daemon=True)
+        self.nodes = nodes
+        self.socket_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket_listener.bind(("127.0.0.1", 0))
+        self.socket_listener.listen(1)
+        self.port = self.socket_listener.getsockname()[1]
+        self.socket = None
+
+    def run(self):
+        self.socket, _ = self.socket_listener.accept()
+        server_handler = ServerHandler(
+            None, self.nodes,
+            lambda packet: self.socket.sendall(struct.pack("<I", len(packet)) + packet)
+        )
+        packet_reader = PacketReader(self.socket.recv_into)
+        try:
+            while True:
+                for packet in packet_reader.read_packets():
+                    server_handler.process_message(packet)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.shutdown(socket.SHUT_RDWR)
+            self.socket.close()
+        self.socket_listener.close()
+
+
+def events_emitted_message(node_id_str, events):
+    return ThymioFB.create_message((
+        ThymioFB.MESSAGE_TYPE_EVENTS_EMITTED,
+        (
+            (ThymioFB.id_str_to_bytes(node_id_str),),
+            [(name, events[name]) for name in events],
+        )
+    ), ThymioFB.SCHEMA)
+
+
+def variables_changed_message(node_id_str, variables):
+    return ThymioFB.create_message((
+        ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED,
+        (
+            (ThymioFB.id_str_to_bytes(node_id_str),),
+            [(name, variables[name]) for name in variables],
+        )
+    ), ThymioFB.SCHEMA)
+
+
+def load_npy(path):
+    """Load a .npy file of float64 or int16 without numpy, as a tuple
+    (shape, array).
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data[:8] == b"\x93NUMPY\x01\x00"
+    header_len = int.from_bytes(data[8:10], "little")
+    header = ast.literal_eval(data[10 : 10 + header_len].decode("latin1"))
+    a = array.array({"<f8": "d", "<i2": "h"}[header["descr"]])
+    a.frombytes(data[10 + header_len:])
+    return header["shape"], a
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server_nodes = [
+            ServerNode(name="A", variables={"a": [1], "b": [1, 2, 3]}),
+            ServerNode(name="B", variables={"a": [2], "b": [4, 5, 6]}),
+        ]
+        self.transport = LoopbackTransport(self.server_nodes)
+        self.client = ClientAsync(tdm_transport=self.transport)
+
+    def tearDown(self):
+        self.client.disconnect()
+
+    def test_connection(self):
+        self.client.process_waiting_messages()
+        self.assertEqual({node.props["name"] for node in self.client.nodes}, {"A", "B"})
+        node = self.client.first_node(node_name="B")
+        self.assertEqual(node.id_str, self.server_nodes[1].id)
+        self.assertEqual(node.var["b"], [4, 5, 6])
+
+    def test_variable_versions(self):
+        node = self.client.aw(self.client.wait_for_node(node_name="A"))
+        var = node.var
+        self.assertEqual(node.changed_since(0), {"a": [1], "b": [1, 2, 3]})
+        version = node.var_version
+        self.assertEqual(node.changed_since(version), {})
+        t0 = node.var_timestamps["a"]
+        node.update_variables({"b": [7, 8, 9]}, timestamp=t0 + 1)
+        self.assertEqual(node.changed_since(version), {"b": [7, 8, 9]})
+        self.assertEqual(node.var_timestamps, {"a": t0, "b": t0 + 1})
+        # updated in place
+        self.assertIs(node.var, var)
+        self.assertEqual(var["b"], [7, 8, 9])
+
+    def test_array_cache(self):
+        node = self.client.aw(self.client.wait_for_node(node_name="A"))
+        b = node.v.b
+        self.assertEqual(len(b), 3)
+        self.assertEqual(list(b), [1, 2, 3])
+        self.assertEqual(b[1:], [2, 3])
+        b[1:] = [5, 6]
+        b[0] = 4
+        self.assertEqual(node.var_to_send, {"b": [4, 5, 6]})
+        b[:] = 0
+        self.assertEqual(node.var["b"], [0, 0, 0])
+        with self.assertRaises(TDMIncompatibleVarSizeError):
+            b[:2] = [1, 2, 3]
+        node.flush()
+        self.assertEqual(self.server_nodes[0].variables["b"], [0, 0, 0])
+
+    def test_flush_changed(self):
+        node = self.client.aw(self.client.wait_for_node(node_name="A"))
+        self.client.aw(node.lock())
+        sent = []
+        send_set_variables = node.send_set_variables
+        node.send_set_variables = lambda var_dict, **kwargs: (sent.append(dict(var_dict)),
+                                                              send_set_variables(var_dict, **kwargs))
+        b = node.v.b
+        for i in range(100):
+            b[1] = i % 10
+        b[1] = 2
+        node["a"] = 1
+        self.assertEqual(node.var_changes, {"b": {1: 2}, "a": {0: 1}})
+        # nothing has changed
+        node.flush()
+        self.assertEqual(sent, [])
+        b[2] = 9
+        b[0] = 1
+        node.flush()
+        self.assertEqual(sent, [{"b": [1, 2, 9]}])
+        self.assertEqual(self.server_nodes[0].variables["b"], [1, 2, 9])
+        # whole variable sent after explicit mark_change
+        node.mark_change("a")
+        node.flush()
+        self.assertEqual(sent[-1], {"a": [1]})
+
+    def test_write_behind(self):
+        node = self.client.aw(self.client.wait_for_node(node_name="A"))
+        self.client.aw(node.lock())
+        self.client.set_write_behind(rate=5)
+        scheduler = self.client.flush_scheduler
+        for i in range(10):
+            node.v.b[0] = i
+            node.v.a = i
+        self.client.aw(self.client.sleep(0.01))
+        self.assertEqual(self.server_nodes[0].variables, {"a": [9], "b": [9, 2, 3]})
+        self.assertEqual(scheduler.message_count, 1)
+        # next message not before 1/5 s
+        node.v.a = 10
+        self.client.process_waiting_messages()
+        self.assertEqual(self.server_nodes[0].variables["a"], [9])
+        self.client.aw(self.client.sleep(0.3))
+        self.assertEqual(self.server_nodes[0].variables["a"], [10])
+        self.assertEqual(scheduler.message_count, 2)
+
+    def test_write_behind_limits(self):
+        self.client.aw(self.client.wait_for_node())
+        nodes = list(self.client.nodes)
+        self.client.aw(self.client.gather(*[node.lock() for node in nodes]))
+        self.client.set_write_behind(rate=20, max_changes=2, link_rate=10)
+        scheduler = self.client.flush_scheduler
+        node_a, node_b = nodes
+        # max_changes reached: sent immediately
+        node_a.v.a = 5
+        self.assertEqual(scheduler.message_count, 0)
+        node_a.v.b = [1, 1, 1]
+        self.assertEqual(scheduler.message_count, 1)
+        # link rate: one node at a time
+        node_a.v.a = 6
+        node_b.v.a = 7
+        t = scheduler.link_last_send_time
+        self.assertAlmostEqual(scheduler.poll(now=t + 0.05), t + 0.1)
+        self.assertEqual(scheduler.message_count, 1)
+        deadline = scheduler.poll(now=t + 0.1)
+        self.assertAlmostEqual(deadline, t + 0.2)
+        self.assertEqual(scheduler.message_count, 2)
+        self.assertIsNone(scheduler.poll(now=deadline))
+        self.assertEqual(scheduler.message_count, 3)
+        self.client.process_waiting_messages()
+        self.assertEqual([server_node.variables["a"] for server_node in self.server_nodes],
+                         [[6], [7]])
+
+    def test_array_storage(self):
+        self.client.array_type = "array"
+        node = self.client.aw(self.client.wait_for_node(node_name="A"))
+        self.assertEqual(node.var["b"], array.array("h", [1, 2, 3]))
+        b = node.v.b
+        b[1:] = [-300, 300]
+        node["a"] = 7
+        self.assertEqual(node.var["a"], array.array("h", [7]))
+        self.assertEqual(node.var["b"], array.array("h", [1, -300, 300]))
+        view = b.memoryview()
+        self.assertEqual(view.format, "h")
+        self.assertTrue(view.readonly)
+        self.assertEqual(view.tolist(), [1, -300, 300])
+        # values set from an array are copied
+        c = array.array("h", [4, 5, 6])
+        node["b"] = c
+        b[0] = 9
+        self.assertEqual(c, array.array("h", [4, 5, 6]))
+        self.assertEqual(node.var["b"], array.array("h", [9, 5, 6]))
+        node["b"] = [1, -300, 300]
+        node.flush()
+        self.assertEqual(self.server_nodes[0].variables["b"], [1, -300, 300])
+
+    def test_variable_history(self):
+        node = self.client.aw(self.client.wait_for_node(node_name="A"))
+        node.record_history(["b"], size=4)
+        history = node.history["b"]
+        for i in range(6):
+            node.update_variables({"a": [i], "b": [i, -i, 2 * i]},
+                                  timestamp=10 + i, tdm_timestamp=1000 + i)
+        self.assertEqual(len(history), 4)
+        times, tdm_timestamps, values = history.window()
+        self.assertEqual(times, array.array("d", [12, 13, 14, 15]))
+        self.assertEqual(tdm_timestamps, array.array("q", [1002, 1003, 1004, 1005]))
+        self.assertEqual(values, array.array("h", [2, -2, 4, 3, -3, 6, 4, -4, 8, 5, -5, 10]))
+        times, _, values = history.window(duration=1.5)
+        self.assertEqual(times, array.array("d", [14, 15]))
+        self.assertEqual(values, array.array("h", [4, -4, 8, 5, -5, 10]))
+        self.assertEqual(history.window(last=1)[0], array.array("d", [15]))
+        node.stop_history()
+        self.assertEqual(node.history, {})
+
+    def emit(self, node, name, data, queue=False):
+        msg = events_emitted_message(node.id_str, {name: data})
+        if queue:
+            self.transport.input_queue.append(msg)
+        else:
+            self.client.process_incoming_message(msg)
+
+    def test_event_stream(self):
+        self.client.aw(self.client.wait_for_node())
+        node_a = self.client.first_node(node_name="A")
+        node_b = self.client.first_node(node_name="B")
+        with self.client.events(names=["e"], max_size=2) as events:
+            for i in range(3):
+                self.emit(node_a, "e", [i])
+            self.emit(node_a, "f", [0])
+            self.assertEqual(len(events), 2)
+            self.assertEqual(events.dropped_count, 1)
+            self.assertEqual(next(events), (node_a, "e", [1]))
+        self.emit(node_a, "e", [5])
+        # closed: remaining events, then end of iteration
+        self.assertEqual(list(events), [(node_a, "e", [2])])
+
+        with self.client.events(node=node_b, overflow=EventStream.DROP_NEWEST,
+                                max_size=1) as events:
+            self.emit(node_b, "f", [1])
+            self.emit(node_b, "f", [2])
+            self.emit(node_a, "f", [3])
+
+            async def prog():
+                async for node, name, data in events:
+                    return data
+
+            self.assertEqual(self.client.aw(prog()), [1])
+            self.assertEqual((events.received_count, events.dropped_count), (2, 1))
+
+    def test_event_stream_block(self):
+        self.client.aw(self.client.wait_for_node())
+        node = self.client.first_node(node_name="A")
+        with self.client.events(max_size=2, overflow=EventStream.BLOCK) as events:
+            for i in range(4):
+                self.emit(node, "e", [i], queue=True)
+            self.client.process_waiting_messages()
+            # messages kept in the transport
+            self.assertEqual(len(events), 2)
+            self.assertEqual(len(self.transport.input_queue), 2)
+            data = [next(events)[2] for _ in range(4)]
+            self.assertEqual(data, [[0], [1], [2], [3]])
+            self.assertEqual(events.dropped_count, 0)
+
+    def test_recorder(self):
+        self.client.aw(self.client.wait_for_node())
+        node_a = self.client.first_node(node_name="A")
+        node_b = self.client.first_node(node_name="B")
+        with tempfile.TemporaryDirectory() as dir:
+            with Recorder(self.client, dir, variables=["b"], events=["e"],
+                          nodes=[node_a], chunk_size=2) as recorder:
+                for i in range(5):
+                    self.client.process_incoming_message(
+                        variables_changed_message(node_a.id_str, {"a": [i], "b": [i, 0, -i]}))
+                    self.client.process_incoming_message(
+                        variables_changed_message(node_b.id_str, {"b": [0, 0, 0]}))
+                    self.emit(node_a, "e", [100 * i, 1])
+                self.emit(node_a, "f", [1])
+                self.emit(node_a, "e", [1])
+            self.assertEqual(recorder.skipped_count, 1)
+            self.assertEqual(sorted(os.listdir(dir)), [node_a.id_str])
+            path = os.path.join(dir, node_a.id_str)
+            self.assertEqual(sorted(os.listdir(path)),
+                             ["event.e.time.npy", "event.e.value.npy",
+                              "var.b.time.npy", "var.b.value.npy"])
+            shape, times = load_npy(os.path.join(path, "var.b.time.npy"))
+            self.assertEqual(shape, (5,))
+            self.assertEqual(list(times), sorted(times))
+            shape, values = load_npy(os.path.join(path, "var.b.value.npy"))
+            self.assertEqual(shape, (5, 3))
+            self.assertEqual(list(values[-3:]), [4, 0, -4])
+            shape, values = load_npy(os.path.join(path, "event.e.value.npy"))
+            self.assertEqual(shape, (5, 2))
+            self.assertEqual(list(values[::2]), [0, 100, 200, 300, 400])
+
+    def test_server_find_node(self):
+        server_handler = self.transport.server_handler
+        node_a, node_b = self.server_nodes
+        self.assertIs(server_handler.find_node(node_b.id), node_b)
+        self.assertIs(server_handler.find_node(node_a.group_id), node_a)
+        self.assertIsNone(server_handler.find_node("unknown"))
+        # node added after the index has been built
+        node_c = ServerNode(name="C")
+        self.server_nodes.append(node_c)
+        self.assertIs(server_handler.find_node(node_c.id), node_c)
+
+    def test_server_message_handler(self):
+        # server which doesn't reply to lock requests
+        self.transport.server_handler.set_message_handler(ThymioFB.MESSAGE_TYPE_LOCK_NODE, None)
+        node = self.client.aw(self.client.wait_for_node())
+        self.client.request_timeout = 0.05
+        with self.assertRaises(RequestTimeoutError):
+            self.client.aw(node.lock())
+        self.assertEqual(self.server_nodes[0].status, ThymioFB.NODE_STATUS_AVAILABLE)
+
+    def test_ignore_message_type(self):
+        self.client.ignore_message_type(ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED)
+        self.client.process_waiting_messages()
+        self.assertEqual(len(self.client.nodes), 2)
+        self.assertEqual(self.client.nodes[0].var, {})
+        self.assertEqual(self.client.skipped_message_count, 2)
+
+    def test_track_nodes(self):
+        self.client.track_nodes([self.server_nodes[0].id])
+        self.client.process_waiting_messages()
+        self.assertEqual(self.client.first_node(node_name="A").var["a"], [1])
+        self.assertEqual(self.client.first_node(node_name="B").var, {})
+
+    def test_message_filter(self):
+        filtered = []
+
+        def message_filter(msg_view):
+            filtered.append(msg_view.field(1)[0].field(0))
+            return False
+
+        self.client.add_message_filter(ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED,
+                                       message_filter)
+        self.client.process_waiting_messages()
+        self.assertEqual(filtered, ["a", "a"])
+        self.assertEqual(self.client.nodes[0].var, {})
+        self.client.remove_message_filter(ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED,
+                                          message_filter)
+        self.assertEqual(self.client.message_filters, {})
+
+    def test_request_timeout(self):
+        node = self.client.aw(self.client.wait_for_node())
+        self.client.aw(node.get_vm_description())
+        self.assertEqual(self.client.request_id_notify_dict, {})
+        # the server doesn't reply to scratchpad updates
+        self.client.request_timeout = 0.05
+        with self.assertRaises(RequestTimeoutError):
+            self.client.aw(node.set_scratchpad("var x"))
+        self.assertEqual(self.client.request_id_notify_dict, {})
+        self.assertEqual(self.client.pending_request_stats()["timed_out"], 1)
+
+    def test_send_nowait(self):
+        self.client.aw(self.client.wait_for_node())
+        node_a = self.client.first_node(node_name="A")
+        node_b = self.client.first_node(node_name="B")
+        errors = []
+        self.client.on_request_error = errors.append
+        handle = node_a.set_variables_nowait({"a": [5]})
+        self.assertFalse(handle.done)
+        # node B unknown to the server
+        del self.server_nodes[1]
+        handle_b = node_b.send_events_nowait({"e": [1]})
+        self.client.process_waiting_messages()
+        self.assertTrue(handle.done)
+        self.assertIsNone(handle.result)
+        self.assertEqual(self.server_nodes[0].variables["a"], [5])
+        self.assertEqual(errors, [handle_b])
+        self.assertEqual(handle_b.result["error_code"], ThymioFB.ERROR_UNKNOWN_NODE)
+        self.assertIs(handle_b.node, node_b)
+        self.assertEqual(self.client.nowait_counts, {"sent": 2, "completed": 1, "failed": 1})
+        self.assertEqual(self.client.pop_request_errors(), [handle_b])
+        self.assertEqual(len(self.client.request_errors), 0)
+        self.assertIsNone(node_a.watch_nowait())
+        self.assertIsNotNone(node_a.watch_nowait(events=True))
+
+    def test_request_cancel(self):
+        node = self.client.aw(self.client.wait_for_node())
+        co = node.set_scratchpad("var x")
+        co.send(None)
+        self.assertEqual(len(self.client.request_id_notify_dict), 1)
+        co.close()
+        self.assertEqual(self.client.request_id_notify_dict, {})
+        self.assertEqual(self.client.pending_request_stats()["cancelled"], 1)
+
+
+class TestDeploy(unittest.TestCase):
+
+    def setUp(self):
+        self.server_nodes = [ServerNode(name=f"R{i}") for i in range(4)]
+        self.transport = LoopbackTransport(self.server_nodes)
+        self.client = ClientAsync(tdm_transport=self.transport)
+
+    def tearDown(self):
+        self.client.disconnect()
+
+    def test_gather(self):
+        active = set()
+        max_active = 0
+
+        @types.coroutine
+        def task(i):
+            nonlocal max_active
+            active.add(i)
+            max_active = max(max_active, len(active))
+            for _ in range(i):
+                yield
+            active.remove(i)
+            if i == 2:
+                raise ValueError(i)
+            return 10 * i
+
+        results = self.client.aw(self.client.gather(*[task(i) for i in range(5)],
+                                                    limit=2,
+                                                    return_exceptions=True))
+        self.assertEqual(max_active, 2)
+        self.assertEqual(results[:2], [0, 10])
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual(results[3:], [30, 40])
+        with self.assertRaises(ValueError):
+            self.client.aw(self.client.gather(*[task(i) for i in range(5)]))
+
+    def test_deploy(self):
+        self.client.aw(self.client.wait_for_node())
+        nodes = self.client.nodes
+        self.assertEqual(len(nodes), len(self.server_nodes))
+        self.client.aw(self.client.gather(*[node.lock() for node in nodes]))
+        timings = {node: {} for node in nodes}
+        errors = self.client.aw(self.client.gather(
+            *[
+                node.deploy("var x = 1", events=[("ev", 2)], timings=timings[node])
+                for node in nodes
+            ],
+            limit=3
+        ))
+        self.assertEqual(errors, [None] * len(nodes))
+        for server_node in self.server_nodes:
+            self.assertEqual(server_node.execution_state,
+                             ThymioFB.VM_EXECUTION_STATE_RUNNING)
+            self.assertEqual(len(server_node.events), 1)
+        for node in nodes:
+            self.assertEqual(list(timings[node]), ["register_events", "compile", "run"])
+
+    def record_send_events(self):
+        """Make the server record events sent to nodes as (group id, event_dict)
+        for each message.
+        """
+        messages = []
+        server_handler = self.transport.server_handler
+        default_handler = server_handler.set_message_handler(
+            ThymioFB.MESSAGE_TYPE_SEND_EVENTS, None)
+
+        def handler(msg_view):
+            messages.append((
+                ThymioFB.bytes_to_id_str(msg_view.fields[1]),
+                {v.fields[0][0]: list(v.fields[1][0]) for v in msg_view.fields[2][0]}
+            ))
+            default_handler(msg_view)
+
+        server_handler.set_message_handler(ThymioFB.MESSAGE_TYPE_SEND_EVENTS, handler)
+        return messages
+
+    def test_coalesce_events(self):
+        # nodes 1 and 2 in the same group
+        self.server_nodes[2].group_id = self.server_nodes[1].group_id
+        self.client.disconnect()
+        self.transport = LoopbackTransport(self.server_nodes)
+        self.client = ClientAsync(tdm_transport=self.transport)
+        self.client.aw(self.client.wait_for_node())
+        a, b, c = [self.client.first_node(node_id=server_node.id)
+                   for server_node in self.server_nodes[:3]]
+        self.assertEqual(ClientAsync.coalesce_events([
+            (a, "x", [1]), (a, "y", []), (b, "x", [2]), (a, "x", [3]), (c, "y", [4])
+        ]), [
+            (a, {"x": [1], "y": []}), (b, {"x": [2], "y": [4]}), (a, {"x": [3]})
+        ])
+
+    def test_send_events_batch(self):
+        messages = self.record_send_events()
+        self.client.aw(self.client.wait_for_node())
+        node_a, node_b = self.client.nodes[:2]
+        error = self.client.aw(self.client.send_events_batch([
+            (node_a, "x", [1]), (node_a, "y", []), (node_b, "x", [2]), (node_a, "x", [3])
+        ]))
+        self.assertIsNone(error)
+        group_a, group_b = [ThymioFB.id_bytes_to_str(node.props["group_id"]) for node in (node_a, node_b)]
+        self.assertEqual(messages, [
+            (group_a, {"x": [1], "y": []}),
+            (group_b, {"x": [2]}),
+            (group_a, {"x": [3]}),
+        ])
+        self.assertEqual(self.client.request_id_notify_dict, {})
+
+    def test_send_events_paced(self):
+        messages = self.record_send_events()
+        self.client.aw(self.client.wait_for_node())
+        nodes = self.client.nodes
+        t0 = monotonic()
+        stats = self.client.aw(self.client.send_events_paced(
+            [[(node, "step", [i]) for node in nodes] for i in range(5)],
+            rate=50
+        ))
+        self.assertGreaterEqual(monotonic() - t0, 4 / 50)
+        self.assertEqual((stats["steps"], stats["messages"], stats["errors"]),
+                         (5, 5 * len(nodes), []))
+        self.assertLess(stats["jitter_max"], 0.1)
+        self.assertEqual(len(messages), 5 * len(nodes))
+        self.assertEqual(messages[-1], (ThymioFB.id_bytes_to_str(nodes[-1].props["group_id"]), {"step": [4]}))
+
+    def test_sendevent_tool(self):
+        messages = self.record_send_events()
+        status = sendevent.main(["sendevent", "--data=[1,2]", "--event=a",
+                                 "--event=b", "--all"],
+                                tdm_transport=self.transport)
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(messages), sorted(
+            (server_node.group_id, {"a": [1, 2], "b": []})
+            for server_node in self.server_nodes
+        ))
+        for server_node in self.server_nodes:
+            self.assertEqual(server_node.status, ThymioFB.NODE_STATUS_AVAILABLE)
+
+    def test_sendevent_tool_lock_error(self):
+        messages = self.record_send_events()
+        # locked by another client
+        self.server_nodes[1].status = ThymioFB.NODE_STATUS_READY
+        with redirect_stderr(io.StringIO()):
+            status = sendevent.main(["sendevent", "--event=a", "--all"],
+                                    tdm_transport=self.transport)
+        self.assertEqual(status, 2)
+        self.assertEqual(messages, [])
+        # other nodes unlocked, node locked by the other client left locked
+        self.assertEqual([server_node.status for server_node in self.server_nodes],
+                         [ThymioFB.NODE_STATUS_AVAILABLE, ThymioFB.NODE_STATUS_READY,
+                          ThymioFB.NODE_STATUS_AVAILABLE, ThymioFB.NODE_STATUS_AVAILABLE])
+
+    def test_run_tool_vm_events(self):
+        for server_node in self.server_nodes:
+            server_node.vm_events = ["timer0"]
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "prog.py")
+            with open(path, "w") as f:
+                f.write("@onevent\ndef timer0():\n    global x\n    x = 1\n")
+            # only events predefined in the vm: don't wait for _exit
+            result = []
+            thread = threading.Thread(
+                target=lambda: result.append(run.main(["run", "--all", path],
+                                                      tdm_transport=self.transport)),
+                daemon=True
+            )
+            thread.start()
+            thread.join(5)
+        self.assertEqual(result, [0])
+        for server_node in self.server_nodes:
+            self.assertEqual(server_node.execution_state,
+                             ThymioFB.VM_EXECUTION_STATE_RUNNING)
+            self.assertEqual(server_node.events, {})
+
+    def test_repl_run_vm_events(self):
+        for server_node in self.server_nodes:
+            server_node.vm_events = ["timer0"]
+        self.client.aw(self.client.wait_for_node())
+        console = TDMConsole(user_functions={})
+        self.client.aw(console.init(self.client, self.client.nodes[0]))
+        src = "@onevent\ndef timer0():\n    global x\n    x = 1\n"
+        thread = threading.Thread(
+            target=lambda: console.run_program(src, language="python", wait=None),
+            daemon=True
+        )
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.server_nodes[0].execution_state,
+                         ThymioFB.VM_EXECUTION_STATE_RUNNING)
+
+    def test_repl_run_unlock(self):
+        self.client.aw(self.client.wait_for_node())
+        nodes = list(self.client.nodes)
+        console = TDMConsole(user_functions={})
+        self.client.aw(console.init(self.client, nodes[0]))
+        console.run_program("var x = 1", nodes=nodes)
+        self.client.process_waiting_messages()
+        for server_node in self.server_nodes:
+            self.assertEqual(server_node.execution_state,
+                             ThymioFB.VM_EXECUTION_STATE_RUNNING)
+            # other nodes unlocked once the program has been started
+            self.assertEqual(server_node.status, ThymioFB.NODE_STATUS_AVAILABLE)
+
+    def test_run_tool_all(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "prog.aseba")
+            with open(path, "w") as f:
+                f.write("var x = 1\n")
+            status = run.main(["run", "--all", "--concurrency=2", path],
+                              tdm_transport=self.transport)
+        self.assertEqual(status, 0)
+        for server_node in self.server_nodes:
+            self.assertEqual(server_node.execution_state,
+                             ThymioFB.VM_EXECUTION_STATE_RUNNING)
+            # unlocked once the program has been started
+            self.assertEqual(server_node.status, ThymioFB.NODE_STATUS_AVAILABLE)
+
+
+class TestClientTCP(unittest.TestCase):
+
+    def setUp(self):
+        self.server_nodes = [ServerNode(name="A", variables={"a": [1]})]
+        self.server = TCPServerThread(self.server_nodes)
+        self.server.start()
+        self.client = ClientAsync(tdm_port=self.server.port)
+
+    def tearDown(self):
+        self.client.disconnect()
+        self.server.close()
+
+    def test_request_latency(self):
+        node = self.client.aw(self.client.wait_for_node())
+        num_requests = 5
+        t0 = monotonic()
+        self.client.aw(node.lock())
+        for i in range(num_requests - 1):
+            self.client.aw(node.set_variables({"a": [i]}))
+        elapsed = monotonic() - t0
+        self.assertEqual(self.server_nodes[0].variables["a"], [num_requests - 2])
+        # replies processed as soon as they're received, without polling
+        self.assertLess(elapsed, num_requests * ClientAsync.DEFAULT_SLEEP)
+
+    def test_wait_for_packet(self):
+        self.client.aw(self.client.wait_for_node())
+        # wait until the server has stopped sending messages
+        while self.client.wait_for_packet(0.05):
+            self.client.process_waiting_messages()
+        t0 = monotonic()
+        self.assertFalse(self.client.wait_for_packet(0.05))
+        self.assertGreaterEqual(monotonic() - t0, 0.04)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+import unittest
+from array import array
+from tdmclient import (FlatBuffer, FlexBuffer, Table, Union, TableView, UnionView,
+                       ThymioFB)
+
+
+def to_native(value):
+    """Convert decoded flatbuffer to nested tuples and lists for comparisons.
+    """
+    if type(value) is Union or type(value) is UnionView:
+        return ("U", value.union_type,
+                to_native(value.union_data[0]) if value.union_data is not None else None)
+    elif type(value) is Table or type(value) is TableView:
+        return tuple(
+            to_native(field[0]) if field is not None else None
+            for field in value.fields
+        )
+    elif isinstance(value, list):
+        return [to_native(el) for el in value]
+    elif isinstance(value, memoryview):
+        return bytes(value)
+    else:
+        return value
+
+
+NODE_ID = bytes(range(16))
+
+MESSAGES = [
+    (
+        ThymioFB.MESSAGE_TYPE_CONNECTION_HANDSHAKE,
+        (1, 1, 102400, None, False, 0, None, "pw"),
+    ),
+    (
+        ThymioFB.MESSAGE_TYPE_NODES_CHANGED,
+        (
+            [
+                ((NODE_ID,), (bytes(range(16, 32)),), 2, 1, "Robot 1", 1, "14", "14"),
+                ((bytes(range(32, 48)),), (bytes(range(48, 64)),), 3, 2, "Thymio", 1, "14", "14"),
+            ],
+        ),
+    ),
+    (
+        ThymioFB.MESSAGE_TYPE_NODE_ASEBA_VM_DESCRIPTION,
+        (7, (NODE_ID,), 1600, 600, 100, [(0, "a", 1), (1, "b.c", 5)], [], []),
+    ),
+    (
+        ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED,
+        (
+            (NODE_ID,),
+            [
+                ("motor.left.target", [50]),
+                ("leds.circle", [0, 32, 0, 32, 0, 32, 0, 32]),
+                ("big", list(range(-100, 100))),
+            ],
+            123456789,
+        ),
+    ),
+    (
+        ThymioFB.MESSAGE_TYPE_SEND_EVENTS,
+        (3, (NODE_ID,), [("speed", [40, 20]), ("go", [])]),
+    ),
+    (
+        ThymioFB.MESSAGE_TYPE_WATCH_NODE,
+        (5, (NODE_ID,), 3),
+    ),
+]
+
+
+class TestFlatBuffer(unittest.TestCase):
+
+    def test_compile_schema_cache(self):
+        schema1 = FlatBuffer.compile_schema(ThymioFB.SCHEMA)
+        schema2 = FlatBuffer.compile_schema(ThymioFB.SCHEMA)
+        self.assertIs(schema1, schema2)
+        self.assertEqual(schema1.kind, "U")
+        self.assertEqual(len(schema1.items), ThymioFB.MESSAGE_TYPE_SAVE_BYTECODE)
+
+    def test_compile_schema_syntax_error(self):
+        with self.assertRaises(Exception):
+            FlatBuffer.compile_schema("T(i")
+        with self.assertRaises(Exception):
+            FlatBuffer.compile_schema("T(q)")
+
+    def test_compiled_decoder_matches_interpreter(self):
+        schema_normalized = FlatBuffer.normalize_schema(ThymioFB.SCHEMA)
+        for msg in MESSAGES:
+            encoded = ThymioFB.create_message(msg, ThymioFB.SCHEMA)
+            fb = FlatBuffer()
+            fb.parse(encoded, ThymioFB.SCHEMA)
+            root_interpreted = FlatBuffer.parse_value(encoded, 0, schema_normalized)
+            self.assertEqual(to_native(fb.root), to_native(root_interpreted))
+            self.assertEqual(fb.root.union_type, msg[0])
+
+    def test_decode_values(self):
+        msg = MESSAGES[3]
+        encoded = ThymioFB.create_message(msg, ThymioFB.SCHEMA)
+        fb = FlatBuffer()
+        fb.parse(encoded, ThymioFB.SCHEMA)
+        node_id, variables, timestamp = to_native(fb.root)[2]
+        self.assertEqual(node_id, (NODE_ID,))
+        self.assertEqual(variables, [tuple(v) for v in msg[1][1]])
+        self.assertEqual(timestamp, 123456789)
+
+    def test_lazy_view_matches_decoder(self):
+        for msg in MESSAGES:
+            encoded = ThymioFB.create_message(msg, ThymioFB.SCHEMA)
+            fb = FlatBuffer()
+            fb.parse(encoded, ThymioFB.SCHEMA)
+            fb_lazy = FlatBuffer()
+            fb_lazy.parse(encoded, ThymioFB.SCHEMA, lazy=True)
+            self.assertIs(type(fb_lazy.root), UnionView)
+            self.assertEqual(to_native(fb_lazy.root), to_native(fb.root))
+
+    def test_lazy_view_zero_copy(self):
+        encoded = ThymioFB.create_message(MESSAGES[5], ThymioFB.SCHEMA)
+        fb = FlatBuffer()
+        fb.parse(encoded, ThymioFB.SCHEMA, lazy=True)
+        watch_node = fb.root.union_data[0]
+        self.assertEqual(watch_node.field(0), 5)
+        self.assertEqual(watch_node.field(2), 3)
+        node_id = watch_node.field(1).field(0)
+        self.assertIsInstance(node_id, memoryview)
+        self.assertEqual(bytes(node_id), NODE_ID)
+        self.assertIsNone(watch_node.fields[1][0].field_pos(1))
+
+    def test_vectors(self):
+        schema = "T(*i*l*T(i)*s)"
+        value = ([100000, -5, 0], [2 ** 40, -1], [(7,), (8,)], ["abc", "de"])
+        fb = FlatBuffer()
+        fb.load_with_schema(value, schema)
+        encoded = fb.encode()
+        fb.parse(encoded, schema)
+        vec_i32, vec_i64, vec_t, vec_s = [field[0] for field in fb.root.fields]
+        self.assertIs(type(vec_i32), list)
+        self.assertEqual(vec_i32, value[0])
+        self.assertEqual(vec_i64, value[1])
+        self.assertEqual(to_native(vec_t), value[2])
+        self.assertEqual(vec_s, value[3])
+        fb.parse(encoded, schema, array_type="array")
+        vec_i32, vec_i64 = [field[0] for field in fb.root.fields[:2]]
+        self.assertEqual(vec_i32, array("i", value[0]))
+        self.assertEqual(vec_i64, array("q", value[1]))
+
+    def test_encoder_matches_legacy_encoder(self):
+        schema_normalized = FlatBuffer.normalize_schema(ThymioFB.SCHEMA)
+        for msg in MESSAGES:
+            encoded = ThymioFB.create_message(msg, ThymioFB.SCHEMA)
+            encoded_legacy = (FlatBuffer.encode_32(4)
+                              + FlatBuffer.convert_with_schema(msg, schema_normalized)[1])
+            self.assertEqual(encoded, encoded_legacy)
+
+    def test_encoded_bytes(self):
+        encoded = ThymioFB.create_message(MESSAGES[5], ThymioFB.SCHEMA)
+        self.assertEqual(encoded.hex(),
+                         "04000000b4ffffff0f00000004000000ccffffff05000000"
+                         "0800000003000000e4ffffff0400000010000000"
+                         "000102030405060708090a0b0c0d0e0f0600080004000000"
+                         "0a001000040008000c00000008000c0004000800")
+
+
+class TestFlexBuffer(unittest.TestCase):
+
+    VALUES = [0, 1, -1, 32767, -32768] + list(range(-150, 150))
+
+    def test_untyped_vector(self):
+        for values in [[], [5], self.VALUES]:
+            encoded = FlexBuffer.encode_vec_untyped_int16(values)
+            self.assertEqual(FlexBuffer.parse(encoded), values)
+            decoded = FlexBuffer.parse(memoryview(encoded), array_type="array")
+            self.assertEqual(decoded, array("h", values))
+
+    def test_typed_vector(self):
+        encoded = FlexBuffer.encode_vec_int16(self.VALUES[:100])
+        self.assertEqual(FlexBuffer.parse(encoded), self.VALUES[:100])
+        self.assertEqual(FlexBuffer.parse(encoded, array_type="array"),
+                         array("h", self.VALUES[:100]))
+
+    def test_minimal_width(self):
+        for values, width in [([], 1), ([1, -128, 127], 1), ([128], 2),
+                              ([0] * 256, 2), (self.VALUES, 2)]:
+            for typed in (False, True):
+                encoded = FlexBuffer.encode_vec_int(values, typed=typed)
+                self.assertEqual(1 << (encoded[-2] & 3), width)
+                self.assertEqual(FlexBuffer.parse(encoded), values)
+        # size, elements, types (untyped only), offset, root type and width
+        self.assertEqual(len(FlexBuffer.encode_vec_int([1, 2, 3])), 1 + 3 + 3 + 1 + 2)
+        self.assertEqual(len(FlexBuffer.encode_vec_int([1, 2, 3], typed=True)), 1 + 3 + 1 + 2)
+        self.assertEqual(len(FlexBuffer.encode_vec_untyped_int16([1, 2, 3])), 2 + 6 + 3 + 1 + 2)
+
+    def test_heterogeneous_vector(self):
+        # vector of int8 [-2, 3] with uint element 3
+        encoded = bytes([
+            2, 0xfe, 3,
+            (FlexBuffer.TYPE_INT << 2) | FlexBuffer.BIT_WIDTH_8,
+            (FlexBuffer.TYPE_UINT << 2) | FlexBuffer.BIT_WIDTH_8,
+            4,
+            (FlexBuffer.TYPE_VECTOR << 2) | FlexBuffer.BIT_WIDTH_8,
+            1,
+        ])
+        self.assertEqual(FlexBuffer.parse(encoded), [-2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import socket
+import struct
+import time
+from tdmclient import PacketReader, TDMConnection
+
+
+def frame(packet):
+    return struct.pack("<I", len(packet)) + packet
+
+
+class TestPacketReader(unittest.TestCase):
+
+    def setUp(self):
+        self.sock_write, self.sock_read = socket.socketpair()
+        self.sock_read.settimeout(1)
+
+    def tearDown(self):
+        self.sock_write.close()
+        self.sock_read.close()
+
+    def test_several_packets(self):
+        reader = PacketReader(self.sock_read.recv_into)
+        packets = [b"abc", b"", bytes(range(200)), b"xyz"]
+        self.sock_write.sendall(b"".join(frame(p) for p in packets))
+        received = reader.read_packets()
+        self.assertEqual([bytes(p) for p in received], packets)
+        # small packets copied
+        self.assertTrue(all(isinstance(p, bytes) for p in received))
+
+    def test_buffer_reused(self):
+        reader = PacketReader(self.sock_read.recv_into, buffer_size=64, copy_size=32)
+        for i in range(20):
+            self.sock_write.sendall(frame(bytes([i]) * 10))
+            self.assertEqual(reader.read_packets(), [bytes([i]) * 10])
+        self.assertEqual(reader.buffer_count, 1)
+        # large packet not copied
+        self.sock_write.sendall(frame(b"x" * 40) + frame(b"end"))
+        received = []
+        while len(received) < 2:
+            received += reader.read_packets()
+        self.assertIsInstance(received[0], memoryview)
+        self.assertEqual(bytes(received[0]), b"x" * 40)
+        self.assertEqual(received[1], b"end")
+        self.assertGreater(reader.buffer_count, 1)
+
+    def test_split_packets(self):
+        reader = PacketReader(self.sock_read.recv_into)
+        data = frame(b"first packet") + frame(b"second")
+        received = []
+        # short reads of length prefix and packet content
+        for i in (2, 5, 19, len(data)):
+            self.sock_write.sendall(data[:i])
+            data = data[i:]
+            received += reader.read_packets()
+            if len(data) == 0:
+                break
+        self.assertEqual([bytes(p) for p in received], [b"first packet", b"second"])
+
+    def test_packets_not_overwritten(self):
+        reader = PacketReader(self.sock_read.recv_into, buffer_size=16, copy_size=0)
+        self.sock_write.sendall(frame(b"12345678"))
+        p1 = reader.read_packets()[0]
+        self.sock_write.sendall(frame(b"abcdefgh"))
+        p2 = reader.read_packets()[0]
+        self.assertEqual((bytes(p1), bytes(p2)), (b"12345678", b"abcdefgh"))
+
+    def test_large_packet(self):
+        reader = PacketReader(self.sock_read.recv_into, buffer_size=16)
+        packet = bytes(i % 251 for i in range(10000))
+        self.sock_write.sendall(frame(packet) + frame(b"end"))
+        received = []
+        while len(received) < 2:
+            received += reader.read_packets()
+        self.assertEqual([bytes(p) for p in received], [packet, b"end"])
+
+    def test_connection_closed(self):
+        reader = PacketReader(self.sock_read.recv_into)
+        self.sock_write.close()
+        with self.assertRaises(ConnectionResetError):
+            reader.read_packets()
+
+
+class TestTDMConnection(unittest.TestCase):
+
+    def test_receive_burst(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        tdm = TDMConnection("127.0.0.1", listener.getsockname()[1])
+        sock, _ = listener.accept()
+        packets = [bytes([i]) * (i * 10) for i in range(1, 20)]
+        sock.sendall(b"".join(frame(p) for p in packets))
+
+        received = []
+        deadline = time.time() + 2
+        while len(received) < len(packets) and time.time() < deadline:
+            p = tdm.receive_packet()
+            if p is None:
+                time.sleep(0.01)
+            else:
+                received.append(bytes(p))
+        self.assertEqual(received, packets)
+
+        tdm.input_thread.terminate()
+        sock.close()
+        listener.close()
+        tdm.input_thread.join(1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,368 @@
+import unittest
+import io
+from array import array
+from contextlib import redirect_stdout
+from time import sleep
+from tdmclient import FlatBuffer, ThymioFB, Node, RequestTimeoutError
+
+
+NODE_ID = bytes(range(16))
+GROUP_ID = bytes(range(16, 32))
+NODE_ID_STR = "00010203-0405-0607-0809-0a0b0c0d0e0f"
+
+
+def nodes_changed_message(status=ThymioFB.NODE_STATUS_AVAILABLE, name="Robot 1",
+                          group_id=GROUP_ID):
+    return ThymioFB.create_message((
+        ThymioFB.MESSAGE_TYPE_NODES_CHANGED,
+        (
+            [
+                ((NODE_ID,), (group_id,), status, ThymioFB.NODE_TYPE_THYMIO2,
+                 name, ThymioFB.NODE_CAPABILITY_RENAME, "14", "14"),
+            ],
+        )
+    ), ThymioFB.SCHEMA)
+
+
+def variables_changed_message(variables, timestamp=None):
+    return ThymioFB.create_message((
+        ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED,
+        (
+            (NODE_ID,),
+            [
+                (name, variables[name])
+                for name in variables
+            ],
+        ) + (() if timestamp is None else (timestamp,))
+    ), ThymioFB.SCHEMA)
+
+
+def events_emitted_message(events, node_id=NODE_ID):
+    return ThymioFB.create_message((
+        ThymioFB.MESSAGE_TYPE_EVENTS_EMITTED,
+        (
+            (node_id,),
+            [
+                (name, events[name])
+                for name in events
+            ],
+        )
+    ), ThymioFB.SCHEMA)
+
+
+class TestThymioFB(unittest.TestCase):
+
+    def setUp(self):
+        self.thymio = ThymioFB()
+        self.thymio.process_message(nodes_changed_message())
+
+    def test_nodes_changed(self):
+        self.assertEqual(len(self.thymio.nodes), 1)
+        node = self.thymio.nodes[0]
+        self.assertEqual(node.id, NODE_ID)
+        self.assertIs(type(node.id), bytes)
+        self.assertEqual(node.id_str, NODE_ID_STR)
+        self.assertEqual(node.props["group_id"], GROUP_ID)
+        self.assertEqual(node.props["name"], "Robot 1")
+        self.assertEqual(node.status, ThymioFB.NODE_STATUS_AVAILABLE)
+
+        # update of existing node
+        self.thymio.process_message(nodes_changed_message(status=ThymioFB.NODE_STATUS_BUSY))
+        self.assertEqual(len(self.thymio.nodes), 1)
+        self.assertEqual(self.thymio.nodes[0].status, ThymioFB.NODE_STATUS_BUSY)
+
+    def test_find_node(self):
+        node = self.thymio.nodes[0]
+        self.assertIs(self.thymio.find_node(NODE_ID_STR), node)
+        self.assertIs(self.thymio.find_node(NODE_ID), node)
+        self.assertIs(self.thymio.find_node(memoryview(NODE_ID)), node)
+        self.assertIsNone(self.thymio.find_node(GROUP_ID))
+        self.assertEqual(self.thymio.find_nodes(node_name="Robot 1"), [node])
+        self.assertEqual(self.thymio.find_nodes(group_id=GROUP_ID), [node])
+        self.assertEqual(self.thymio.find_nodes(group_id=ThymioFB.id_bytes_to_str(GROUP_ID),
+                                                node_name="Robot 1"), [node])
+        self.assertEqual(self.thymio.find_nodes(node_id=NODE_ID, node_name="Robot 2"), [])
+        self.assertEqual(self.thymio.find_nodes(), [node])
+        # renamed
+        self.thymio.process_message(nodes_changed_message(name="Robot 2"))
+        self.assertEqual(self.thymio.find_nodes(node_name="Robot 1"), [])
+        self.assertEqual(self.thymio.find_nodes(node_name="Robot 2"), [node])
+
+    def test_id_str(self):
+        self.assertEqual(ThymioFB.id_bytes_to_str(NODE_ID), NODE_ID_STR)
+        self.assertEqual(ThymioFB.id_str_to_bytes(NODE_ID_STR), NODE_ID)
+        self.assertIsNone(ThymioFB.id_bytes_to_str(None))
+
+    def test_missing_node_id(self):
+        self.thymio.process_message(ThymioFB.create_message((
+            ThymioFB.MESSAGE_TYPE_NODE_ASEBA_VM_DESCRIPTION,
+            (1, None, 1600, 600, 100, [], [], [])
+        ), ThymioFB.SCHEMA))
+        self.thymio.process_message(ThymioFB.create_message((
+            ThymioFB.MESSAGE_TYPE_EVENTS_EMITTED,
+            (None, [("a", [1])])
+        ), ThymioFB.SCHEMA))
+
+    def test_variables_changed(self):
+        received = []
+        node = self.thymio.nodes[0]
+        node.add_variables_changed_listener(
+            lambda node, variables: received.append((node, variables))
+        )
+        variables = {
+            "a": [1],
+            "b.c": [1, -2, 3],
+            "big": list(range(-50, 150)),
+        }
+        self.thymio.process_message(memoryview(variables_changed_message(variables)))
+        self.assertEqual(received, [(node, variables)])
+        self.assertIsNone(node.variables_timestamp)
+        self.thymio.process_message(variables_changed_message({"a": [2]}, 1234567890123))
+        self.assertEqual(node.variables_timestamp, 1234567890123)
+
+    def test_event_subscriptions(self):
+        node = self.thymio.nodes[0]
+        other_node = Node(self.thymio, {**node.props, "node_id": GROUP_ID})
+        received = []
+        decoded = []
+        decode_values = self.thymio.decode_values
+
+        def decode_values_counted(named_values):
+            decoded.append(named_values.field(0))
+            return decode_values(named_values)
+
+        self.thymio.decode_values = decode_values_counted
+
+        def listener_a(node, name, data):
+            received.append(("a", name, list(data)))
+
+        def listener_b(node, name, data):
+            received.append(("b", name, list(data)))
+
+        self.thymio.add_event_received_listener(listener_a, names=["x"])
+        self.thymio.add_event_received_listener(listener_b, names=["x", "y"],
+                                                node=other_node)
+        self.assertEqual(self.thymio.subscribed_event_names(node), {"x"})
+        self.assertEqual(self.thymio.subscribed_event_names(other_node), {"x", "y"})
+        self.thymio.process_message(events_emitted_message({"x": [1], "y": [2], "z": [3]}))
+        self.assertEqual(received, [("a", "x", [1])])
+        # events not subscribed aren't decoded
+        self.assertEqual(decoded, ["x"])
+
+        # listener for all events of the node
+        received.clear()
+        self.thymio.remove_event_received_listener(listener_b)
+        self.thymio.add_event_received_listener(listener_b, node=node)
+        self.assertIsNone(self.thymio.subscribed_event_names(node))
+        self.thymio.process_message(events_emitted_message({"x": [1], "y": [2]}))
+        self.assertEqual(sorted(received),
+                         [("a", "x", [1]), ("b", "x", [1]), ("b", "y", [2])])
+
+        self.thymio.clear_event_received_listeners()
+        self.assertEqual(self.thymio.subscribed_event_names(node), set())
+
+    def test_events_debug(self):
+        # events without listener are displayed
+        self.thymio.debug = 2
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.thymio.process_message(events_emitted_message({"x": [1], "y": [2]}))
+        self.assertEqual(output.getvalue().splitlines()[-3:],
+                         [f"events emitted by node {NODE_ID_STR}", "x [1]", "y [2]"])
+
+    def test_variables_changed_array(self):
+        received = []
+        self.thymio.array_type = "array"
+        self.thymio.add_variables_changed_listener(
+            lambda node, variables: received.append(variables)
+        )
+        self.thymio.process_message(variables_changed_message({"a": [1, -2, 3]}))
+        self.assertEqual(received, [{"a": array("h", [1, -2, 3])}])
+
+    def test_message_handlers(self):
+        node = self.thymio.nodes[0]
+        received = []
+        firmware_status_msg = ThymioFB.create_message(
+            (ThymioFB.MESSAGE_TYPE_FIRMWARE_UPGRADE_STATUS, (7,)), ThymioFB.SCHEMA)
+
+        # unknown message type
+        with redirect_stdout(io.StringIO()) as output:
+            self.thymio.process_message(firmware_status_msg)
+        self.assertIn("unprocessed", output.getvalue())
+
+        # new handler
+        self.thymio.set_message_handler(
+            ThymioFB.MESSAGE_TYPE_FIRMWARE_UPGRADE_STATUS,
+            lambda msg_view: received.append(msg_view.field(0))
+        )
+        self.thymio.process_message(firmware_status_msg)
+        self.assertEqual(received, [7])
+
+        # default handler disabled, then restored
+        default_handler = self.thymio.set_message_handler(
+            ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED, None)
+        self.assertEqual(default_handler, self.thymio.process_msg_variables_changed)
+        node.add_variables_changed_listener(
+            lambda node, variables: received.append(variables))
+        self.thymio.process_message(variables_changed_message({"a": [1]}))
+        self.assertEqual(received, [7])
+        self.thymio.reset_message_handler(ThymioFB.MESSAGE_TYPE_VARIABLES_CHANGED)
+        self.thymio.process_message(variables_changed_message({"a": [1]}))
+        self.assertEqual(received, [7, {"a": [1]}])
+        self.thymio.reset_message_handler(ThymioFB.MESSAGE_TYPE_FIRMWARE_UPGRADE_STATUS)
+        self.assertNotIn(ThymioFB.MESSAGE_TYPE_FIRMWARE_UPGRADE_STATUS,
+                         self.thymio.message_handlers)
+
+    def test_request_completed(self):
+        results = []
+        request_id = self.thymio.next_request_id(request_id_notify=results.append)
+        self.thymio.process_message(self.thymio.create_msg_request_completed(request_id))
+        self.assertEqual(results, [None])
+        self.assertNotIn(request_id, self.thymio.request_id_notify_dict)
+
+        request_id = self.thymio.next_request_id(request_id_notify=results.append)
+        self.thymio.process_message(self.thymio.create_msg_error(request_id, ThymioFB.ERROR_NODE_BUSY))
+        self.assertEqual(results, [None, {"error_code": ThymioFB.ERROR_NODE_BUSY}])
+
+    def test_request_timeout(self):
+        results = []
+        request_id1 = self.thymio.next_request_id(request_id_notify=results.append,
+                                                  request_timeout=0.01)
+        request_id2 = self.thymio.next_request_id(request_id_notify=results.append,
+                                                  request_timeout=10)
+        self.assertEqual(self.thymio.expire_requests(), 0)
+        sleep(0.02)
+        self.assertEqual(self.thymio.expire_requests(), 1)
+        self.assertIsInstance(results[0], RequestTimeoutError)
+        self.assertEqual(results[0].request_id, request_id1)
+        self.assertEqual(list(self.thymio.request_id_notify_dict), [request_id2])
+        self.assertTrue(self.thymio.cancel_request(request_id2))
+        self.assertFalse(self.thymio.cancel_request(request_id2))
+        stats = self.thymio.pending_request_stats()
+        self.assertEqual(stats["pending"], 0)
+        self.assertIsNone(stats["oldest_age"])
+        self.assertEqual((stats["sent"], stats["timed_out"], stats["cancelled"]), (2, 1, 1))
+
+    def test_max_pending_requests(self):
+        self.thymio.max_pending_requests = 2
+        results = []
+        request_ids = [
+            self.thymio.next_request_id(request_id_notify=results.append)
+            for _ in range(3)
+        ]
+        self.assertEqual(list(self.thymio.request_id_notify_dict), request_ids[1:])
+        self.assertEqual(results[0].request_id, request_ids[0])
+        self.assertEqual(self.thymio.pending_request_stats()["discarded"], 1)
+        self.assertEqual(self.thymio.request_time_dict.keys(),
+                         self.thymio.request_id_notify_dict.keys())
+
+
+class TestMessageTemplate(unittest.TestCase):
+
+    def setUp(self):
+        self.thymio = ThymioFB()
+        self.thymio.process_message(nodes_changed_message())
+        self.node = self.thymio.nodes[0]
+
+    @staticmethod
+    def named_values_message(message_type, request_id, id, value_dict):
+        return ThymioFB.create_message((
+            message_type,
+            (
+                request_id,
+                (id,),
+                [(name, value_dict[name]) for name in value_dict],
+            )
+        ), ThymioFB.SCHEMA)
+
+    @staticmethod
+    def decode_named_values(msg):
+        fb = FlatBuffer()
+        fb.parse(msg, ThymioFB.SCHEMA)
+        request_id, node_id, named_values = [f[0] for f in fb.root.union_data[0].fields]
+        return (
+            fb.root.union_type,
+            request_id,
+            {v.fields[0][0]: v.fields[1][0] for v in named_values},
+        )
+
+    def test_set_variables(self):
+        var_dict = {"a": [1], "b": [1, 2, 3]}
+        msg = self.node.create_msg_set_variables(var_dict)
+        self.assertIs(type(msg), bytes)
+        self.assertEqual(msg, self.named_values_message(
+            ThymioFB.MESSAGE_TYPE_SET_VARIABLES,
+            self.thymio.last_request_id, NODE_ID, var_dict
+        ))
+        self.assertEqual(self.node.msg_templates[
+            (ThymioFB.MESSAGE_TYPE_SET_VARIABLES, ("a", "b"), (1, 3))
+        ].widths, [1, 1])
+        for var_dict in [
+            {"a": [-5], "b": [4, 5, 6]},
+            {"a": [7], "b": [40000, -40000, 65535]},
+            {"a": [8], "b": [1, 2, 3]},
+            {"a": [8], "b": list(range(200))},
+            {"a": [9], "b": list(range(-100, 100))},
+        ]:
+            msg = self.node.create_msg_set_variables(var_dict)
+            self.assertEqual(self.decode_named_values(msg), (
+                ThymioFB.MESSAGE_TYPE_SET_VARIABLES,
+                self.thymio.last_request_id,
+                {
+                    name: [((x & 0xffff) ^ 0x8000) - 0x8000 for x in var_dict[name]]
+                    for name in var_dict
+                }
+            ))
+        # one template per set of sizes, 16-bit elements when needed
+        self.assertEqual(len(self.node.msg_templates), 2)
+        self.assertEqual(self.node.msg_templates[
+            (ThymioFB.MESSAGE_TYPE_SET_VARIABLES, ("a", "b"), (1, 3))
+        ].widths, [1, 2])
+
+    def test_typed_vectors(self):
+        self.thymio.typed_vectors = True
+        var_dict = {"a": [1, 2, 3], "b": [-1000]}
+        msg = self.node.create_msg_set_variables(var_dict)
+        self.assertEqual(self.decode_named_values(msg)[2], var_dict)
+        self.assertLess(len(msg), len(self.named_values_message(
+            ThymioFB.MESSAGE_TYPE_SET_VARIABLES, 1, NODE_ID, var_dict
+        )))
+
+    def test_send_events(self):
+        msg = self.node.create_msg_send_events({"go": [], "speed": [1, 2]},
+                                               reuse_buffer=True)
+        self.assertIs(type(msg), bytearray)
+        self.assertEqual(msg, self.named_values_message(
+            ThymioFB.MESSAGE_TYPE_SEND_EVENTS,
+            self.thymio.last_request_id, GROUP_ID, {"go": [], "speed": [1, 2]}
+        ))
+        msg2 = self.node.create_msg_send_events({"go": [], "speed": [3, 4]},
+                                                reuse_buffer=True)
+        self.assertIs(msg2, msg)
+
+    def test_send_events_group_changed(self):
+        self.node.create_msg_send_events({"speed": [1, 2]})
+        group_id = bytes(range(32, 48))
+        self.thymio.process_message(nodes_changed_message(group_id=group_id))
+        msg = self.node.create_msg_send_events({"speed": [3, 4]})
+        self.assertEqual(msg, self.named_values_message(
+            ThymioFB.MESSAGE_TYPE_SEND_EVENTS,
+            self.thymio.last_request_id, group_id, {"speed": [3, 4]}
+        ))
+
+    def test_watch_node(self):
+        for flags in [1, 3, 3]:
+            msg = self.node.create_msg_watch_node(flags)
+            self.assertEqual(msg, ThymioFB.create_message((
+                ThymioFB.MESSAGE_TYPE_WATCH_NODE,
+                (self.thymio.last_request_id, (NODE_ID,), flags)
+            ), ThymioFB.SCHEMA))
+
+    def test_max_templates(self):
+        for i in range(Node.MAX_MSG_TEMPLATES + 1):
+            self.node.create_msg_set_variables({f"v{i}": [i]})
+        self.assertLessEqual(len(self.node.msg_templates), Node.MAX_MSG_TEMPLATES)
+
+
+if __name__ == "__main__":
+    unittest.main()